@@ -0,0 +1,163 @@
+# Synthetic MODIS events for the benchmarks
+#
+# A fixture is a Terra/Aqua stack in the RAW_BANDS layout of modis_local.py
+# covering the buffered date range of an event (Began - 2 to Ended + 2), with
+# a flood of known extent and dates, a permanent river, moving clouds with
+# their shadows flagged in state_1km, and a few missing swaths:
+#
+#     event = synthetic_event(n_days=16, shape=(256, 256), seed=0)
+#     flood_map = modis_local.dfo(event["stack"], event["dates"],
+#                                 event["began"], event["ended"],
+#                                 roi_mask=event["roi_mask"])
+#
+# Reflectances are drawn so that land never passes the standard thresholds
+# and open water always does. Cloud shadows are dark and can pass them in
+# single images, which the 2/3-day composites have to reject, as in real
+# events. Everything is drawn from a seeded RandomState, so a fixture is the
+# same on every machine.
+
+from collections import OrderedDict
+
+import numpy as np
+
+from flood_detection import modis_local
+from flood_detection.utils import tiled_raster
+
+# Event length (days) and shape (rows, cols) of the standard fixtures, and the
+# fraction of the window covered by the roi
+SIZES = OrderedDict([
+    ("small", {"n_days": 8, "shape": (128, 128), "roi_frac": 0.9}),
+    ("medium", {"n_days": 16, "shape": (256, 256), "roi_frac": 0.7}),
+    ("large", {"n_days": 32, "shape": (384, 384), "roi_frac": 0.5}),
+])
+
+# state_1km values: clear, cloudy, clear with cloud shadow
+CLEAR = 0
+CLOUDY = 1
+SHADOW = 1 << 2
+
+# Top left pixel of the fixtures in the GFD grid, for the zonal stats
+WINDOW_ORIGIN = (40000, 100000)
+
+
+def _blobs(rng, shape, frac, scale=16):
+    """Boolean blobs covering about 'frac' of the image"""
+    coarse = rng.uniform(size=(shape[0] // scale + 2, shape[1] // scale + 2))
+    field = np.kron(coarse, np.ones((scale, scale)))
+    # Smooth the blocks a little so the blobs are not squares
+    field = (field + np.roll(field, scale // 2, 0) +
+             np.roll(field, scale // 2, 1)) / 3
+    field = field[:shape[0], :shape[1]]
+    return field > np.quantile(field, 1 - frac)
+
+
+def _ellipse(shape, center, radii):
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    return ((y - center[0]) / float(radii[0])) ** 2 + \
+        ((x - center[1]) / float(radii[1])) ** 2 <= 1
+
+
+def synthetic_event(n_days=16, shape=(256, 256), seed=0, roi_frac=0.7,
+                    cloud_frac=0.1, gap_frac=0.02, began="2010-06-01"):
+    """
+    A synthetic event.
+
+    Args:
+        n_days: days from Began to Ended
+        shape: (rows, cols) of the images
+        roi_frac: fraction of the window inside the (elliptical) roi
+        cloud_frac: fraction of each image under clouds
+        gap_frac: fraction of images with a missing swath (NaN)
+        began: Began date, after 2002-07-04 so there are Aqua images
+
+    Returns:
+        dict with the 'stack' (time, band, y, x) float32, 'dates', 'began',
+        'ended', 'roi_mask', the permanent water 'strata', the 'flood' mask
+        (under water for at least two days of the event) and the 'window'
+        of the GFD grid
+    """
+    rng = np.random.RandomState(seed)
+    rows, cols = shape
+    began = np.datetime64(began, "D")
+    ended = began + n_days - 1
+    days = np.arange(began - 2, ended + 3)
+    dates = np.repeat(days, 2)
+
+    # Permanent river across the window and a flood around it for the middle
+    # half of the event
+    y = np.arange(rows)[:, None]
+    x = np.arange(cols)[None, :]
+    river = np.abs(y - rows / 2.0 - rows / 8.0 * np.sin(x * 6.0 / cols)) < \
+        max(rows // 64, 1)
+    flood = _ellipse(shape, (rows / 2.0, cols / 2.0), (rows / 5.0, cols / 3.0))
+    flood_days = (days >= began + n_days // 4) & \
+        (days <= began + n_days // 4 + max(n_days // 2, 2) - 1)
+    radius = np.sqrt(roi_frac / np.pi)
+    roi_mask = _ellipse(shape, (rows / 2.0, cols / 2.0),
+                        (rows * radius, cols * radius))
+
+    n_images = len(dates)
+    stack = np.empty((n_images, len(modis_local.RAW_BANDS)) + shape,
+                     np.float32)
+    band = dict((name, i) for i, name in enumerate(modis_local.RAW_BANDS))
+    for t in range(n_images):
+        water = river | (flood & flood_days[t // 2])
+        clouds = _blobs(rng, shape, cloud_frac)
+        shift = rng.randint(2, 6, size=2)
+        shadows = np.roll(np.roll(clouds, shift[0], 0), shift[1], 1) & ~clouds
+
+        red = rng.uniform(300, 1500, shape)
+        nir = rng.uniform(2500, 4000, shape)
+        swir = rng.uniform(1000, 2500, shape)
+        red[water] = rng.uniform(300, 900, water.sum())
+        nir[water] = rng.uniform(100, 400, water.sum())
+        swir[water] = rng.uniform(50, 300, water.sum())
+        # Shadows darken the nir and swir, some of them look like water
+        nir[shadows] *= 0.5
+        swir[shadows] *= 0.5
+        red[clouds] = rng.uniform(3000, 6000, clouds.sum())
+        nir[clouds] = rng.uniform(3000, 6000, clouds.sum())
+        swir[clouds] = rng.uniform(2000, 4000, clouds.sum())
+
+        img = stack[t]
+        img[band["red_250m"]] = red
+        img[band["nir_250m"]] = nir
+        img[band["red_500m"]] = red * rng.uniform(0.95, 1.05, shape)
+        img[band["blue"]] = rng.uniform(100, 1500, shape)
+        img[band["green"]] = rng.uniform(100, 1500, shape)
+        img[band["swir"]] = swir
+        img[band["state_1km"]] = np.where(clouds, CLOUDY,
+                                          np.where(shadows, SHADOW, CLEAR))
+        if rng.uniform() < gap_frac:
+            start = rng.randint(rows)
+            img[:, start:start + rows // 8] = np.nan
+
+    window = (slice(WINDOW_ORIGIN[0], WINDOW_ORIGIN[0] + rows),
+              slice(WINDOW_ORIGIN[1], WINDOW_ORIGIN[1] + cols))
+    return {"stack": stack, "dates": dates, "began": str(began),
+            "ended": str(ended), "roi_mask": roi_mask, "strata": river,
+            "flood": flood, "window": window}
+
+
+def size_event(size, seed=0):
+    """The synthetic event of one of the SIZES"""
+    return synthetic_event(seed=seed, **SIZES[size])
+
+
+def zones(window, n_zones=(2, 3)):
+    """
+    Rectangular zones (ID, GeoJSON polygon) tiling a window of the GFD grid,
+    n_zones rows by columns, for the zonal stats
+    """
+    west, south, east, north = tiled_raster.window_to_bounds(window)
+    lon = np.linspace(west, east, n_zones[1] + 1)
+    lat = np.linspace(north, south, n_zones[0] + 1)
+    out = []
+    for i in range(n_zones[0]):
+        for j in range(n_zones[1]):
+            ring = [[lon[j], lat[i]], [lon[j + 1], lat[i]],
+                    [lon[j + 1], lat[i + 1]], [lon[j], lat[i + 1]],
+                    [lon[j], lat[i]]]
+            out.append(("zone_{0}_{1}".format(i, j),
+                        {"type": "Polygon", "coordinates": [ring]}))
+    return out
@@ -0,0 +1,149 @@
+# Offline smoke run of main_gfd.py and main_popstats.py
+#
+# Maps the events of a synthetic event table with main_gfd.py against the
+# offline Earth Engine stand-in (flood_detection/utils/offline_ee.py), on the
+# MODIS stack of the 'small' fixture (fixtures.py), then runs main_popstats.py
+# on the flood maps main_gfd.py exported. Exits with an error if an event of
+# either script is not done.
+#
+# main_gfd.py maps the events with flood_detection/modis.py, which like
+# modis_toolbox.py is still Python 2 (print statements and implicit relative
+# imports such as 'import modis_toolbox'), so the run needs Python 2.7 with
+# numpy and shapely. Run from the top of the repository:
+#
+#     python2.7 -m benchmarks.offline_run
+#
+# The scripts run with 'run_dir' as the working directory, where they write
+# their error logs and checkpoints and the session its assets and exports.
+
+import csv
+import os
+import shutil
+import sys
+
+# Python 2 'python -m' puts '' on sys.path, and packages found there get a
+# relative __path__ that no longer resolves once main() changes to run_dir.
+# The absolute path of the repository goes first so they are found there.
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+
+from benchmarks import fixtures
+from flood_detection.batch import open_csv
+from flood_detection.utils import offline_ee, tiled_raster
+
+# SETTINGS
+run_dir = "offline_run"
+
+
+def rect(x0, y0, x1, y1):
+    return {"type": "Polygon",
+            "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1],
+                             [x0, y0]]]}
+
+
+def feature(geometry, **properties):
+    return {"type": "Feature", "geometry": geometry,
+            "properties": properties}
+
+
+# Session with the datasets main_gfd.py and main_popstats.py read, on the
+# window of 'event'. The event table has two events in the window, one for
+# each threshold type.
+def make_session(event, root):
+    west, south, east, north = tiled_raster.window_to_bounds(event["window"])
+    width, height = east - west, north - south
+
+    def part(x0, y0, x1, y1):
+        return rect(west + width * x0, south + height * y0,
+                    west + width * x1, south + height * y1)
+
+    session = offline_ee.Session(event["window"], root=root)
+    river = event["strata"]
+    session.add_modis(event["stack"], event["dates"])
+    session.add_image("USGS/GMTED2010", {"be75": np.zeros(river.shape)})
+    session.add_image("JRC/GSW1_0/GlobalSurfaceWater",
+                      {"transition": np.where(river, 1, 0)})
+    session.add_collection("JRC/GSW1_1/YearlyHistory", [
+        ({"waterClass": np.where(river, 3, 1)},
+         {"year": year, "system:index": str(year)})
+        for year in range(2000, 2019)])
+    pop = np.random.RandomState(0).uniform(0, 100, river.shape)
+    session.add_collection("JRC/GHSL/P2016/POP_GPW_GLOBE_V1", [
+        ({"population_count": pop * k}, {"system:index": str(year)})
+        for k, year in [(1, 1975), (2, 1990), (3, 2000), (4, 2015)]])
+    session.add_table("USDOS/LSIB/2013", [
+        feature(part(-1, -1, 0.5, 2), cc="AA", name="Aland"),
+        feature(part(0.5, -1, 2, 2), cc="BB", name="Bland")])
+    session.add_table("projects/global-flood-db/fpu", [
+        feature(part(0, 0, 0.5, 1), id="fpu_a"),
+        feature(part(0.5, 0, 1, 1), id="fpu_b")])
+
+    # HydroSHEDS level 4 basins
+    session.add_table("ft:1JRW4YKfVTZKLAH4x4JRsggsHZoXRRUQKTIOYgJOW", [
+        feature(part(0.05, 0.05, 0.5, 0.95), HYBAS_ID=1),
+        feature(part(0.5, 0.05, 0.95, 0.95), HYBAS_ID=2)])
+
+    # Event table (QC database) and DFO database
+    dfo = dict(GlideNumber="0", OtherCountry="0", Country="Aland", long=0.0,
+               lat=0.0, Validation="News", MainCause="Heavy rain",
+               Severity=1, Dead=0, Displaced=10, Began=event["began"],
+               Ended=event["ended"])
+    events = [feature(part(0.3, 0.3, 0.45, 0.6), ID=4604, ThreshType="std",
+                      **dfo),
+              feature(part(0.3, 0.3, 0.7, 0.6), ID=4605, ThreshType="otsu",
+                      **dfo)]
+    session.add_table("projects/global-flood-db/dfo-polygons/qc-aug-01-2019",
+                      events)
+
+    # export imports ee
+    offline_ee.install(session)
+    try:
+        from flood_detection.utils import export
+    finally:
+        offline_ee.uninstall()
+    session.add_table(export.DFO_TABLE, events)
+    return session
+
+
+# Run a script of the repository in run_dir. Returns the rows of its
+# checkpoint that are not done.
+def run(script, session, checkpoint):
+    offline_ee.run_script(os.path.join(repo_dir, script), session)
+    with open_csv(checkpoint, "r") as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        return [{"dfo_id": "", "status": "no events"}]
+    return [row for row in rows if row["status"] != "done"]
+
+
+def main():
+    if sys.version_info[0] > 2:
+        sys.exit("main_gfd.py needs Python 2.7, see the top of {0}"
+                 .format(__file__))
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    for path in ["error_logs/gfd_v3", "error_logs/event_stats"]:
+        os.makedirs(os.path.join(run_dir, path))
+    event = fixtures.size_event("small")
+    session = make_session(event, os.path.abspath(
+                               os.path.join(run_dir, "offline")))
+    os.chdir(run_dir)
+
+    failed = []
+    for script, checkpoint in [
+            ("main_gfd.py", "error_logs/gfd_v3/checkpoint.csv"),
+            ("main_popstats.py", "error_logs/event_stats/pop_checkpoint.csv")]:
+        rows = run(script, session, checkpoint)
+        print("{0}: {1} round trips so far, {2} events not done".format(
+            script, session.round_trips, len(rows)))
+        failed += [(script, row) for row in rows]
+    for script, row in failed:
+        print("{0} {1} {2} {3}".format(script, row["dfo_id"], row["status"],
+                                       row.get("error_message", "")))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# Benchmarks of the local DFO pipeline on synthetic events (fixtures.py)
+#
+# Every stage of modis_local.dfo() and the zonal stats is timed on its own
+# for each fixture size, from inputs built the same way as dfo() builds them,
+# and reported as pixel-days per second (pixels of the window times days of
+# the stack). The whole dfo() and dfo_fused() are timed too. The results are
+# compared to the stored baselines:
+#
+#   - a stage more than 'tolerance' (and min_delta seconds) slower than its
+#     baseline is a regression
+#   - the flood map of every fixture is hashed, a different hash means the
+#     output changed (the fixtures are the same on every machine)
+#
+# Run from the top of the repository:
+#
+#     python -m benchmarks.run
+#
+# and set save_baseline = True to store the results as the new baselines.
+# Timings depend on the machine, so the baseline records a fingerprint of the
+# machine (see machine()) and the timings are only compared on a machine with
+# the same fingerprint. The baseline is local to each machine and is not part
+# of the repository.
+#
+# The composite stages get new water flags for every run, as dfo() does. The
+# uint8 matrix product of join_previous_days() is up to 3x slower depending
+# on where the flags are allocated, so flags computed once would time the
+# stage on one allocation only.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+
+from benchmarks import fixtures
+from flood_detection import modis_local
+from flood_detection.utils import qa
+from flood_stats import zonal
+
+# SETTINGS
+# Fixtures to run (see fixtures.SIZES) and the number of runs of each stage,
+# the fastest is kept
+sizes = ["small", "medium", "large"]
+repeat = 3
+
+# Baselines to compare to, and whether to store these results in it
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "baseline.json")
+save_baseline = False
+
+# A stage slower than (1 + tolerance) times its baseline is a regression,
+# unless it is less than min_delta seconds slower (timer noise)
+tolerance = 0.25
+min_delta = 0.005
+
+# Population grid of the zonal stats, 4 x 4 flood pixels (~1 km)
+POP_FACTOR = 4
+
+
+def best_time(fn, repeat, setup=None):
+    """
+    Fastest of 'repeat' runs of fn(), in seconds, and its last result. With
+    'setup' every run times fn(*setup()) on new inputs.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = timeit.default_timer()
+        result = fn(*args)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def output_digest(img):
+    """Hash of the bands of a flood map"""
+    digest = hashlib.sha1()
+    for name in img.band_names():
+        band = np.ascontiguousarray(img.select(name))
+        digest.update(name.encode("utf-8"))
+        digest.update(band.tobytes())
+    return digest.hexdigest()
+
+
+def accuracy(flooded, truth, roi_mask):
+    """Precision and recall of the flood map against the known water"""
+    flooded = flooded.astype(bool)[roi_mask]
+    truth = truth[roi_mask]
+    tp = float((flooded & truth).sum())
+    return OrderedDict([
+        ("precision", tp / flooded.sum() if flooded.sum() else float("nan")),
+        ("recall", tp / truth.sum() if truth.sum() else float("nan")),
+    ])
+
+
+def machine():
+    """Fingerprint of the machine, timings are only compared on the same"""
+    return OrderedDict([("node", platform.node()),
+                        ("system", platform.system()),
+                        ("machine", platform.machine()),
+                        ("processor", platform.processor()),
+                        ("cpus", multiprocessing.cpu_count()),
+                        ("python", platform.python_version()),
+                        ("numpy", np.__version__)])
+
+
+def stages(event, my_comp="3Day"):
+    """
+    Stage name and a function running it, with the inputs of each stage
+    computed once beforehand from the previous ones the same way as dfo().
+    Stages given as (setup, function) run function(*setup()), see
+    best_time().
+    """
+    stack, days = modis_local.select_stack(event["stack"], event["dates"],
+                                           event["began"], event["ended"])
+    raw = modis_local.from_stack(stack, modis_local.RAW_BANDS)
+    sharp = modis_local.b1b2_ratio(modis_local.pan_sharpen(raw))
+    modis = modis_local.preprocess(modis_local.from_stack(
+        stack, modis_local.RAW_BANDS))
+    thresh = modis_local.STANDARD_THRESHOLDS
+
+    def new_flags():
+        return (modis_local.water_flag(modis, thresh["b1b2"], thresh["b7"]),)
+    flags, = new_flags()
+    lag_days = modis_local.LAG_DAYS[my_comp]
+    comp_days = modis_local.composite_days(event["began"], my_comp)
+    comp_counts = modis_local.join_previous_days(flags, days, lag_days)
+    flood_water = (comp_counts >= comp_days).astype(np.uint8)
+    flooded, _ = modis_local.flood_extent_freq(flood_water)
+
+    window = event["window"]
+    flood_grid = zonal.Grid.from_window(window)
+    pop_grid = zonal.Grid(flood_grid.west, flood_grid.north,
+                          flood_grid.pixel_width * POP_FACTOR,
+                          flood_grid.pixel_height * POP_FACTOR,
+                          (flood_grid.shape[0] // POP_FACTOR,
+                           flood_grid.shape[1] // POP_FACTOR))
+    zones = fixtures.zones(window)
+    population = OrderedDict([("Exposed", np.random.RandomState(0).uniform(
+        0, 100, pop_grid.shape))])
+
+    def rasterize_zones():
+        return zonal.ZonalEngine(zones, flood_grid, pop_grid)
+    engine = rasterize_zones()
+
+    args = (event["stack"], event["dates"], event["began"], event["ended"])
+    return OrderedDict([
+        ("qa_decode", lambda: qa.decode(raw["state_1km"])),
+        ("pan_sharpen", lambda: modis_local.b1b2_ratio(
+            modis_local.pan_sharpen(raw))),
+        ("add_qa_bands", lambda: modis_local.add_qa_bands(OrderedDict(sharp))),
+        ("threshold", lambda: modis_local.water_flag(
+            modis, thresh["b1b2"], thresh["b7"])),
+        ("composite_join", (new_flags,
+                            lambda flags: modis_local.join_previous_days(
+                                flags, days, lag_days))),
+        ("composite_rolling", (new_flags,
+                               lambda flags: modis_local.rolling_previous_days(
+                                   flags, days, lag_days))),
+        ("extent", lambda: modis_local.flood_extent_freq(flood_water)),
+        ("clear_views", lambda: modis_local.get_clear_views(modis)),
+        ("otsu", lambda: modis_local.otsu_thresholds(
+            modis, event["strata"], event["roi_mask"])),
+        ("zonal_setup", rasterize_zones),
+        ("zonal_stats", lambda: engine.exposure(flooded, population)),
+        ("dfo", lambda: modis_local.dfo(*args, my_comp=my_comp,
+                                        roi_mask=event["roi_mask"])),
+        ("dfo_fused", lambda: modis_local.dfo_fused(
+            *args, my_comp=my_comp, roi_mask=event["roi_mask"])),
+    ])
+
+
+def run_size(size, repeat):
+    """Timings, throughput, output hash and accuracy of one fixture"""
+    event = fixtures.size_event(size)
+    stack, days = modis_local.select_stack(event["stack"], event["dates"],
+                                           event["began"], event["ended"])
+    n_days = len(np.unique(days))
+    pixel_days = float(np.prod(stack.shape[-2:])) * n_days
+
+    result = OrderedDict([("n_days", n_days),
+                          ("shape", list(stack.shape[-2:])),
+                          ("images", stack.shape[0]),
+                          ("seconds", OrderedDict()),
+                          ("pixel_days_per_s", OrderedDict())])
+    for name, fn in stages(event).items():
+        setup = None
+        if isinstance(fn, tuple):
+            setup, fn = fn
+        seconds, out = best_time(fn, repeat, setup)
+        result["seconds"][name] = seconds
+        result["pixel_days_per_s"][name] = pixel_days / seconds
+        if name == "dfo":
+            img = out
+    result["output"] = output_digest(img)
+    result["accuracy"] = accuracy(img.select("flooded"),
+                                  event["flood"] | event["strata"],
+                                  event["roi_mask"])
+    return result
+
+
+def compare(results, baseline, tolerance, min_delta=0, timings=True):
+    """
+    Lines of the comparison to the baseline and the number of problems. Set
+    'timings' to False to only compare the outputs.
+    """
+    lines = []
+    problems = 0
+    for size, result in results.items():
+        base = baseline.get("results", {}).get(size)
+        if base is None:
+            lines.append("{0}: no baseline".format(size))
+            continue
+        if base.get("output") != result["output"]:
+            lines.append("{0}: OUTPUT CHANGED (flood map hash {1} -> {2})"
+                         .format(size, base.get("output"), result["output"]))
+            problems += 1
+        if not timings:
+            continue
+        for name, seconds in result["seconds"].items():
+            if name not in base["seconds"]:
+                continue
+            ratio = seconds / base["seconds"][name]
+            if abs(seconds - base["seconds"][name]) < min_delta:
+                continue
+            if ratio > 1 + tolerance:
+                lines.append("{0}: {1} SLOWER {2:.2f}x ({3:.4f}s -> {4:.4f}s)"
+                             .format(size, name, ratio, base["seconds"][name],
+                                     seconds))
+                problems += 1
+            elif ratio < 1 - tolerance:
+                lines.append("{0}: {1} faster {2:.2f}x".format(size, name,
+                                                               1 / ratio))
+    return lines, problems
+
+
+def report(results):
+    names = list(next(iter(results.values()))["seconds"].keys())
+    header = "{0:<18}".format("stage") + "".join(
+        "{0:>22}".format("{0} ({1}d {2}x{3})".format(
+            size, r["n_days"], r["shape"][0], r["shape"][1]))
+        for size, r in results.items())
+    lines = [header, "-" * len(header)]
+    for name in names:
+        lines.append("{0:<18}".format(name) + "".join(
+            "{0:>12.4f}s {1:>6.1f}M/s".format(
+                r["seconds"][name], r["pixel_days_per_s"][name] / 1e6)
+            for r in results.values()))
+    for size, r in results.items():
+        lines.append("{0}: precision {1:.3f}, recall {2:.3f}, output {3}"
+                     .format(size, r["accuracy"]["precision"],
+                             r["accuracy"]["recall"], r["output"][:12]))
+    return "\n".join(lines)
+
+
+def main():
+    results = OrderedDict()
+    for size in sizes:
+        print("Running {0}".format(size))
+        results[size] = run_size(size, repeat)
+    print(report(results))
+
+    problems = 0
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        same_machine = baseline.get("machine") == machine()
+        print("\nCompared to the baseline from {0}:".format(
+            baseline.get("machine", {}).get("node", "?")))
+        if not same_machine:
+            print("baseline is from another machine ({0}), only the outputs "
+                  "are compared".format(json.dumps(baseline.get("machine"))))
+        lines, problems = compare(results, baseline, tolerance, min_delta,
+                                  timings=same_machine)
+        print("\n".join(lines) or "no changes")
+    if save_baseline:
+        baseline = OrderedDict([
+            ("machine", machine()),
+            ("repeat", repeat),
+            ("results", results)])
+        tmp = baseline_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(baseline, f, indent=2)
+        os.rename(tmp, baseline_file)
+        print("Baseline saved to {0}".format(baseline_file))
+    return problems
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -0,0 +1,234 @@
+# Batch runner for mapping many DFO events, used by main_gfd.py
+#
+# Events are mapped by a bounded pool of worker threads. Requests to GEE are
+# paced with a token bucket instead of sleeping for a fixed time every 50
+# events, quota errors are retried with a back off, and every completed or
+# failed event is written to a checkpoint file so a crashed run picks up where
+# it stopped. The runner never touches ee itself, it only calls the function
+# that maps one event, so it can be run against a fake ee client.
+
+import csv
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+CHECKPOINT_FIELDS = ["dfo_id", "status", "error_type", "error_message",
+                     "timestamp"]
+ERROR_LOG_FIELDS = ["error_type", "dfo_id", "error_message"]
+
+# HTTP status and ee.EEException messages GEE returns when we are going too
+# fast. These are retried instead of being logged as a failed event. The
+# messages are only matched on EEException, other errors need the HTTP status,
+# so IDs or pixel counts in a message are never taken for a quota error.
+QUOTA_STATUS = 429
+QUOTA_MESSAGES = ["too many concurrent aggregations", "quota exceeded",
+                  "rate limit exceeded", "too many requests"]
+QUOTA_ERROR = "Quota Error"
+
+
+def open_csv(path, mode):
+    if sys.version_info[0] < 3:
+        return open(path, mode + "b")
+    return open(path, mode, newline="")
+
+
+# Raise from an event function to label the error in the logs, e.g.
+# EventError("Export Error", str(e)) like the error types in main_gfd.py
+class EventError(Exception):
+
+    def __init__(self, error_type, message):
+        Exception.__init__(self, message)
+        self.error_type = error_type
+        self.message = message
+
+
+# HTTP status of an error from the GEE client or the google api client
+def http_status(e):
+    for attr in ("status_code", "status", "code"):
+        status = getattr(e, attr, None)
+        if isinstance(status, int):
+            return status
+    status = getattr(getattr(e, "resp", None), "status", None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+# EventErrors are never quota errors, so map_event can stop the retries of an
+# event once its exports started by raising one.
+def is_quota_error(e):
+    if isinstance(e, EventError):
+        return False
+    status = http_status(e)
+    if status is not None:
+        return status == QUOTA_STATUS
+    if type(e).__name__ != "EEException":
+        return False
+    msg = str(e).lower()
+    return any(m in msg for m in QUOTA_MESSAGES)
+
+
+# Token bucket rate limiter. Holds up to 'capacity' tokens that refill at
+# 'rate' tokens per second, acquire() blocks until a token is available.
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+# Persistent record of event IDs that completed or failed. Rows are appended
+# to a CSV file as events finish, the last row for an ID wins when loading.
+class CheckpointStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.status = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open_csv(path, "r") as f:
+                for row in csv.DictReader(f):
+                    dfo_id = int(float(row["dfo_id"]))
+                    self.status[dfo_id] = row["status"]
+                    self.errors[dfo_id] = (row["error_type"], row["error_message"])
+        else:
+            with open_csv(path, "w") as f:
+                csv.writer(f).writerow(CHECKPOINT_FIELDS)
+
+    def _write(self, dfo_id, status, error_type="", error_message=""):
+        with self.lock:
+            with open_csv(self.path, "a") as f:
+                csv.writer(f).writerow([dfo_id, status, error_type,
+                                        error_message,
+                                        time.strftime("%Y-%m-%d %H:%M:%S")])
+            self.status[dfo_id] = status
+            self.errors[dfo_id] = (error_type, error_message)
+
+    def mark_done(self, dfo_id):
+        self._write(dfo_id, "done")
+
+    def mark_failed(self, dfo_id, error_type, error_message):
+        self._write(dfo_id, "failed", error_type, error_message)
+
+    def completed(self):
+        return sorted(i for i, s in self.status.items() if s == "done")
+
+    def failed(self):
+        return sorted(i for i, s in self.status.items() if s == "failed")
+
+
+# Read the DFO IDs from an error log written by main_gfd.py (or the runner)
+def read_error_log(path):
+    with open_csv(path, "r") as f:
+        return sorted(set(int(float(row["dfo_id"])) for row in csv.DictReader(f)))
+
+
+def write_error_log_header(path):
+    if not os.path.exists(path):
+        with open_csv(path, "w") as f:
+            csv.writer(f).writerow(ERROR_LOG_FIELDS)
+
+
+class BatchRunner(object):
+    # Args:
+    #    map_event: function that maps and exports a single DFO ID
+    #    checkpoint: CheckpointStore with the events already done
+    #    log_file: error log CSV with the same columns as main_gfd.py
+    #    workers: number of events mapped at the same time
+    #    rate_limiter: TokenBucket, one token is taken per event
+    #    max_retries: times an event is retried after a quota error
+    #    backoff: seconds to wait after the first quota error, doubles on
+    #             each retry
+    def __init__(self, map_event, checkpoint, log_file=None, workers=4,
+                 rate_limiter=None, max_retries=3, backoff=60,
+                 sleep=time.sleep):
+        self.map_event = map_event
+        self.checkpoint = checkpoint
+        self.log_file = log_file
+        self.workers = workers
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.log_lock = threading.Lock()
+        if log_file is not None:
+            write_error_log_header(log_file)
+
+    def _log_error(self, error_type, dfo_id, message):
+        self.checkpoint.mark_failed(dfo_id, error_type, message)
+        if self.log_file is None:
+            return
+        with self.log_lock:
+            with open_csv(self.log_file, "a") as f:
+                csv.writer(f).writerow([error_type, dfo_id, message])
+
+    def run_event(self, dfo_id):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                self.map_event(dfo_id)
+            except Exception as e:
+                if is_quota_error(e):
+                    if attempt < self.max_retries:
+                        self.sleep(self.backoff * 2 ** attempt)
+                        attempt += 1
+                        continue
+                    error_type = QUOTA_ERROR
+                else:
+                    error_type = getattr(e, "error_type",
+                                         "DFO Algorithm Error")
+                self._log_error(error_type, dfo_id, str(e))
+                print("{0} {1} - Cataloguing and moving onto next event"
+                      .format(error_type, dfo_id))
+                return dfo_id, "failed"
+            self.checkpoint.mark_done(dfo_id)
+            return dfo_id, "done"
+
+    # Map all events in id_list that are not in the checkpoint yet. Set
+    # retry_failed to also re-run events that failed in a previous run.
+    def run(self, id_list, retry_failed=False):
+        skip = set(self.checkpoint.completed())
+        if not retry_failed:
+            skip.update(self.checkpoint.failed())
+        todo = [i for i in id_list if i not in skip]
+        print("{0} events to map, {1} already in checkpoint"
+              .format(len(todo), len(id_list) - len(todo)))
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = dict(pool.imap_unordered(self.run_event, todo))
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    # Re-run only the events recorded in an error log CSV
+    def run_failures(self, error_log):
+        return self.run(read_error_log(error_log), retry_failed=True)
@@ -0,0 +1,175 @@
+# Incremental updates of the local DFO flood map of an active event
+#
+# When the 'Ended' date of an event is extended or new MODIS days come in,
+# modis_local.dfo_fused() streams the whole date range again. All it keeps
+# while streaming are small accumulators (see "Fused kernel" in
+# modis_local.py): the water flags of the last 2-3 days in a ring buffer, the
+# running composite window and the flood, clear view and observation counts.
+# IncrementalDFO saves those accumulators for the event and the next update
+# carries on from them, so only the new days are read:
+#
+#     event = IncrementalDFO("state/4851.npz", began="2019-10-01")
+#     flood_map = event.update(stack, dates, ended="2019-10-05")
+#     ...
+#     flood_map = event.update(new_stack, new_dates, ended="2019-10-12")
+#
+# The stack of an update only needs the images from resume_date() on. The
+# last day with images may still be incomplete (more granules can come in),
+# so it is not saved: the saved state ends the day before and that day is
+# streamed again on the next update.
+#
+# The thresholds are fixed when the event is first mapped (Otsu thresholds
+# from the images available then). An update gives the same image as
+# dfo_fused() over the whole range with thresholds=event.thresholds;
+# get_max is not supported.
+
+import os
+
+import numpy as np
+
+from flood_detection import modis_local
+
+# Version of the saved state, bumped when the layout changes
+STATE_VERSION = 1
+
+
+class IncrementalDFO(object):
+
+    # Args:
+    #    path: .npz file the state of the event is saved to
+    #    began: start date of the event
+    #    threshold, my_comp, preprocessed, block_rows: see
+    #         modis_local.dfo_fused(), fixed for the event
+    def __init__(self, path, began, threshold="standard", my_comp="3Day",
+                 preprocessed=False, block_rows=256):
+        if threshold not in ["standard", "otsu"]:
+            raise ValueError("'threshold' options are 'standard' or 'otsu'")
+        if my_comp not in modis_local.LAG_DAYS:
+            raise ValueError("'my_comp' options are '2Day' or '3Day'")
+        self.path = path
+        self.began = str(np.datetime64(began, "D"))
+        self.threshold = threshold
+        self.my_comp = my_comp
+        self.preprocessed = preprocessed
+        self.block_rows = block_rows
+        self.lag_days = modis_local.LAG_DAYS[my_comp]
+        self.comp_days = modis_local.composite_days(began, my_comp)
+        # Day 0 of the state, the first day of the buffered date range
+        self.origin = np.datetime64(began, "D") - 2
+        self.thresholds = None
+        self.next_day = 0
+        self.acc = None
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with np.load(self.path) as f:
+            if int(f["version"]) != STATE_VERSION:
+                raise ValueError("{0} was saved by another version"
+                                 .format(self.path))
+            options = (str(f["began"]), str(f["threshold"]), str(f["my_comp"]))
+            if options != (self.began, self.threshold, self.my_comp):
+                raise ValueError("{0} is the state of began={1}, threshold={2}"
+                                 ", my_comp={3}".format(self.path, *options))
+            self.thresholds = {"b1b2": float(f["b1b2"]), "b7": float(f["b7"]),
+                               "base_res": None}
+            self.next_day = int(f["next_day"])
+            self.acc = dict((name, f[name]) for name in
+                            ["ring", "window", "flood_count", "clear_views",
+                             "total_obs"])
+
+    def _save(self, acc, next_day):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp, version=STATE_VERSION, began=self.began,
+                 threshold=self.threshold, my_comp=self.my_comp,
+                 b1b2=self.thresholds["b1b2"], b7=self.thresholds["b7"],
+                 next_day=next_day, **acc)
+        os.rename(tmp, self.path)
+        self.acc = acc
+        self.next_day = next_day
+
+    def resume_date(self):
+        """First day the next update has to read images from"""
+        return str(self.origin + self.next_day)
+
+    def _thresholds(self, stack, strata, roi_mask, seed, thresholds):
+        if thresholds is not None:
+            return thresholds
+        if self.threshold == "standard":
+            return modis_local.STANDARD_THRESHOLDS
+        if strata is None:
+            raise ValueError("'otsu' thresholds need the permanent water "
+                             "'strata'")
+        frame = modis_local.blocked_sample_frame(stack, self.preprocessed,
+                                                 self.block_rows)
+        return modis_local.otsu_thresholds(None, strata, roi_mask, seed=seed,
+                                           frame=frame)
+
+    # Stream days first_day..last_day into (a copy of) the accumulators
+    def _stream(self, acc, stack, day_idx, first_day, last_day):
+        band_names = modis_local.PREPROCESSED_BANDS if self.preprocessed \
+            else modis_local.RAW_BANDS
+        acc = dict((name, array.copy()) for name, array in acc.items())
+        if last_day < first_day:
+            return acc
+        for rows in modis_local.row_blocks(stack.shape[-2], self.block_rows):
+            block = {"ring": acc["ring"][:, rows]}
+            for name in ["window", "flood_count", "clear_views", "total_obs"]:
+                block[name] = acc[name][rows]
+            modis_local.fused_block(stack, day_idx, rows, band_names,
+                                    self.thresholds["b1b2"],
+                                    self.thresholds["b7"], self.lag_days,
+                                    self.comp_days, first_day, last_day,
+                                    acc=block)
+        return acc
+
+    def update(self, stack, dates, ended, roi_mask=None, strata=None, seed=0,
+               thresholds=None):
+        """
+        Add the images of 'stack' from resume_date() to 'ended' (+2 days,
+        like dfo) to the event, save the state and return the flood map of
+        the event so far.
+
+        'strata', 'seed' and 'thresholds' are only used the first time, to
+        set the thresholds of the event.
+        """
+        stack, days = modis_local.select_stack(stack, dates, self.began,
+                                               ended)
+        day_idx = (days - self.origin).astype(np.int64)
+        first = int(np.searchsorted(day_idx, self.next_day))
+        stack, day_idx = stack[first:], day_idx[first:]
+        if self.thresholds is None:
+            self.thresholds = self._thresholds(stack, strata, roi_mask, seed,
+                                               thresholds)
+        if self.acc is None:
+            self.acc = modis_local.fused_accumulators(stack.shape[-2:],
+                                                      self.lag_days)
+        elif self.acc["window"].shape != stack.shape[-2:]:
+            raise ValueError("The stack is {0}, the event state is {1}"
+                             .format(stack.shape[-2:],
+                                     self.acc["window"].shape))
+
+        if len(day_idx):
+            last_day = int(day_idx[-1])
+            # Everything before the last day is final
+            committed = self._stream(self.acc, stack, day_idx,
+                                     self.next_day, last_day - 1)
+            self._save(committed, last_day)
+            acc = self._stream(committed, stack, day_idx, last_day, last_day)
+        else:
+            acc = self.acc
+        return self.image(acc, ended, roi_mask)
+
+    def image(self, acc, ended, roi_mask=None):
+        duration = acc["flood_count"] // 2
+        flooded = (duration >= 1).astype(np.uint8)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            clear_perc = acc["clear_views"] / \
+                acc["total_obs"].astype(np.float32)
+        return modis_local.final_image(flooded, duration, acc["clear_views"],
+                                       clear_perc, self.thresholds,
+                                       self.began, ended, self.threshold,
+                                       self.comp_days, roi_mask)
@@ -5,6 +5,11 @@
 #  - 'threshold' - "standard" or "otsu"
 #  - 'my_comp' - "2Day" or "3Day". The DFO algorithm uses multiple days of images to remove false detections from cloud shadows.
 #  - 'get_max' - option to add the maximum amount image as a band to the output default 'False'
+#  - 'composite' - "join" or "rolling". How the 2 or 3-day composites are built, either with
+#                  an ee.Join.saveAll (default) or a rolling window sum over the days of the event.
+#                  Both give the same result, "rolling" is cheaper for long events.
+#  - 'roi_mask' - optional ee.Image mask of the roi (utils.roi.ee_mask()). The images are masked
+#                 with it instead of clipped to 'roi', which is faster for complex geometries.
 
 # The output is a multi-band image that has 4 bands:
 #     0: 'flooded': Flood Extent (1 = flood, 0 = not flood)
@@ -14,14 +19,26 @@
 
 import ee
 import modis_toolbox
-from utils import misc, otsu
+from utils import misc, otsu, timing
 
-def dfo(roi, began, ended, threshold, my_comp='3Day', get_max=False):
+@timing.traced
+def dfo(roi, began, ended, threshold, my_comp='3Day', get_max=False,
+        composite='join', roi_mask=None):
+
+    if composite not in ['join', 'rolling']:
+        raise ValueError("'composite' options are 'join' or 'rolling'")
 
     # Get rectangular bounds because it works faster than complex geometries.
     # Clip to actual geometry at the end.
     roi_bounds = roi.bounds()
 
+    # Clip to the roi, or mask with the rasterized roi (utils.roi.ee_mask())
+    # which is much cheaper than clipping to a complex geometry
+    def roi_clip(img):
+        if roi_mask is None:
+            return img.clip(roi)
+        return img.updateMask(roi_mask)
+
     # Get dates as ee.Date()
     # The "Began" and "End" dates are taken in this case and buffered at the
     # start and end by 2 days.  This is so the first day of the flood, defined
@@ -36,25 +53,26 @@ def dfo(roi, began, ended, threshold, my_comp='3Day', get_max=False):
 
     # STEP 2 - LOAD IMPORTANT MODIS DATA BASED ON DATES
     # Collect Terra and Aqua satellites
-    terra = modis_toolbox.get_terra(roi_bounds, date_range).map(region_clip)
-    aqua = modis_toolbox.get_aqua(roi_bounds, date_range).map(region_clip)
-
-    # Apply Pan-sharpen function to aqua and terra images
-    terra_sharp = terra.map(modis_toolbox.pan_sharpen)
-    aqua_sharp = aqua.map(modis_toolbox.pan_sharpen)
-
-    # add NIR/RED ratio to all images
-    terra_ratio = terra_sharp.map(modis_toolbox.b1b2_ratio)
-    aqua_ratio = aqua_sharp.map(modis_toolbox.b1b2_ratio)
-
-    # Apply QA Band Extract to Terra & Aqua
-    terra_final = terra_ratio.map(modis_toolbox.add_qa_bands)
-    aqua_final = aqua_ratio.map(modis_toolbox.add_qa_bands)
-
-    # Finally, the Terra and Aqua products are combined into one image
-    # collection so they can be accessed in together in the DFO algorithm.
-    modis = ee.ImageCollection(terra_final.merge(aqua_final)\
-                                .sort("system:time_start", True))
+    with timing.stage("modis.dfo.collect"):
+        terra = modis_toolbox.get_terra(roi_bounds, date_range).map(region_clip)
+        aqua = modis_toolbox.get_aqua(roi_bounds, date_range).map(region_clip)
+
+        # Apply Pan-sharpen function to aqua and terra images
+        terra_sharp = terra.map(modis_toolbox.pan_sharpen)
+        aqua_sharp = aqua.map(modis_toolbox.pan_sharpen)
+
+        # add NIR/RED ratio to all images
+        terra_ratio = terra_sharp.map(modis_toolbox.b1b2_ratio)
+        aqua_ratio = aqua_sharp.map(modis_toolbox.b1b2_ratio)
+
+        # Apply QA Band Extract to Terra & Aqua
+        terra_final = terra_ratio.map(modis_toolbox.add_qa_bands)
+        aqua_final = aqua_ratio.map(modis_toolbox.add_qa_bands)
+
+        # Finally, the Terra and Aqua products are combined into one image
+        # collection so they can be accessed in together in the DFO algorithm.
+        modis = ee.ImageCollection(terra_final.merge(aqua_final)\
+                                    .sort("system:time_start", True))
     print "Collected and pre-processed MODIS Images"
 
     # STEP 3 - APPLY THE DFO WATER DETECTION & COMPOSITING ALGORITHMS
@@ -69,56 +87,57 @@ def dfo(roi, began, ended, threshold, my_comp='3Day', get_max=False):
     if threshold == "standard":
         thresh_dict = {"b1b2": 0.70, "b7": 675.00, 'base_res': None}
     elif threshold == "otsu":
-
-        # Apply the qa_mask to each modis image.  We then make a composite across
-        # all the flood images to one image.  This is done so to increase the
-        # sampling space as well as represent variation within the flood event
-        # itself.  Clip to the roi to exclude ocean area in the sample.
-        modis_masked = modis.map(modis_toolbox.qa_mask)
-        sample_frame = modis_masked.median().clip(roi)
-
-        # Get a watermask that can be used to define strata for sampling
-        began_img = ee.Image().set({"Began": began})
-        strata = misc.get_jrc_yearly_perm(began, roi_bounds)\
-                     .updateMask(sample_frame.select("red_250m").mask()).int8()\
-                     .clip(roi)
-
-        # Otsu histrograms require a "bi-modal histogram". We need to constrain
-        # the reflectance range that can be used in the histogram as it may
-        # include high-reflectance features (e.g. missed clouds) that will make
-        # the histogram "multi-modal". Below are the steps to constrain the
-        # histograms into a reasonable range that one might expect water/ land
-        swir_mask = sample_frame.select("swir").gt(-500)\
-                    .And(sample_frame.select("swir").lt(3000))
-        cleaned_swir = sample_frame.select("swir").updateMask(swir_mask)
-
-        # Put it all together in a final sample image
-        sample_img = sample_frame.addBands(strata)\
-                                 .addBands(cleaned_swir, overwrite=True)
-
-        # Collect Sample using stratifiedSample() function
-        sample_bands = ["b1b2_ratio", "swir", "jrc_perm_yearly"]
-        base_res = ee.Image(modis.first()).select("red_250m")\
-                            .projection().nominalScale().multiply(1).getInfo()
-        base_res = round(base_res,2)
-        sample = sample_img.select(sample_bands)\
-                           .stratifiedSample(numPoints=2500,
-                                             classBand="jrc_perm_yearly",
-                                             region=roi, scale=base_res,
-                                             dropNulls=True)
-
-        # Convert the sample to a histogram
-        b1b2_hist = sample.reduceColumns(ee.Reducer.histogram(),
-                                        ["b1b2_ratio"]).get("histogram")
-        swir_hist = sample.reduceColumns(ee.Reducer.histogram(),
-                                        ["swir"]).get("histogram")
-
-        # Calculate histogram, run otsu, and collect into a dictionary
-        b1b2_thresh = otsu.get_threshold(b1b2_hist)
-        swir_thresh = otsu.get_threshold(swir_hist)
-        thresh_dict = {'b1b2': b1b2_thresh.getInfo(),
-                       'b7': swir_thresh.getInfo(),
-                       'base_res':base_res}
+        with timing.stage("modis.dfo.otsu", num_points=2500):
+
+            # Apply the qa_mask to each modis image.  We then make a composite across
+            # all the flood images to one image.  This is done so to increase the
+            # sampling space as well as represent variation within the flood event
+            # itself.  Clip to the roi to exclude ocean area in the sample.
+            modis_masked = modis.map(modis_toolbox.qa_mask)
+            sample_frame = roi_clip(modis_masked.median())
+
+            # Get a watermask that can be used to define strata for sampling
+            began_img = ee.Image().set({"Began": began})
+            strata = roi_clip(misc.get_jrc_yearly_perm(began, roi_bounds)\
+                         .updateMask(sample_frame.select("red_250m").mask()).int8())
+
+            # Otsu histrograms require a "bi-modal histogram". We need to constrain
+            # the reflectance range that can be used in the histogram as it may
+            # include high-reflectance features (e.g. missed clouds) that will make
+            # the histogram "multi-modal". Below are the steps to constrain the
+            # histograms into a reasonable range that one might expect water/ land
+            swir_mask = sample_frame.select("swir").gt(-500)\
+                        .And(sample_frame.select("swir").lt(3000))
+            cleaned_swir = sample_frame.select("swir").updateMask(swir_mask)
+
+            # Put it all together in a final sample image
+            sample_img = sample_frame.addBands(strata)\
+                                     .addBands(cleaned_swir, overwrite=True)
+
+            # Collect Sample using stratifiedSample() function
+            sample_bands = ["b1b2_ratio", "swir", "jrc_perm_yearly"]
+            with timing.stage("modis.dfo.otsu.base_res"):
+                base_res = ee.Image(modis.first()).select("red_250m")\
+                                    .projection().nominalScale().multiply(1).getInfo()
+            base_res = round(base_res,2)
+            sample = sample_img.select(sample_bands)\
+                               .stratifiedSample(numPoints=2500,
+                                                 classBand="jrc_perm_yearly",
+                                                 region=roi, scale=base_res,
+                                                 dropNulls=True)
+
+            # Convert the sample to a histogram
+            b1b2_hist = sample.reduceColumns(ee.Reducer.histogram(),
+                                            ["b1b2_ratio"]).get("histogram")
+            swir_hist = sample.reduceColumns(ee.Reducer.histogram(),
+                                            ["swir"]).get("histogram")
+
+            # Calculate histogram, run otsu, and collect into a dictionary
+            b1b2_thresh = otsu.get_threshold(b1b2_hist)
+            swir_thresh = otsu.get_threshold(swir_hist)
+            thresh_dict = {'b1b2': b1b2_thresh.getInfo(),
+                           'b7': swir_thresh.getInfo(),
+                           'base_res':base_res}
 
         print "Calculated thresholds for Otsu: {0}".format(thresh_dict)
 
@@ -158,75 +177,121 @@ def dfo(roi, began, ended, threshold, my_comp='3Day', get_max=False):
                                          'otsu_sample_res': thresh_dict['base_res']})
 
     # The dfoWaterDetection() function is mapped over the MODIS collection
-    modis_dfo_water_detection = dfo_water_detection(modis, thresh_dict["b1b2"],
-                                                    thresh_dict["b7"])
-
-    # STEP 3.2 - DFO COMPOSITES
-    # The following functions create 2 or 3-day composites.  IMPORTANT:
-    # This is based on the variable defined above as "my_comp".  This is
-    # done by using a join where a lag period is defined (in milliseconds)
-    # where images 2 or 3 days prior are joined to the current image as a
-    # property.  This is later extracted in a function to access the images
-    # and create a composite.
-    def join_previous_days(left_collection, right_collection, lag_days):
-            filt = ee.Filter.And(ee.Filter.maxDifference(
-                                    1000 * 60 * 60 * 24 * lag_days,
-                                    leftField = "system:time_start",
-                                    rightField = "system:time_start"),
-                                ee.Filter.greaterThanOrEquals(
-                                    leftField = "system:time_start",
-                                    rightField = "system:time_start"))
-
-            return ee.Join.saveAll(matchesKey = 'dfo_images',
-                                   measureKey = 'delta_t',
-                                   ordering = "system:time_start",
-                                   ascending = True).apply(left_collection,
-                                                           right_collection,
-                                                           filt)
-
-    # The join_previous_days() function is then used to calculate  "2Day" or
-    # "3Day" composites. The separate image collections can be accessed by
-    # defining the variable my_comp above.
-    lag_days = {"3Day": 2, "2Day": 1}
-    modis_join_previous = join_previous_days(modis_dfo_water_detection,
-                        modis_dfo_water_detection, lag_days[my_comp])
-
-    # The next function takes the join_previous_days results and combines the
-    # images in order to create the actual composite.  This is done by
-    # accessing the images stored in the properties of each image (i.e. the
-    # images 1 or 2 days prior).  Each composite has 2x the number of
-    # images as it does days since we use both Terra and Aqua.  Where at
-    # least half of those days are flagged as water (i.e. 3 days for 3-day
-    # composites and 2-days for 2-day composites) a pixel is marked as
-    # water.  This step help avoid marking cloud shadows, that move between
-    # images, as water.  A common misclassificatin in these types of
-    # algorithms.
-
-    def dfo_flood_water(composite_collection, comp_days):
-        def apply_comp_day(image):
-            dfo_composite = ee.ImageCollection.fromImages(image.get("dfo_images")).sum()
-            stable_water_thresh = dfo_composite.gte(comp_days)
-            return stable_water_thresh.select(["sum"], ["flood_water"]).copyProperties(image).set({"system:time_start": image.get("system:time_start")})
-        stable_water_thresh = composite_collection.map(apply_comp_day)
-        return stable_water_thresh.set({"composite_type": ee.String(str(comp_days)).cat("Day")})
-
-    # If the began date is before Aqua started, change the critera for flooded pixels
-    # Since there will be half the images available
-    #
-    # Terra & Aqua (post 2002-07-04)
-    # DFO Threshold for flood water is 3 for 3-day composites and 2 for
-    # 2-day composites
-    #
-    # Terra Only (pre 2002-07-04)
-    # DFO Threshold for flood water is 2 for 3-day composites and 1 for
-    # 2-day composites.
-
-    if (ee.Date(began).difference(ee.Date("2002-07-04"), "day")).gte(0):
-        dfo_comp = {"3Day": 3, "2Day": 2}
-    elif (ee.Date(began).difference(ee.Date("2002-07-04"), "day")).lt(0):
-        dfo_comp = {"3Day": 2, "2Day": 1}
-
-    dfo_flood_coll = dfo_flood_water(modis_join_previous, dfo_comp[my_comp])
+    with timing.stage("modis.dfo.composite", composite=composite, my_comp=my_comp):
+        modis_dfo_water_detection = dfo_water_detection(modis, thresh_dict["b1b2"],
+                                                        thresh_dict["b7"])
+
+        # STEP 3.2 - DFO COMPOSITES
+        # The following functions create 2 or 3-day composites.  IMPORTANT:
+        # This is based on the variable defined above as "my_comp".  This is
+        # done by using a join where a lag period is defined (in milliseconds)
+        # where images 2 or 3 days prior are joined to the current image as a
+        # property.  This is later extracted in a function to access the images
+        # and create a composite.
+        def join_previous_days(left_collection, right_collection, lag_days):
+                filt = ee.Filter.And(ee.Filter.maxDifference(
+                                        1000 * 60 * 60 * 24 * lag_days,
+                                        leftField = "system:time_start",
+                                        rightField = "system:time_start"),
+                                    ee.Filter.greaterThanOrEquals(
+                                        leftField = "system:time_start",
+                                        rightField = "system:time_start"))
+
+                return ee.Join.saveAll(matchesKey = 'dfo_images',
+                                       measureKey = 'delta_t',
+                                       ordering = "system:time_start",
+                                       ascending = True).apply(left_collection,
+                                                               right_collection,
+                                                               filt)
+
+        # The join_previous_days() function is then used to calculate  "2Day" or
+        # "3Day" composites. The separate image collections can be accessed by
+        # defining the variable my_comp above.
+        lag_days = {"3Day": 2, "2Day": 1}
+
+        # The next function takes the join_previous_days results and combines the
+        # images in order to create the actual composite.  This is done by
+        # accessing the images stored in the properties of each image (i.e. the
+        # images 1 or 2 days prior).  Each composite has 2x the number of
+        # images as it does days since we use both Terra and Aqua.  Where at
+        # least half of those days are flagged as water (i.e. 3 days for 3-day
+        # composites and 2-days for 2-day composites) a pixel is marked as
+        # water.  This step help avoid marking cloud shadows, that move between
+        # images, as water.  A common misclassificatin in these types of
+        # algorithms.
+
+        def dfo_flood_water(composite_collection, comp_days):
+            def apply_comp_day(image):
+                dfo_composite = ee.ImageCollection.fromImages(image.get("dfo_images")).sum()
+                stable_water_thresh = dfo_composite.gte(comp_days)
+                return stable_water_thresh.select(["sum"], ["flood_water"]).copyProperties(image).set({"system:time_start": image.get("system:time_start")})
+            stable_water_thresh = composite_collection.map(apply_comp_day)
+            return stable_water_thresh.set({"composite_type": ee.String(str(comp_days)).cat("Day")})
+
+        # The join compares every image with every other image and then sums the
+        # 4-6 matched images again for each output image. The rolling alternative
+        # sums the water flags per day once, then steps through the days keeping a
+        # running window sum: the entering day is added and the day that falls out
+        # of the window is subtracted. Each image then picks up the window of its
+        # own day, which gives the same composites as the join.
+        def dfo_rolling_flood_water(water_collection, lag_days, comp_days):
+            start = date_range.start()
+            n_days = date_range.end().difference(start, "day").round()
+            day_index = ee.List.sequence(0, n_days.subtract(1))
+            zero = ee.Image.constant(0).rename("sum")
+
+            def daily_sum(i):
+                day = start.advance(i, "day")
+                day_coll = water_collection.filterDate(day, day.advance(1, "day"))
+                return ee.Image(ee.Algorithms.If(day_coll.size().gt(0),
+                                                 day_coll.sum().unmask(0), zero))
+            daily = day_index.map(daily_sum)
+
+            def add_day(i, windows):
+                windows = ee.List(windows)
+                i = ee.Number(i)
+                entering = ee.Image(daily.get(i))
+                leaving = ee.Image(ee.Algorithms.If(i.gt(lag_days),
+                                            daily.get(i.subtract(lag_days + 1)),
+                                            zero))
+                return windows.add(ee.Image(windows.get(-1)).add(entering)
+                                                             .subtract(leaving))
+            windows = ee.List(day_index.iterate(add_day, ee.List([zero]))).slice(1)
+
+            # The join leaves pixels masked where no image has data, do the same
+            observed = water_collection.count().select([0]).gt(0)
+
+            def apply_comp_day(image):
+                i = ee.Date(image.get("system:time_start")).difference(start, "day").floor()
+                stable_water_thresh = ee.Image(windows.get(i)).gte(comp_days)\
+                                        .updateMask(observed)
+                return stable_water_thresh.select(["sum"], ["flood_water"]).copyProperties(image).set({"system:time_start": image.get("system:time_start")})
+            stable_water_thresh = water_collection.map(apply_comp_day)
+            return stable_water_thresh.set({"composite_type": ee.String(str(comp_days)).cat("Day")})
+
+        # If the began date is before Aqua started, change the critera for flooded pixels
+        # Since there will be half the images available
+        #
+        # Terra & Aqua (post 2002-07-04)
+        # DFO Threshold for flood water is 3 for 3-day composites and 2 for
+        # 2-day composites
+        #
+        # Terra Only (pre 2002-07-04)
+        # DFO Threshold for flood water is 2 for 3-day composites and 1 for
+        # 2-day composites.
+
+        if (ee.Date(began).difference(ee.Date("2002-07-04"), "day")).gte(0):
+            dfo_comp = {"3Day": 3, "2Day": 2}
+        elif (ee.Date(began).difference(ee.Date("2002-07-04"), "day")).lt(0):
+            dfo_comp = {"3Day": 2, "2Day": 1}
+
+        if composite == "join":
+            modis_join_previous = join_previous_days(modis_dfo_water_detection,
+                                modis_dfo_water_detection, lag_days[my_comp])
+            dfo_flood_coll = dfo_flood_water(modis_join_previous, dfo_comp[my_comp])
+        elif composite == "rolling":
+            dfo_flood_coll = dfo_rolling_flood_water(modis_dfo_water_detection,
+                                        lag_days[my_comp], dfo_comp[my_comp])
 
     # STEP 3.3 COLLAPSE COMPOSITES INTO A FINAL FLOOD MAP
     # The following function is the last step in the DFO algorithm.  Here we
@@ -241,73 +306,74 @@ def dfo(roi, began, ended, threshold, my_comp='3Day', get_max=False):
                             .addBands(freq.select(["flood_water"],["duration"]))
                             .copyProperties(img_coll))
 
-    dfo_flood_img = flood_extent_freq(dfo_flood_coll)
-
-    # STEP 3.4 CALCULATE CLEAR DAYS
-    # The following function takes an imageCollection that was previously run
-    # through qaBandExtract (i.e. the input band names match with those output
-    # by qaBandExtract) and returns an image that calculates the number of clear
-    # days for each pixel during the flood period.
-    def get_clear_views(img_coll):
-        def get_cloud_mask(img):
-            clouds = img.select("cloud_state").eq(0)
-            shadows = img.select("cloud_shadow").eq(0)
-            return clouds.add(shadows).gt(0)
-        clear_views = img_coll.map(get_cloud_mask)
-        number_clear_views = ee.Image(clear_views.sum()).select(["cloud_state"],
-                                                             ["clear_views"]).toUint16()
-        def add_obs(img):
-            obs = img.select(["cloud_state"],["observation"]).gte(0)
-            return img.addBands(obs);
-        observations = img_coll.map(add_obs)
-        total_obs = observations.select('observation').sum()
-        clear_perc = number_clear_views.divide(ee.Image(total_obs))\
-                        .select(["clear_views"], ["clear_perc"])
-        return number_clear_views.addBands(clear_perc)
-
-    dfo_clear_days = get_clear_views(modis)
-
-    # STEP 3.4a ADD MAX IMG
-    # For the validation we want to use the image with the maximum flood extent.
-    # Calculate the maxImg with the function below that runs a reduceRegion() and
-    # then selects the image with the max value.
-    if get_max == True:
-        def get_max_img(img_coll):
-            # Function to calculate the flood extent of each image
-            def calc_extent(img):
-                img_extent = ee.Image(img).reduceRegion(reducer=ee.Reducer.sum(),
-                                                        geometry=roi, scale=1000,
-                                                        maxPixels=10e9)
-                return img.set({'extent': img_extent.get('flood_water')})
-
-            # Apply calcExtent() function to each image
-            extent = img_coll.map(calc_extent)
-            max_val = extent.aggregate_max('extent')
-            max_img = ee.Image(extent.filterMetadata('extent', 'equals', max_val).first())
-            date = ee.Date(max_img.get('system:time_start'))
-            return max_img.select(['flood_water'],['max_img']).set({'max_img_date':date})
-
-        max_img = get_max_img(dfo_flood_coll)
-        max_img_date = ee.Date(max_img.get("max_img_date")).format('yyyy-MM-dd')
-
-        # STEP 3.5_TRUE: PREP FINAL IMAGES
-        # Add all the prepared bands together
-        dfo_final = ee.Image(dfo_flood_img).addBands([dfo_clear_days, max_img])\
-                            .clip(roi)\
-                            .set({"began": ee.Date(began).format("yyyy-MM-dd"),
-                                  "ended": ee.Date(ended).format("yyyy-MM-dd"),
-                                  "threshold_type": threshold,
-                                  "max_img_date": max_img_date})
-    elif get_max == False:
-        # STEP 3.5_FALSE: PREP FINAL IMAGES
-        # Add all the prepared bands together
-        dfo_final = ee.Image(dfo_flood_img).addBands(dfo_clear_days).clip(roi)\
-                            .set({"began": ee.Date(began).format("yyyy-MM-dd"),
-                                  "ended": ee.Date(ended).format("yyyy-MM-dd"),
-                                  "threshold_type": threshold})
-
-    else:
-        raise ValueError("'max_img' options are 'True' or 'False'")
+    with timing.stage("modis.dfo.final", get_max=get_max):
+        dfo_flood_img = flood_extent_freq(dfo_flood_coll)
+
+        # STEP 3.4 CALCULATE CLEAR DAYS
+        # The following function takes an imageCollection that was previously run
+        # through qaBandExtract (i.e. the input band names match with those output
+        # by qaBandExtract) and returns an image that calculates the number of clear
+        # days for each pixel during the flood period.
+        def get_clear_views(img_coll):
+            def get_cloud_mask(img):
+                clouds = img.select("cloud_state").eq(0)
+                shadows = img.select("cloud_shadow").eq(0)
+                return clouds.add(shadows).gt(0)
+            clear_views = img_coll.map(get_cloud_mask)
+            number_clear_views = ee.Image(clear_views.sum()).select(["cloud_state"],
+                                                                 ["clear_views"]).toUint16()
+            def add_obs(img):
+                obs = img.select(["cloud_state"],["observation"]).gte(0)
+                return img.addBands(obs);
+            observations = img_coll.map(add_obs)
+            total_obs = observations.select('observation').sum()
+            clear_perc = number_clear_views.divide(ee.Image(total_obs))\
+                            .select(["clear_views"], ["clear_perc"])
+            return number_clear_views.addBands(clear_perc)
+
+        dfo_clear_days = get_clear_views(modis)
+
+        # STEP 3.4a ADD MAX IMG
+        # For the validation we want to use the image with the maximum flood extent.
+        # Calculate the maxImg with the function below that runs a reduceRegion() and
+        # then selects the image with the max value.
+        if get_max == True:
+            def get_max_img(img_coll):
+                # Function to calculate the flood extent of each image
+                def calc_extent(img):
+                    img_extent = ee.Image(img).reduceRegion(reducer=ee.Reducer.sum(),
+                                                            geometry=roi, scale=1000,
+                                                            maxPixels=10e9)
+                    return img.set({'extent': img_extent.get('flood_water')})
+
+                # Apply calcExtent() function to each image
+                extent = img_coll.map(calc_extent)
+                max_val = extent.aggregate_max('extent')
+                max_img = ee.Image(extent.filterMetadata('extent', 'equals', max_val).first())
+                date = ee.Date(max_img.get('system:time_start'))
+                return max_img.select(['flood_water'],['max_img']).set({'max_img_date':date})
+
+            max_img = get_max_img(dfo_flood_coll)
+            max_img_date = ee.Date(max_img.get("max_img_date")).format('yyyy-MM-dd')
+
+            # STEP 3.5_TRUE: PREP FINAL IMAGES
+            # Add all the prepared bands together
+            dfo_final = roi_clip(ee.Image(dfo_flood_img)
+                                 .addBands([dfo_clear_days, max_img]))\
+                                .set({"began": ee.Date(began).format("yyyy-MM-dd"),
+                                      "ended": ee.Date(ended).format("yyyy-MM-dd"),
+                                      "threshold_type": threshold,
+                                      "max_img_date": max_img_date})
+        elif get_max == False:
+            # STEP 3.5_FALSE: PREP FINAL IMAGES
+            # Add all the prepared bands together
+            dfo_final = roi_clip(ee.Image(dfo_flood_img).addBands(dfo_clear_days))\
+                                .set({"began": ee.Date(began).format("yyyy-MM-dd"),
+                                      "ended": ee.Date(ended).format("yyyy-MM-dd"),
+                                      "threshold_type": threshold})
+
+        else:
+            raise ValueError("'max_img' options are 'True' or 'False'")
 
     print "DFO Flood Dectection Complete"
     return dfo_final
@@ -0,0 +1,595 @@
+# Local (NumPy) version of the DFO flood detection algorithm in modis.py. The
+# steps, band names and thresholds follow the Earth Engine version one-for-one
+# so results can be checked against the EE output, but everything runs on
+# in-memory arrays instead of building a server side graph.
+#
+# Input Parameters:
+#  - 'stack' - MODIS stack as an array of shape (time, band, y, x) with bands
+#              in the order of RAW_BANDS (the joined GQ/GA bands produced by
+#              modis_toolbox.get_terra / get_aqua). Terra and Aqua images are
+#              simply stacked along the time axis. Masked pixels are NaN.
+#  - 'dates' - acquisition date of each image along the time axis (strings or
+#              numpy datetime64)
+#  - 'began' - the start date of the event as a String
+#  - 'ended' - the end date of the event as a String
+#  - 'threshold' - "standard" or "otsu"
+#  - 'my_comp' - "2Day" or "3Day"
+#  - 'roi_mask' - optional boolean (y, x) array, the local equivalent of
+#                 clipping to the roi. Pixels outside of it are set to 0.
+#  - 'get_max' - option to add the maximum amount image as a band to the output
+#  - 'composite' - "join" or "rolling", how the 2 or 3-day composites are built
+#  - 'strata' - boolean (y, x) array of JRC yearly permanent water, the Otsu
+#               sample is drawn from these pixels (see misc.get_jrc_yearly_perm)
+#  - 'seed' - seed for the Otsu sample
+#  - 'preprocessed' - True if 'stack' already holds the PREPROCESSED_BANDS,
+#                     e.g. read from utils.stack_cache
+#
+# The output is a LocalImage with the same 4 bands as modis.dfo():
+#     0: 'flooded': Flood Extent (1 = flood, 0 = not flood)
+#     1: 'duration': number of days in event that each pixel was flooded
+#     2: 'clear_views': Number of clear views during the event
+#     3: 'clear_perc': Percent clear views (clear views normalized by number of images)
+#
+# dfo_fused() takes the same parameters (plus 'block_rows' and precomputed
+# 'thresholds', without 'composite') and returns the same image while streaming the time axis once
+# per block of rows, see the "Fused kernel" section below.
+
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+from flood_detection.utils import otsu_local, qa
+
+# Band order of the joined GQ (250-m) and GA (500-m) products, see
+# modis_toolbox.dfo_bands_gq, dfo_bands_ga and join_collections
+RAW_BANDS = ["red_250m", "nir_250m", "red_500m", "blue", "green", "swir",
+             "state_1km"]
+
+# Band order after pan_sharpen, b1b2_ratio and add_qa_bands
+PREPROCESSED_BANDS = ["red_250m", "nir_250m", "state_1km", "blue", "green",
+                      "swir", "b1b2_ratio", "cloud_state", "cloud_shadow",
+                      "ice_flag", "snow_flag"]
+
+OUTPUT_BANDS = ["flooded", "duration", "clear_views", "clear_perc"]
+
+# Static DFO thresholds, same as the "standard" option in modis.dfo()
+STANDARD_THRESHOLDS = {"b1b2": 0.70, "b7": 675.00, "base_res": None}
+B1_THRESHOLD = 2027
+
+# First day with both Terra and Aqua images
+AQUA_START = np.datetime64("2002-07-04", "D")
+
+# Number of days prior joined to each image, and the number of water flags in
+# the composite needed to call a pixel flood water (Terra & Aqua / Terra only)
+LAG_DAYS = {"3Day": 2, "2Day": 1}
+DFO_COMP = {"3Day": 3, "2Day": 2}
+DFO_COMP_TERRA = {"3Day": 2, "2Day": 1}
+
+# modis.dfo() picks the counts with 'if ee.Number(...).gte(0)', which is
+# always true on the client, so the EE flood maps use the Terra & Aqua counts
+# for pre-Aqua events too. The local engine does the same so both give the
+# same maps. Set to True for the Terra only counts before AQUA_START (this
+# changes the flood maps of pre-Aqua events).
+TERRA_ONLY_COMPOSITES = False
+
+
+# Minimal stand-in for the ee.Image returned by modis.dfo(). Bands are kept as
+# 2-D (y, x) arrays in an ordered dictionary and properties in a plain dict.
+class LocalImage(object):
+
+    def __init__(self, bands, props=None):
+        self.bands = OrderedDict(bands)
+        self.props = dict(props or {})
+
+    def band_names(self):
+        return list(self.bands.keys())
+
+    def select(self, name):
+        return self.bands[name]
+
+    def get(self, prop):
+        return self.props.get(prop)
+
+    def set(self, props):
+        self.props.update(props)
+        return self
+
+    def add_bands(self, bands):
+        self.bands.update(bands)
+        return self
+
+    # Stack all bands into one (band, y, x) array
+    def to_array(self, dtype=np.float32):
+        return np.stack([b.astype(dtype) for b in self.bands.values()])
+
+
+# Split a (time, band, y, x) stack into an ordered dictionary of (time, y, x)
+# band arrays. These are views, no data is copied.
+def from_stack(stack, band_names):
+    stack = np.asarray(stack)
+    if stack.ndim != 4 or stack.shape[1] != len(band_names):
+        raise ValueError("stack must have shape (time, {0}, y, x)"
+                         .format(len(band_names)))
+    return OrderedDict((name, stack[:, i]) for i, name in enumerate(band_names))
+
+
+# Combine an ordered dictionary of band arrays back to a (time, band, y, x) stack
+def to_stack(bands, band_names=None, dtype=np.float32):
+    band_names = band_names or list(bands.keys())
+    return np.stack([np.asarray(bands[b], dtype=dtype) for b in band_names],
+                    axis=1)
+
+
+def as_days(dates):
+    return np.asarray(dates, dtype="datetime64[D]")
+
+
+# The pan_sharpen function pan-sharpens the 500-m bands using the ratio of the
+# 500-m and 250-m red bands, same as modis_toolbox.pan_sharpen(). Division by
+# zero is masked in EE, here it becomes NaN.
+def sharpen_ratio(red_500m, red_250m):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.asarray(red_500m, np.float32) / \
+                np.asarray(red_250m, np.float32)
+    ratio[~np.isfinite(ratio) | (ratio == 0)] = np.nan
+    return ratio
+
+
+def pan_sharpen(img):
+    ratio = sharpen_ratio(img["red_500m"], img["red_250m"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharp = OrderedDict()
+        sharp["red_250m"] = np.asarray(img["red_250m"], np.float32)
+        sharp["nir_250m"] = np.asarray(img["nir_250m"], np.float32)
+        sharp["state_1km"] = np.asarray(img["state_1km"], np.float32)
+        for band in ["blue", "green", "swir"]:
+            sharp[band] = np.asarray(img[band], np.float32) / ratio
+    return sharp
+
+
+# Ratio between b1 and b2, same expression as modis_toolbox.b1b2_ratio()
+def b1b2_ratio(img):
+    img["b1b2_ratio"] = (img["nir_250m"] + np.float32(13.5)) / \
+                        (img["red_250m"] + np.float32(1081.1))
+    return img
+
+
+# add_qa_bands adds the cloud_state, cloud_shadow, ice_flag and snow_flag
+# bands decoded from state_1km, see modis_toolbox.add_qa_bands(). The bits
+# are decoded with a single lookup in qa.QA_LUT per pixel.
+def add_qa_bands(img):
+    packed = qa.decode(img["state_1km"])
+    for name, start, end in qa.QA_BITS:
+        img[name] = qa.unpack(packed, name)
+    return img
+
+
+# Mask out cloudy areas, shadow, and ice/snow (set to NaN), see
+# modis_toolbox.qa_mask()
+def qa_mask(img):
+    mask = ~qa.clear(qa.decode(img["state_1km"]))
+    return OrderedDict((name, np.where(mask, np.nan, band))
+                       for name, band in img.items())
+
+
+# Run pan_sharpen, b1b2_ratio and add_qa_bands over a raw band dictionary
+def preprocess(img):
+    return add_qa_bands(b1b2_ratio(pan_sharpen(img)))
+
+
+# Apply the DFO thresholds to each image. A pixel is flagged as water where
+# it passes all three thresholds (b1b2 ratio, band 1 and band 7).
+def water_flag(img, thresh_b1b2, thresh_b7):
+    with np.errstate(invalid="ignore"):
+        b1b2_sliced = img["b1b2_ratio"] < thresh_b1b2
+        b1_sliced = img["red_250m"] < B1_THRESHOLD
+        b7_sliced = img["swir"] < thresh_b7
+    return (b1b2_sliced & b1_sliced & b7_sliced).astype(np.uint8)
+
+
+# Local equivalent of the ee.Join.saveAll join in modis.dfo(): every image is
+# matched with all images from the same day and the 'lag_days' days before,
+# and the water flags of the matches are summed.
+def join_previous_days(flags, days, lag_days):
+    days = as_days(days).astype(np.int64)
+    delta = days[:, None] - days[None, :]
+    matches = ((delta >= 0) & (delta <= lag_days)).astype(np.uint8)
+    flat = flags.reshape(flags.shape[0], -1)
+    return matches.dot(flat).astype(np.uint8).reshape(flags.shape)
+
+
+# Rolling window version of join_previous_days(). The water flags are summed
+# per day, then a running window sum steps through the days adding the
+# entering day and subtracting the day that falls out of the window. Each
+# image gets the window of its own day, same as the join.
+def rolling_previous_days(flags, days, lag_days):
+    day_num = as_days(days).astype(np.int64)
+    day_idx = day_num - day_num.min()
+    n_days = int(day_idx.max()) + 1
+
+    daily = np.zeros((n_days,) + flags.shape[1:], np.uint8)
+    for t in range(flags.shape[0]):
+        daily[day_idx[t]] += flags[t]
+
+    composite = np.empty(flags.shape, np.uint8)
+    window = np.zeros(flags.shape[1:], np.uint8)
+    for d in range(n_days):
+        window += daily[d]
+        if d > lag_days:
+            window -= daily[d - lag_days - 1]
+        composite[day_idx == d] = window
+    return composite
+
+
+# Collapse the composites into the flood extent and duration (the number of
+# composites flagged as flood water divided by 2 for Terra and Aqua)
+def flood_extent_freq(flood_water):
+    freq = (flood_water.sum(axis=0, dtype=np.uint16) // 2).astype(np.uint16)
+    flooded = (freq >= 1).astype(np.uint8)
+    return flooded, freq
+
+
+# Number of clear views and percent clear views, see get_clear_views() in
+# modis.dfo(). Images where a pixel is masked are not counted as observations.
+def get_clear_views(img):
+    with np.errstate(invalid="ignore"):
+        clear = (img["cloud_state"] == 0) | (img["cloud_shadow"] == 0)
+        observed = img["cloud_state"] >= 0
+    clear_views = clear.sum(axis=0, dtype=np.uint16)
+    total_obs = observed.sum(axis=0, dtype=np.uint16)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        clear_perc = clear_views / total_obs.astype(np.float32)
+    return clear_views, clear_perc
+
+
+# Image with the maximum flood extent and its date, see get_max_img() in
+# modis.dfo()
+def get_max_img(flood_water, days, roi_mask=None):
+    if roi_mask is not None:
+        extent = (flood_water * roi_mask).reshape(len(days), -1).sum(axis=1)
+    else:
+        extent = flood_water.reshape(len(days), -1).sum(axis=1)
+    i = int(np.argmax(extent))
+    return flood_water[i], str(as_days(days)[i])
+
+
+# Median of the QA masked images, the frame the Otsu sample is drawn from
+def otsu_sample_frame(modis):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        masked = qa_mask(modis)
+        return OrderedDict((name, np.nanmedian(masked[name], axis=0))
+                           for name in ["b1b2_ratio", "swir", "red_250m"])
+
+
+# Otsu thresholds for the event, same steps as the "otsu" option in
+# modis.dfo(): a median of the QA masked images is sampled over the permanent
+# water strata, the swir band constrained to a reasonable range, and each
+# band's histogram split with Otsu's method.
+def otsu_thresholds(modis, strata, roi_mask=None, num_points=2500, seed=0,
+                    frame=None):
+    if frame is None:
+        frame = otsu_sample_frame(modis)
+    sample_mask = otsu_sample_mask(frame, strata, roi_mask)
+    return otsu_from_samples(frame["b1b2_ratio"][sample_mask],
+                             frame["swir"][sample_mask], num_points, seed)
+
+
+# Pixels of the sample frame that can be sampled. Points with any band masked
+# are dropped, like dropNulls=True
+def otsu_sample_mask(frame, strata, roi_mask=None):
+    b1b2, swir, red = frame["b1b2_ratio"], frame["swir"], frame["red_250m"]
+    with np.errstate(invalid="ignore"):
+        sample_mask = np.asarray(strata, bool) & np.isfinite(red) & \
+                      np.isfinite(b1b2) & (swir > -500) & (swir < 3000)
+    if roi_mask is not None:
+        sample_mask &= np.asarray(roi_mask, bool)
+    return sample_mask
+
+
+# Otsu thresholds from the b1b2 and swir values of every candidate pixel, in
+# row-major order of the full image so the seeded sample does not depend on
+# how the image was split up
+def otsu_from_samples(b1b2, swir, num_points=2500, seed=0):
+    if len(b1b2) == 0:
+        raise ValueError("No clear permanent water pixels to sample for Otsu")
+    candidates = np.arange(len(b1b2))
+    rng = np.random.RandomState(seed)
+    if candidates.size > num_points:
+        candidates = rng.choice(candidates, num_points, replace=False)
+
+    b1b2_hist = otsu_local.histogram(np.asarray(b1b2)[candidates])
+    swir_hist = otsu_local.histogram(np.asarray(swir)[candidates])
+    b1b2_thresh, swir_thresh = otsu_local.get_threshold([b1b2_hist, swir_hist])
+    return {"b1b2": float(b1b2_thresh), "b7": float(swir_thresh),
+            "base_res": None}
+
+
+COMPOSITES = {"join": join_previous_days, "rolling": rolling_previous_days}
+
+
+def select_dates(dates, began, ended):
+    days = as_days(dates)
+    start = np.datetime64(began, "D") - 2
+    end = np.datetime64(ended, "D") + 3
+    keep = np.where((days >= start) & (days < end))[0]
+    return keep[np.argsort(days[keep], kind="mergesort")]
+
+
+# Images of the event in time order. Takes a view of the stack when the
+# dates are already in order, so memory-mapped stacks are read without copying
+def select_stack(stack, dates, began, ended):
+    keep = select_dates(dates, began, ended)
+    if len(keep) == 0:
+        raise ValueError("No MODIS images between {0} and {1}".format(began, ended))
+    days = as_days(dates)[keep]
+    stack = np.asarray(stack)
+    if np.array_equal(keep, np.arange(keep[0], keep[-1] + 1)):
+        stack = stack[keep[0]:keep[-1] + 1]
+    else:
+        stack = stack[keep]
+    return stack, days
+
+
+def check_options(threshold, my_comp, get_max, strata, thresholds=None):
+    if threshold not in ["standard", "otsu"]:
+        raise ValueError("'threshold' options are 'standard' or 'otsu'")
+    if threshold == "otsu" and strata is None and thresholds is None:
+        raise ValueError("'otsu' thresholds need the permanent water 'strata'")
+    if my_comp not in LAG_DAYS:
+        raise ValueError("'my_comp' options are '2Day' or '3Day'")
+    if get_max not in [True, False]:
+        raise ValueError("'max_img' options are 'True' or 'False'")
+
+
+# Before Aqua started there are half the images, so the composite should need
+# half the water flags. Only applied with TERRA_ONLY_COMPOSITES, to match
+# modis.dfo() by default.
+def composite_days(began, my_comp):
+    if not TERRA_ONLY_COMPOSITES or np.datetime64(began, "D") >= AQUA_START:
+        return DFO_COMP[my_comp]
+    return DFO_COMP_TERRA[my_comp]
+
+
+# STEP 3.5: Put the final bands and properties together and clip to the roi
+def final_image(flooded, duration, clear_views, clear_perc, thresh_dict,
+                began, ended, threshold, comp_days, roi_mask=None,
+                max_img=None, max_img_date=None):
+    bands = OrderedDict([("flooded", flooded), ("duration", duration),
+                         ("clear_views", clear_views),
+                         ("clear_perc", clear_perc)])
+    props = {"began": str(np.datetime64(began, "D")),
+             "ended": str(np.datetime64(ended, "D")),
+             "threshold_type": threshold,
+             "threshold_b1b2": round(thresh_dict["b1b2"], 3),
+             "threshold_b7": round(thresh_dict["b7"], 2),
+             "composite_type": "{0}Day".format(comp_days)}
+    if max_img is not None:
+        bands["max_img"] = max_img
+        props["max_img_date"] = max_img_date
+
+    if roi_mask is not None:
+        roi_mask = np.asarray(roi_mask, bool)
+        for name in bands:
+            bands[name] = np.where(roi_mask, bands[name],
+                                   bands[name].dtype.type(0))
+    return LocalImage(bands, props)
+
+
+def dfo(stack, dates, began, ended, threshold="standard", my_comp="3Day",
+        roi_mask=None, get_max=False, composite="join", strata=None, seed=0,
+        preprocessed=False):
+
+    check_options(threshold, my_comp, get_max, strata)
+    if composite not in COMPOSITES:
+        raise ValueError("'composite' options are 'join' or 'rolling'")
+
+    # STEP 2 - SELECT MODIS IMAGES BASED ON DATES
+    # Same buffered date range as modis.dfo(), sorted by time
+    stack, days = select_stack(stack, dates, began, ended)
+    if preprocessed:
+        modis = from_stack(stack, PREPROCESSED_BANDS)
+    else:
+        modis = preprocess(from_stack(stack, RAW_BANDS))
+
+    # STEP 3.1 - SELECT thresholds
+    if threshold == "standard":
+        thresh_dict = STANDARD_THRESHOLDS
+    elif threshold == "otsu":
+        thresh_dict = otsu_thresholds(modis, strata, roi_mask, seed=seed)
+
+    # STEP 3.2 - APPLY THRESHOLDS TO MODIS IMAGES
+    flags = water_flag(modis, thresh_dict["b1b2"], thresh_dict["b7"])
+
+    # STEP 3.2 - DFO COMPOSITES
+    comp_days = composite_days(began, my_comp)
+    comp_counts = COMPOSITES[composite](flags, days, LAG_DAYS[my_comp])
+    flood_water = (comp_counts >= comp_days).astype(np.uint8)
+
+    # STEP 3.3 COLLAPSE COMPOSITES INTO A FINAL FLOOD MAP
+    flooded, duration = flood_extent_freq(flood_water)
+
+    # STEP 3.4 CALCULATE CLEAR DAYS
+    clear_views, clear_perc = get_clear_views(modis)
+
+    # STEP 3.4a ADD MAX IMG
+    max_img, max_img_date = None, None
+    if get_max == True:
+        max_img, max_img_date = get_max_img(flood_water, days, roi_mask)
+
+    return final_image(flooded, duration, clear_views, clear_perc, thresh_dict,
+                       began, ended, threshold, comp_days, roi_mask,
+                       max_img, max_img_date)
+
+
+# ------------------------------------------------------------------------------
+# Fused kernel
+#
+# dfo() keeps every stage as a full (time, y, x) array. dfo_fused() gives the
+# same result but walks the time axis once per block of rows: each image is
+# read, thresholded and QA decoded, and only small accumulators are kept, a
+# ring buffer with the water flag counts of the last 2-3 days, the running
+# composite window and uint16 counters for duration, clear views and
+# observations. Peak memory is O(window x pixels) instead of
+# O(days x pixels x bands), and the stack can be a memory-mapped array.
+
+# Water flag, clear view and observation of one (band, rows, x) image block
+def image_flags(img, band_names, thresh_b1b2, thresh_b7):
+    band = dict((name, i) for i, name in enumerate(band_names))
+    red = np.asarray(img[band["red_250m"]], np.float32)
+    if "b1b2_ratio" in band:
+        ratio = img[band["b1b2_ratio"]]
+        swir = img[band["swir"]]
+    else:
+        ratio = b1b2_ratio({"red_250m": red,
+                            "nir_250m": np.asarray(img[band["nir_250m"]],
+                                                   np.float32)})["b1b2_ratio"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            swir = np.asarray(img[band["swir"]], np.float32) / \
+                   sharpen_ratio(img[band["red_500m"]], red)
+    flag = water_flag({"b1b2_ratio": ratio, "red_250m": red, "swir": swir},
+                      thresh_b1b2, thresh_b7)
+
+    packed = qa.decode(img[band["state_1km"]])
+    observed = (packed & qa.NO_DATA) == 0
+    clear = observed & (((packed & 3) == 0) |
+                        ((packed & (1 << qa.PACKED_SHIFT["cloud_shadow"])) == 0))
+    return flag, clear, observed
+
+
+# Empty accumulators of fused_block() for a block of 'shape' pixels
+def fused_accumulators(shape, lag_days):
+    return {"ring": np.zeros((lag_days + 1,) + tuple(shape), np.uint8),
+            "window": np.zeros(shape, np.uint8),
+            "flood_count": np.zeros(shape, np.uint16),
+            "clear_views": np.zeros(shape, np.uint16),
+            "total_obs": np.zeros(shape, np.uint16)}
+
+
+# Stream the images of days first_day..last_day (indices from the first day
+# of the event) for one block of rows. 'acc' are the accumulators at the end
+# of first_day - 1 to carry on from (updated in place), new ones if None.
+def fused_block(stack, day_idx, rows, band_names, thresh_b1b2, thresh_b7,
+                lag_days, comp_days, first_day, last_day, roi_block=None,
+                acc=None):
+    if acc is None:
+        acc = fused_accumulators((rows.stop - rows.start, stack.shape[-1]),
+                                 lag_days)
+    ring, window = acc["ring"], acc["window"]
+    flood_count = acc["flood_count"]
+    clear_views, total_obs = acc["clear_views"], acc["total_obs"]
+    extents = np.zeros(last_day + 1, np.int64)
+
+    t = int(np.searchsorted(day_idx, first_day))
+    for d in range(first_day, last_day + 1):
+        # The ring slot for today still holds the day leaving the window
+        today = ring[d % (lag_days + 1)]
+        window -= today
+        today[:] = 0
+        n_images = 0
+        while t < len(day_idx) and day_idx[t] == d:
+            flag, clear, observed = image_flags(stack[t, :, rows], band_names,
+                                                thresh_b1b2, thresh_b7)
+            today += flag
+            clear_views += clear
+            total_obs += observed
+            n_images += 1
+            t += 1
+        window += today
+
+        # Every image of the day gets the same composite
+        if n_images:
+            flood = window >= comp_days
+            flood_count += flood.astype(np.uint16) * n_images
+            if roi_block is not None:
+                flood = flood & roi_block
+            extents[d] = flood.sum()
+    acc["extents"] = extents
+    return acc
+
+
+def row_blocks(n_rows, block_rows):
+    return [slice(r, min(r + block_rows, n_rows))
+            for r in range(0, n_rows, block_rows)]
+
+
+# The Otsu sample frame needs the median over time, it is built block by
+# block from a stack returned by select_stack()
+def blocked_sample_frame(stack, preprocessed=False, block_rows=256):
+    band_names = PREPROCESSED_BANDS if preprocessed else RAW_BANDS
+    n_rows, n_cols = stack.shape[-2:]
+    frame = OrderedDict((name, np.empty((n_rows, n_cols), np.float32))
+                        for name in ["b1b2_ratio", "swir", "red_250m"])
+    for rows in row_blocks(n_rows, block_rows):
+        block = from_stack(stack[:, :, rows], band_names)
+        if not preprocessed:
+            block = preprocess(block)
+        for name, band in otsu_sample_frame(block).items():
+            frame[name][rows] = band
+    return frame
+
+
+def dfo_fused(stack, dates, began, ended, threshold="standard", my_comp="3Day",
+              roi_mask=None, get_max=False, strata=None, seed=0,
+              preprocessed=False, block_rows=256, thresholds=None):
+
+    check_options(threshold, my_comp, get_max, strata, thresholds)
+    stack, days = select_stack(stack, dates, began, ended)
+    band_names = PREPROCESSED_BANDS if preprocessed else RAW_BANDS
+    day_num = days.astype(np.int64)
+    day_idx = day_num - day_num[0]
+    n_days = int(day_idx[-1]) + 1
+    n_rows, n_cols = stack.shape[-2:]
+    blocks = row_blocks(n_rows, block_rows)
+    if roi_mask is not None:
+        roi_mask = np.asarray(roi_mask, bool)
+
+    # STEP 3.1 - SELECT thresholds. 'thresholds' are already computed for
+    # the event, e.g. over all tiles by tiling.TiledDFO
+    if thresholds is not None:
+        thresh_dict = thresholds
+    elif threshold == "standard":
+        thresh_dict = STANDARD_THRESHOLDS
+    else:
+        frame = blocked_sample_frame(stack, preprocessed, block_rows)
+        thresh_dict = otsu_thresholds(None, strata, roi_mask, seed=seed,
+                                      frame=frame)
+
+    # STEPS 3.2 - 3.4 in one pass over the time axis per block
+    comp_days = composite_days(began, my_comp)
+    lag_days = LAG_DAYS[my_comp]
+    duration = np.zeros((n_rows, n_cols), np.uint16)
+    clear_views = np.zeros((n_rows, n_cols), np.uint16)
+    total_obs = np.zeros((n_rows, n_cols), np.uint16)
+    extents = np.zeros(n_days, np.int64)
+    for rows in blocks:
+        roi_block = roi_mask[rows] if roi_mask is not None else None
+        acc = fused_block(stack, day_idx, rows, band_names,
+                          thresh_dict["b1b2"], thresh_dict["b7"], lag_days,
+                          comp_days, 0, n_days - 1, roi_block)
+        duration[rows] = acc["flood_count"] // 2
+        clear_views[rows] = acc["clear_views"]
+        total_obs[rows] = acc["total_obs"]
+        extents += acc["extents"]
+
+    flooded = (duration >= 1).astype(np.uint8)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        clear_perc = clear_views / total_obs.astype(np.float32)
+
+    # STEP 3.4a ADD MAX IMG. Only the composite window of the max day is
+    # streamed again.
+    max_img, max_img_date = None, None
+    if get_max == True:
+        max_day = int(np.argmax(extents))
+        max_img = np.zeros((n_rows, n_cols), np.uint8)
+        for rows in blocks:
+            acc = fused_block(stack, day_idx, rows, band_names,
+                              thresh_dict["b1b2"], thresh_dict["b7"], lag_days,
+                              comp_days, max(max_day - lag_days, 0), max_day)
+            max_img[rows] = acc["window"] >= comp_days
+        max_img_date = str(days[0] + max_day)
+
+    return final_image(flooded, duration, clear_views, clear_perc, thresh_dict,
+                       began, ended, threshold, comp_days, roi_mask,
+                       max_img, max_img_date)
@@ -12,6 +12,7 @@
 import ee
 ee.Initialize()
 import math
+from utils import qa
 
 # Function that renames the bands in MODIS GQ (250-m) collections to
 # readable band names
@@ -88,9 +89,7 @@ def b1b2_ratio (img):
 #     name  - A name for the output image.u
 def get_qa_bits (image, start, end, new_name):
     # Compute the bits we need to extract.
-    pattern = 0
-    for i in range(start, end+1):
-        pattern += pow(2, i)
+    pattern = qa.bit_pattern(start, end)
     return image.select([0], [new_name]).bitwiseAnd(pattern).rightShift(start)
 
 # add_qa_bands creates an image based on MODIS QA information
@@ -100,28 +99,26 @@ def get_qa_bits (image, start, end, new_name):
 # QA Band information is available at:
 # http://modis-sr.ltdri.org/guide/MOD09_UserGuide_v1_3.pdf
 # Table 16: 1-kilometer State QA Descriptions (16-bit)
+# The bit positions are defined once in utils/qa.py (QA_BITS), which the local
+# engine uses as well.
 
 # cloud_state ==> 0: "clear", 1: "cloudy", 2: "mixed", 3: "not set"
 # cloud_shadow ==> 0: "no", 1: "yes"
 # ice_flag ==> 0: "no", 1: "yes"
 # snow_flag ==> 0: "no snow", 1: "snow"
 def add_qa_bands(img):
-    cloud_state = get_qa_bits(img.select("state_1km"), 0, 1, "cloud_state")
-    cloud_shadow = get_qa_bits(img.select("state_1km"), 2, 2, "cloud_shadow")
-    ice_flag = get_qa_bits(img.select("state_1km"), 12, 12, "ice_flag")
-    snow_flag = get_qa_bits(img.select("state_1km"), 15, 15, "snow_flag")
-    return img.addBands([cloud_state, cloud_shadow, ice_flag, snow_flag])
+    return img.addBands([get_qa_bits(img.select("state_1km"), start, end, name)
+                         for name, start, end in qa.QA_BITS])
 
 # The qaMask function takes an image as an input with bands defined from the
 # add_qa_bands function.  This then creates a mask from these bands to mask out
-# cloudy areas, shadow, and ice/snow.  This mask is then applied to an image which
-# is returned.
+# cloudy areas, shadow, and ice/snow (qa.MASK_VALUES).  This mask is then
+# applied to an image which is returned.
 def qa_mask(image):
-    cloud_mask = image.expression("b('cloud_state') == 1 || b('cloud_state') == 2")
-    shadow_mask = image.expression("b('cloud_shadow') == 1")
-    ice_mask = image.expression("b('ice_flag') == 1")
-    snow_mask = image.expression("b('snow_flag') == 1")
-    mask = cloud_mask.add(shadow_mask).add(ice_mask).add(snow_mask)
+    mask = ee.Image.constant(0)
+    for name, values in qa.MASK_VALUES.items():
+        for value in values:
+            mask = mask.add(image.select(name).eq(value))
     return image.updateMask(mask.eq(0))
 
 # cloud_calc calculates the cloud cover over the ROI in each image
@@ -0,0 +1,330 @@
+# Tiled, out-of-core DFO algorithm for very large events
+#
+# modis.dfo() clips to roi.bounds() and the whole event is exported at once,
+# which runs into Earth Engine memory and time limits for continental events
+# (e.g. level 4 HydroSHEDS unions over the Amazon or the Ganges) and would not
+# fit in memory locally either. TiledDFO splits the event grid into fixed size
+# tiles of 250-m pixels, maps every tile on its own with the local engine
+# (modis_local.dfo_fused) in a pool of processes, writes each tile to disk as
+# soon as it is done and mosaics the 4 output bands into memory-mapped .npy
+# files. Peak memory depends on the tile size, not on the size of the event.
+#
+# Each tile is read with a halo of extra pixels around it. The DFO steps are
+# per pixel, but the slope mask (see misc.apply_slope_mask) needs the
+# neighbours of the DEM pixels on the tile edges. The halo is cropped off
+# before the tile is written.
+#
+# Tiles are read with a 'loader', a function (or picklable object) taking the
+# (row slice, col slice) window of a tile on the event grid and returning a
+# dict with:
+#  - 'stack', 'dates' - MODIS stack of the window and image dates, as for
+#                       modis_local.dfo()
+#  - 'roi_mask' - optional boolean roi mask of the window
+#  - 'strata' - JRC yearly permanent water of the window, for 'otsu'
+#  - 'dem' - elevation of the window in meters, for the slope mask when no
+#            precomputed slope classes are given (see utils.slope). The
+#            slope is computed on the GFD grid rows of the window, with the
+#            pixel widths of their latitude like the slope classes.
+#
+# Otsu thresholds are computed for the whole event, same as the untiled
+# version: the candidate pixels of every tile are gathered in a first pass and
+# sampled in the row-major order of the full grid.
+#
+# A resumed run only reuses the tiles and thresholds on disk when they were
+# made with the same options. The options are written to options.json next to
+# the tiles (and stored with the thresholds), when they differ the old tiles
+# and thresholds are deleted and mapped again. The loader's data can't be
+# checked this way, so pass a 'source' naming the stack, roi and strata it
+# reads (e.g. a file name with a version) to have a new roi or new strata
+# invalidate the tiles too.
+
+import glob
+import json
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from flood_detection import modis_local
+from flood_detection.utils import slope
+
+# Tile size in 250-m pixels (256 km a side)
+TILE_SIZE = 1024
+
+# ee.Terrain.slope uses the 4 neighbours of each pixel
+HALO = 1
+
+OUTPUT_DTYPES = OrderedDict([("flooded", np.uint8),
+                             ("duration", np.uint16),
+                             ("clear_views", np.uint16),
+                             ("clear_perc", np.float32)])
+
+
+class Tile(object):
+
+    def __init__(self, row, col, core, window):
+        self.row = row
+        self.col = col
+        self.core = core
+        self.window = window
+
+    @property
+    def key(self):
+        return "tile_{0:04d}_{1:04d}".format(self.row, self.col)
+
+    # Part of a window array that is in the core of the tile
+    def crop(self, array):
+        rows = slice(self.core[0].start - self.window[0].start,
+                     self.core[0].stop - self.window[0].start)
+        cols = slice(self.core[1].start - self.window[1].start,
+                     self.core[1].stop - self.window[1].start)
+        return array[..., rows, cols]
+
+
+# Split a (rows, cols) grid into tiles with a halo, clipped to the grid
+def tile_grid(shape, tile_size=TILE_SIZE, halo=HALO):
+    n_rows, n_cols = shape
+    tiles = []
+    for i, r in enumerate(range(0, n_rows, tile_size)):
+        for j, c in enumerate(range(0, n_cols, tile_size)):
+            core = (slice(r, min(r + tile_size, n_rows)),
+                    slice(c, min(c + tile_size, n_cols)))
+            window = (slice(max(r - halo, 0), min(r + tile_size + halo, n_rows)),
+                      slice(max(c - halo, 0), min(c + tile_size + halo, n_cols)))
+            tiles.append(Tile(i, j, core, window))
+    return tiles
+
+
+# Local version of misc.apply_slope_mask(), True where the slope is below the
+# threshold. 'rows' is the row slice of the DEM on the GFD grid.
+def slope_mask(dem, rows, thresh=5):
+    return slope.grid_slope_degrees(dem, rows) <= thresh
+
+
+def _optional(data, name, tile):
+    if data.get(name) is None:
+        return None
+    return tile.crop(np.asarray(data[name]))
+
+
+# Otsu candidates of one tile: flat indices on the full grid and their b1b2
+# and swir values
+def tile_otsu_samples(job):
+    loader, tile, shape, began, ended, preprocessed, block_rows = job
+    data = loader(tile.window)
+    stack, _ = modis_local.select_stack(tile.crop(np.asarray(data["stack"])),
+                                        data["dates"], began, ended)
+    frame = modis_local.blocked_sample_frame(stack, preprocessed, block_rows)
+    sample_mask = modis_local.otsu_sample_mask(
+        frame, _optional(data, "strata", tile), _optional(data, "roi_mask", tile))
+    rows, cols = np.nonzero(sample_mask)
+    index = np.ravel_multi_index((rows + tile.core[0].start,
+                                  cols + tile.core[1].start), shape)
+    return (index, frame["b1b2_ratio"][sample_mask],
+            frame["swir"][sample_mask])
+
+
+# Map one tile and write its bands to 'path'
+def run_tile(job):
+    loader, tile, path, began, ended, options = job
+    data = loader(tile.window)
+    img = modis_local.dfo_fused(tile.crop(np.asarray(data["stack"])),
+                                data["dates"], began, ended,
+                                threshold=options["threshold"],
+                                my_comp=options["my_comp"],
+                                roi_mask=_optional(data, "roi_mask", tile),
+                                preprocessed=options["preprocessed"],
+                                block_rows=options["block_rows"],
+                                thresholds=options["thresholds"])
+
+    # Masked out by the slope mask, set to 0 like pixels outside the roi
+    keep = None
+    row0, col0 = options["grid_offset"]
+    if options["slope_thresh"] is not None and options["slope_store"]:
+        window = (slice(tile.core[0].start + row0, tile.core[0].stop + row0),
+                  slice(tile.core[1].start + col0, tile.core[1].stop + col0))
+        keep = slope.slope_mask(slope.open_store(options["slope_store"]),
+                                window, options["slope_thresh"])
+    elif options["slope_thresh"] is not None and data.get("dem") is not None:
+        rows = slice(tile.window[0].start + row0, tile.window[0].stop + row0)
+        keep = tile.crop(slope_mask(data["dem"], rows,
+                                    options["slope_thresh"]))
+    if keep is not None:
+        img.add_bands(OrderedDict(
+            (name, np.where(keep, img.select(name),
+                            img.select(name).dtype.type(0)))
+            for name in img.band_names()))
+
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **dict((name, img.select(name)) for name in OUTPUT_DTYPES))
+    os.rename(tmp, path)
+    return tile.key
+
+
+# Options as they read back from json, so they compare equal to a manifest
+def _json_options(options):
+    return json.loads(json.dumps(options, sort_keys=True))
+
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(tmp, path)
+
+
+class TiledDFO(object):
+    # Args:
+    #    loader: returns the inputs of a tile window, see above
+    #    shape: (rows, cols) of the event grid in 250-m pixels
+    #    out_dir: directory for the tiles and the mosaic
+    #    tile_size: tile size in pixels
+    #    halo: extra pixels read around each tile
+    #    processes: number of tiles mapped at the same time, 1 maps them in
+    #               this process
+    #    slope_thresh: slope mask threshold in degrees, None to skip it
+    #    slope_store: directory of precomputed slope classes (utils.slope),
+    #                 used instead of the loader's 'dem'
+    #    grid_offset: (row, col) of the event grid on the GFD grid, for the
+    #                 slope mask
+    #    source: name of the data the loader reads, tiles of another source
+    #            are not reused (see above)
+    def __init__(self, loader, shape, out_dir, tile_size=TILE_SIZE, halo=HALO,
+                 processes=4, slope_thresh=5, slope_store=None,
+                 grid_offset=(0, 0), source=None):
+        self.loader = loader
+        self.shape = tuple(shape)
+        self.out_dir = out_dir
+        self.tile_dir = os.path.join(out_dir, "tiles")
+        self.tile_size = tile_size
+        self.halo = halo
+        self.tiles = tile_grid(self.shape, tile_size, halo)
+        self.processes = processes
+        self.slope_thresh = slope_thresh
+        self.slope_store = slope_store
+        self.grid_offset = tuple(grid_offset)
+        self.source = source
+        if not os.path.exists(self.tile_dir):
+            os.makedirs(self.tile_dir)
+
+    def _map(self, func, jobs):
+        if self.processes == 1:
+            for job in jobs:
+                yield func(job)
+            return
+        pool = Pool(self.processes)
+        try:
+            for result in pool.imap_unordered(func, jobs):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def tile_path(self, tile):
+        return os.path.join(self.tile_dir, tile.key + ".npz")
+
+    # Options of the event grid and the input data, shared by the thresholds
+    # and the tiles
+    def _grid_options(self, began, ended):
+        return {"shape": self.shape, "tile_size": self.tile_size,
+                "halo": self.halo, "source": self.source,
+                "began": str(np.datetime64(began, "D")),
+                "ended": str(np.datetime64(ended, "D"))}
+
+    # Delete the tiles on disk unless they were mapped with 'options', then
+    # record 'options' as the options of the tiles
+    def _check_tiles(self, options):
+        path = os.path.join(self.out_dir, "options.json")
+        options = _json_options(options)
+        if os.path.exists(path):
+            with open(path) as f:
+                if json.load(f) == options:
+                    return
+        stale = glob.glob(os.path.join(self.tile_dir, "*.npz"))
+        if stale:
+            print("Options changed, deleting {0} tiles".format(len(stale)))
+        for name in stale:
+            os.remove(name)
+        _write_json(path, options)
+
+    # Otsu thresholds over all tiles. Saved with the tiles so a resumed run
+    # maps the rest of the tiles with the same thresholds, as long as they
+    # were computed with the same options.
+    def otsu_thresholds(self, began, ended, preprocessed=False, block_rows=256,
+                        seed=0):
+        path = os.path.join(self.out_dir, "thresholds.json")
+        options = self._grid_options(began, ended)
+        options.update({"preprocessed": preprocessed,
+                        "block_rows": block_rows, "seed": seed})
+        options = _json_options(options)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get("options") == options:
+                return saved["thresholds"]
+        jobs = [(self.loader, tile, self.shape, began, ended, preprocessed,
+                 block_rows) for tile in self.tiles]
+        index, b1b2, swir = zip(*self._map(tile_otsu_samples, jobs))
+        index = np.concatenate(index)
+        order = np.argsort(index, kind="mergesort")
+        thresholds = modis_local.otsu_from_samples(
+                         np.concatenate(b1b2)[order],
+                         np.concatenate(swir)[order], seed=seed)
+        _write_json(path, {"options": options, "thresholds": thresholds})
+        return thresholds
+
+    # Map every tile that is not on disk yet and mosaic the output. Returns a
+    # LocalImage of read-only memory-mapped bands.
+    def run(self, began, ended, threshold="standard", my_comp="3Day",
+            preprocessed=False, block_rows=256, seed=0):
+        modis_local.check_options(threshold, my_comp, False, True)
+        if threshold == "otsu":
+            thresholds = self.otsu_thresholds(began, ended, preprocessed,
+                                              block_rows, seed)
+        else:
+            thresholds = modis_local.STANDARD_THRESHOLDS
+
+        options = {"threshold": threshold, "my_comp": my_comp,
+                   "preprocessed": preprocessed, "block_rows": block_rows,
+                   "thresholds": thresholds, "slope_thresh": self.slope_thresh,
+                   "slope_store": self.slope_store,
+                   "grid_offset": self.grid_offset}
+        manifest = self._grid_options(began, ended)
+        manifest.update(options)
+        self._check_tiles(manifest)
+        todo = [t for t in self.tiles if not os.path.exists(self.tile_path(t))]
+        print("{0} of {1} tiles to map".format(len(todo), len(self.tiles)))
+        jobs = [(self.loader, tile, self.tile_path(tile), began, ended, options)
+                for tile in todo]
+        for i, key in enumerate(self._map(run_tile, jobs)):
+            print("{0} done ({1}/{2})".format(key, i + 1, len(todo)))
+
+        bands = self.mosaic()
+        comp_days = modis_local.composite_days(began, my_comp)
+        props = {"began": str(np.datetime64(began, "D")),
+                 "ended": str(np.datetime64(ended, "D")),
+                 "threshold_type": threshold,
+                 "threshold_b1b2": round(thresholds["b1b2"], 3),
+                 "threshold_b7": round(thresholds["b7"], 2),
+                 "composite_type": "{0}Day".format(comp_days),
+                 "slope_threshold": self.slope_thresh}
+        return modis_local.LocalImage(bands, props)
+
+    # Copy the tiles into one memory-mapped .npy file per band, one tile in
+    # memory at a time
+    def mosaic(self):
+        bands = OrderedDict()
+        for name, dtype in OUTPUT_DTYPES.items():
+            bands[name] = np.lib.format.open_memmap(
+                os.path.join(self.out_dir, name + ".npy"), mode="w+",
+                dtype=dtype, shape=self.shape)
+        for tile in self.tiles:
+            with np.load(self.tile_path(tile)) as data:
+                for name in OUTPUT_DTYPES:
+                    bands[name][tile.core] = data[name]
+        for name in bands:
+            bands[name].flush()
+            bands[name] = np.load(os.path.join(self.out_dir, name + ".npy"),
+                                  mmap_mode="r")
+        return bands
@@ -0,0 +1,233 @@
+# Local spatial index of the watershed layers used to build the event roi
+#
+# misc.get_watersheds_level3/4/5, get_islands and get_american_somoa run a
+# filterBounds of a global basin table against the event polygon and
+# main_gfd.py dissolves the result with .union(), for every event. Here each
+# layer is read once from a local copy (a shapefile, e.g. the HydroSHEDS
+# basins of one level) and stored under 'root' as <layer>.npz: the basin IDs,
+# their bounds and their geometries as WKB. Loading a layer builds a shapely
+# STRtree over the geometries, and the basins of every event come out of a
+# tree query instead of a server round trip:
+#
+#     index = BasinIndex("data/basins")
+#     index.build("level4", "hybas_lev04.shp", id_field="HYBAS_ID")
+#     events = catalog.EventCatalog.from_shapefile()
+#     watersheds = index.bulk_union("level4", events.geometries)
+#
+# Events that touch the same set of basins share one dissolved geometry,
+# unions are computed once per set of basin IDs.
+#
+# main_gfd.py runs under Python 2.7, where the latest shapely is 1.7, so the
+# index only uses the shapely API that 1.7 and 2.x share (STRtree(geoms),
+# unary_union, shapely.wkb). Needs pyshp to build a layer from a shapefile.
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# The layers of misc.py
+LAYERS = ["level3", "level4", "level5", "islands", "american_samoa"]
+
+
+def to_shape(geometry):
+    """Shapely geometry of a GeoJSON dict (or a shapely geometry), made valid"""
+    from shapely.geometry import shape
+
+    if not hasattr(geometry, "geom_type"):
+        geometry = shape(geometry)
+    if not geometry.is_valid:
+        try:
+            from shapely.validation import make_valid
+        except ImportError:
+            # shapely < 1.8
+            return geometry.buffer(0)
+        geometry = make_valid(geometry)
+    return geometry
+
+
+def object_array(items):
+    """1-d object array of geometries (numpy unpacks multi-part geometries
+    of shapely 1.x when given a list)"""
+    array = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        array[i] = item
+    return array
+
+
+def read_shapefile(path, id_field):
+    """IDs and shapely geometries of the features of a shapefile"""
+    import shapefile
+
+    reader = shapefile.Reader(path, encoding="latin-1")
+    names = [f[0] for f in reader.fields[1:]]
+    if id_field not in names:
+        raise KeyError("No field {0} in {1}".format(id_field, path))
+    column = names.index(id_field)
+    ids = []
+    geometries = []
+    for rec in reader.iterShapeRecords():
+        if rec.shape.shapeType == shapefile.NULL:
+            continue
+        ids.append(rec.record[column])
+        geometries.append(to_shape(rec.shape.__geo_interface__))
+    return ids, geometries
+
+
+def ee_geometry(geometry):
+    """ee.Geometry of a shapely geometry"""
+    import ee
+    from shapely.geometry import mapping
+
+    return ee.Geometry(mapping(geometry))
+
+
+class BasinLayer(object):
+    """
+    The basins of one layer and their STRtree.
+
+    Args:
+        ids: basin IDs
+        geometries: shapely geometries of the basins
+    """
+
+    def __init__(self, ids, geometries):
+        from shapely.strtree import STRtree
+
+        self.ids = np.asarray(ids)
+        self.geometries = object_array(list(geometries))
+        self.tree = STRtree(list(self.geometries))
+        # shapely 1.x queries return the geometries, not their positions
+        self._positions = dict((id(g), i)
+                               for i, g in enumerate(self.geometries))
+
+    def save(self, path):
+        from shapely import wkb
+
+        blobs = [wkb.dumps(g) for g in self.geometries]
+        offsets = np.cumsum([0] + [len(b) for b in blobs])
+        data = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, ids=self.ids, wkb=data, offsets=offsets,
+                 bounds=np.array([g.bounds for g in self.geometries]))
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        from shapely import wkb
+
+        with np.load(path) as f:
+            data = f["wkb"].tobytes()
+            offsets = f["offsets"]
+            ids = f["ids"]
+        return cls(ids, [wkb.loads(data[offsets[i]:offsets[i + 1]])
+                         for i in range(len(ids))])
+
+    def _candidates(self, geometry):
+        """Positions of the basins whose bounds intersect a geometry"""
+        hits = self.tree.query(geometry)
+        if len(hits) and not hasattr(hits[0], "geom_type"):
+            return np.asarray(hits, dtype=np.int64)
+        return np.array([self._positions[id(g)] for g in hits],
+                        dtype=np.int64)
+
+    def query(self, geometries):
+        """
+        Basins that intersect each geometry (like filterBounds), as a list of
+        sorted arrays of positions in the layer
+        """
+        from shapely.prepared import prep
+
+        out = []
+        for geometry in geometries:
+            prepared = prep(geometry)
+            positions = np.sort(self._candidates(geometry))
+            out.append(np.array(
+                [p for p in positions
+                 if prepared.intersects(self.geometries[p])],
+                dtype=np.int64))
+        return out
+
+
+class BasinIndex(object):
+    """
+    Basin layers stored under 'root', loaded on first use.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.layers = {}
+        self._unions = {}
+
+    def _path(self, layer):
+        return os.path.join(self.root, "{0}.npz".format(layer))
+
+    def build(self, layer, path, id_field):
+        """Store a layer from a shapefile of basins"""
+        ids, geometries = read_shapefile(path, id_field)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        basins = BasinLayer(ids, geometries)
+        basins.save(self._path(layer))
+        self.layers[layer] = basins
+        self._unions = dict((k, v) for k, v in self._unions.items()
+                            if k[0] != layer)
+        print("{0}: {1} basins stored".format(layer, len(ids)))
+        return basins
+
+    def layer(self, layer):
+        if layer not in self.layers:
+            if not os.path.exists(self._path(layer)):
+                raise IOError("Basin layer {0} is not built, see "
+                              "BasinIndex.build()".format(layer))
+            self.layers[layer] = BasinLayer.load(self._path(layer))
+        return self.layers[layer]
+
+    def basin_ids(self, layer, geometry):
+        """IDs of the basins that intersect a geometry"""
+        basins = self.layer(layer)
+        positions = basins.query([to_shape(geometry)])[0]
+        return tuple(basins.ids[positions].tolist())
+
+    def union(self, layer, positions):
+        """Dissolved geometry of basins (positions in the layer), memoized"""
+        from shapely.ops import unary_union
+
+        basins = self.layer(layer)
+        key = (layer, tuple(int(p) for p in positions))
+        if key not in self._unions:
+            self._unions[key] = unary_union(
+                list(basins.geometries[list(positions)]))
+        return self._unions[key]
+
+    def bulk_union(self, layer, geometries):
+        """
+        Basins and dissolved watershed of many events, from one loaded layer.
+
+        Args:
+            layer: name of the layer
+            geometries: dict of event ID to GeoJSON (or shapely) geometry,
+                        e.g. EventCatalog.geometries
+
+        Returns:
+            OrderedDict of event ID to (tuple of basin IDs, shapely
+            geometry), the geometry is None if no basin intersects the event
+        """
+        basins = self.layer(layer)
+        events = [e for e in sorted(geometries)
+                  if geometries[e] is not None]
+        matches = basins.query([to_shape(geometries[e]) for e in events])
+        out = OrderedDict()
+        for event, positions in zip(events, matches):
+            union = self.union(layer, positions) if len(positions) else None
+            out[event] = (tuple(basins.ids[positions].tolist()), union)
+        return out
+
+    def ee_watershed(self, layer, geometry):
+        """The dissolved watershed of one event as an ee.Geometry"""
+        basins = self.layer(layer)
+        positions = basins.query([to_shape(geometry)])[0]
+        if not len(positions):
+            raise ValueError("No {0} basin intersects the geometry"
+                             .format(layer))
+        return ee_geometry(self.union(layer, positions))
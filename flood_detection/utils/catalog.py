@@ -0,0 +1,202 @@
+# Event catalog: the properties and geometry of every DFO event in one
+# in-memory table keyed by event ID.
+#
+# main_gfd.py and the export functions used to look up each event with
+# filterMetadata('ID', 'equals', ...) and a getInfo() per property. The catalog
+# is loaded once, either with a single getInfo() on the whole event
+# FeatureCollection or from the local copies of the databases in data/, and
+# every lookup after that is a dictionary access.
+
+import csv
+import datetime
+import os
+import re
+from collections import OrderedDict
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "..", "data")
+QC_DATABASE = os.path.join(DATA_DIR, "gfd_qcdatabase_2019_08_01.csv")
+DFO_POLYGONS = os.path.join(DATA_DIR, "shp_files", "dfo_polys_20191203.shp")
+
+# Shapefile field names are cut to 10 characters
+SHP_FIELDS = {"GlideNumbe": "GlideNumber", "OtherCount": "OtherCountry"}
+
+# Properties of the exported flood maps and the DFO database fields they
+# come from, see EventCatalog.export_props()
+EXPORT_FIELDS = OrderedDict([('glide_index', 'GlideNumber'),
+                             ('dfo_country', 'Country'),
+                             ('dfo_other_country', 'OtherCountry'),
+                             ('dfo_centroid_x', 'long'),
+                             ('dfo_centroid_y', 'lat'),
+                             ('dfo_validation_type', 'Validation'),
+                             ('dfo_main_cause', 'MainCause'),
+                             ('dfo_severity', 'Severity'),
+                             ('dfo_dead', 'Dead'),
+                             ('dfo_displaced', 'Displaced')])
+
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%Y%m%d",
+                "%Y-%m-%dT%H:%M:%S"]
+
+
+# Dates come as strings in several formats, datetime.date objects from the
+# shapefile or milliseconds since epoch from Earth Engine
+def parse_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, (int, float)):
+        return (datetime.datetime(1970, 1, 1) +
+                datetime.timedelta(milliseconds=value)).date()
+    if isinstance(value, dict) and "value" in value:
+        return parse_date(value["value"])
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value), fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("Unknown date format: {0}".format(value))
+
+
+def to_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    return int(number) if number.is_integer() else number
+
+
+# Convert the KML geometry strings in the QC database CSV to GeoJSON
+def kml_to_geojson(kml):
+    def ring(coords):
+        return [[float(v) for v in pt.split(",")[:2]] for pt in coords.split()]
+
+    polygons = []
+    for poly in re.findall(r"<Polygon>(.*?)</Polygon>", kml, re.S):
+        outer = re.findall(r"<outerBoundaryIs>.*?<coordinates>(.*?)</coordinates>",
+                           poly, re.S)
+        inner = re.findall(r"<innerBoundaryIs>.*?<coordinates>(.*?)</coordinates>",
+                           poly, re.S)
+        polygons.append([ring(c) for c in outer + inner])
+    if len(polygons) == 1:
+        return {"type": "Polygon", "coordinates": polygons[0]}
+    return {"type": "MultiPolygon", "coordinates": polygons}
+
+
+class EventCatalog(object):
+
+    def __init__(self, properties, geometries=None):
+        self.properties = dict((int(k), v) for k, v in properties.items())
+        self.geometries = dict((int(k), v) for k, v in
+                               (geometries or {}).items())
+
+    # Load every event from an ee.FeatureCollection with one getInfo() call
+    @classmethod
+    def from_feature_collection(cls, event_db):
+        properties = {}
+        geometries = {}
+        for ft in event_db.getInfo()["features"]:
+            props = ft["properties"]
+            properties[int(props["ID"])] = props
+            geometries[int(props["ID"])] = ft.get("geometry")
+        return cls(properties, geometries)
+
+    # Load the QC database CSV (KML polygons in the 'geometry' column)
+    @classmethod
+    def from_csv(cls, path=QC_DATABASE):
+        properties = {}
+        geometries = {}
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                kml = row.pop("geometry", None)
+                props = dict((k, to_number(v)) for k, v in row.items())
+                properties[int(props["ID"])] = props
+                if kml:
+                    geometries[int(props["ID"])] = kml_to_geojson(kml)
+        return cls(properties, geometries)
+
+    # Load the DFO polygon shapefile, needs pyshp
+    @classmethod
+    def from_shapefile(cls, path=DFO_POLYGONS):
+        import shapefile
+
+        properties = {}
+        geometries = {}
+        reader = shapefile.Reader(path, encoding="latin-1")
+        names = [SHP_FIELDS.get(f[0], f[0]) for f in reader.fields[1:]]
+        for rec in reader.iterShapeRecords():
+            props = dict((k, v.strip() if hasattr(v, "strip") else v)
+                         for k, v in zip(names, list(rec.record)))
+            properties[int(props["ID"])] = props
+            geometries[int(props["ID"])] = rec.shape.__geo_interface__
+        return cls(properties, geometries)
+
+    # Add the events and geometries of another catalog. Properties already in
+    # this catalog are kept, missing geometries are filled in.
+    def update(self, other):
+        for i, props in other.properties.items():
+            merged = dict(props)
+            merged.update(self.properties.get(i, {}))
+            self.properties[i] = merged
+        for i, geom in other.geometries.items():
+            self.geometries.setdefault(i, geom)
+        return self
+
+    def __contains__(self, dfo_id):
+        return int(dfo_id) in self.properties
+
+    def __len__(self):
+        return len(self.properties)
+
+    def ids(self, min_id=None):
+        ids = sorted(self.properties)
+        if min_id is not None:
+            ids = [i for i in ids if i > min_id]
+        return ids
+
+    def get(self, dfo_id):
+        try:
+            return self.properties[int(dfo_id)]
+        except KeyError:
+            raise KeyError("DFO event {0} is not in the catalog".format(dfo_id))
+
+    def geometry(self, dfo_id):
+        return self.geometries[int(dfo_id)]
+
+    def ee_geometry(self, dfo_id):
+        import ee
+        return ee.Geometry(self.geometry(dfo_id))
+
+    def began(self, dfo_id, fmt="%Y-%m-%d"):
+        return parse_date(self.get(dfo_id)["Began"]).strftime(fmt)
+
+    def ended(self, dfo_id, fmt="%Y-%m-%d"):
+        return parse_date(self.get(dfo_id)["Ended"]).strftime(fmt)
+
+    # 'std' in the QC database means the 'standard' thresholds in modis.dfo()
+    def thresh_type(self, dfo_id):
+        thresh_type = str(self.get(dfo_id).get("ThreshType"))
+        if thresh_type == 'std':
+            thresh_type = 'standard'
+        return thresh_type
+
+    # DFO database properties that are added to the exported flood maps,
+    # see export.to_asset(). Only a catalog of export.DFO_TABLE gives the same
+    # values as an export without a catalog. The values are passed through
+    # as they are in the table, and a missing (or null) property raises a
+    # KeyError like ee.String(None)/ee.Number(None) failed in the export.
+    def export_props(self, dfo_id):
+        props = self.get(dfo_id)
+        missing = [k for k in EXPORT_FIELDS.values() if props.get(k) is None]
+        if missing:
+            raise KeyError("DFO event {0} has no {1}".format(
+                dfo_id, ", ".join(missing)))
+
+        # Clean up some of the DFO database
+        export_props = dict((name, props[k])
+                            for name, k in EXPORT_FIELDS.items())
+        if export_props['glide_index'] == '0':
+            export_props['glide_index'] = 'NA'
+        if export_props['dfo_other_country'] == '0':
+            export_props['dfo_other_country'] = 'NA'
+        return export_props
@@ -2,9 +2,27 @@
 # Export functions
 # These are different functions to export the maps to assets or cloud buckets
 
+import math
+
 import ee
 ee.Initialize()
 
+from flood_detection.utils import timing
+
+# This Fusion Table is the DFO Database from July 16th, 2019. The properties of
+# the exported assets come from this table, not from the QC database.
+DFO_TABLE = 'ft:1lxrZ7wqJZkxVgP3L_yQOFqY3rXHH_5oSscO3IPOZ'
+
+# Approximate number of 'res' meter pixels in the bounding box of an export
+# region (GeoJSON polygon coordinates), for the timing trace
+def region_pixels(coordinates, res):
+    lon = [p[0] for ring in coordinates for p in ring]
+    lat = [p[1] for ring in coordinates for p in ring]
+    mid_lat = math.radians((max(lat) + min(lat)) / 2.0)
+    width = (max(lon) - min(lon)) * 111320 * math.cos(mid_lat)
+    height = (max(lat) - min(lat)) * 110574
+    return int(round(width / res)) * int(round(height / res))
+
 # --------------------------------------------------------
 # This function is used to export maps that were created from DFO events with an
 # index number
@@ -13,55 +31,73 @@ ee.Initialize()
     #        bounds: the ROI
     #        save_path: the asset path into which you'd like to save the image
     #        res: the resolution (in meters) per pixel of the image
+    #        dfo_id: the DFO event ID, read from the image if not given
+    #        catalog: optional catalog.EventCatalog of the DFO table
+    #                 (DFO_TABLE), saves fetching the properties again
+    #                 from it. A catalog of another database (e.g. the QC
+    #                 database) changes the properties of the asset.
     #    Returns:
     #        - Saves the image into the GEE Code Editor Asset path
 # --------------------------------------------------------
-def to_asset(flood_img, bounds, save_path, res=250):
+@timing.traced
+def to_asset(flood_img, bounds, save_path, res=250, dfo_id=None, catalog=None):
 
-    # This Fusion Table is the QC database from 11/12/18
-    # dfo_props = ee.FeatureCollection('ft:1P_wUQQJqghdnN3UMAcXDlrbQFpJWN-md2eH1WprS')
+    if dfo_id is None:
+        dfo_id = flood_img.get('id').getInfo()
 
-    # This Fustino Table is the DFO Database from July 16th, 2019
-    dfo_props = ee.FeatureCollection('ft:1lxrZ7wqJZkxVgP3L_yQOFqY3rXHH_5oSscO3IPOZ')
-    dfo_id = flood_img.get('id').getInfo()
-    props = ee.Feature(dfo_props.filterMetadata('ID', 'equals', dfo_id).first())\
-                                .getInfo()['properties']
+    if catalog is None:
+        # This Fusion Table is the QC database from 11/12/18
+        # dfo_props = ee.FeatureCollection('ft:1P_wUQQJqghdnN3UMAcXDlrbQFpJWN-md2eH1WprS')
 
-    # Clean up some of the DFO database
-    if props.get('GlideNumber')=='0':
-        glide_number = 'NA'
-    else:
-        glide_number = props.get('GlideNumber')
+        # This Fustino Table is the DFO Database from July 16th, 2019
+        dfo_props = ee.FeatureCollection(DFO_TABLE)
+        props = ee.Feature(dfo_props.filterMetadata('ID', 'equals', dfo_id).first())\
+                                    .getInfo()['properties']
 
-    if props.get('OtherCountry')=='0':
-        dfo_other_country = 'NA'
+        # Clean up some of the DFO database
+        if props.get('GlideNumber')=='0':
+            glide_number = 'NA'
+        else:
+            glide_number = props.get('GlideNumber')
+
+        if props.get('OtherCountry')=='0':
+            dfo_other_country = 'NA'
+        else:
+            dfo_other_country = props.get('OtherCountry')
+
+        export_props = {'glide_index': ee.String(glide_number),
+                        'dfo_country': ee.String(props.get('Country')),
+                        'dfo_other_country': ee.String(dfo_other_country),
+                        'dfo_centroid_x': ee.Number(props.get('long')),
+                        'dfo_centroid_y': ee.Number(props.get('lat')),
+                        'dfo_validation_type': ee.String(props.get("Validation")),
+                        'dfo_main_cause': ee.String(props.get("MainCause")),
+                        'dfo_severity': ee.Number(props.get("Severity")),
+                        'dfo_dead': ee.Number(props.get("Dead")),
+                        'dfo_displaced': ee.Number(props.get("Displaced"))}
+        start_formatted = ee.Date(props.get('Began')).format('yyyyMMdd').getInfo()
+        end_formatted = ee.Date(props.get('Ended')).format('yyyyMMdd').getInfo()
     else:
-        dfo_other_country = props.get('OtherCountry')
+        export_props = catalog.export_props(dfo_id)
+        start_formatted = catalog.began(dfo_id, '%Y%m%d')
+        end_formatted = catalog.ended(dfo_id, '%Y%m%d')
 
     # ------------------------ EXPORT RESULTS-------------------------- #
-    start_formatted = ee.Date(props.get('Began')).format('yyyyMMdd').getInfo()
-    end_formatted = ee.Date(props.get('Ended')).format('yyyyMMdd').getInfo()
     save_name = "DFO_" + str(dfo_id) + "_From_" + str(start_formatted) + "_to_" + str(end_formatted)
     save_asset = str(save_path + "/" + save_name)
+    region = bounds.getInfo()['coordinates']
 
     task = ee.batch.Export.image.toAsset(
-        image=flood_img.set({'glide_index': ee.String(glide_number),
-                             'dfo_country': ee.String(props.get('Country')),
-                             'dfo_other_country': ee.String(dfo_other_country),
-                             'dfo_centroid_x': ee.Number(props.get('long')),
-                             'dfo_centroid_y': ee.Number(props.get('lat')),
-                             'dfo_validation_type': ee.String(props.get("Validation")),
-                             'dfo_main_cause': ee.String(props.get("MainCause")),
-                             'dfo_severity': ee.Number(props.get("Severity")),
-                             'dfo_dead': ee.Number(props.get("Dead")),
-                             'dfo_displaced': ee.Number(props.get("Displaced"))}),
+        image=flood_img.set(export_props),
         description="ExportToAsset DFO" + str(dfo_id),
         assetId=save_asset,
-        region=bounds.getInfo()['coordinates'],
+        region=region,
         scale=res,
         maxPixels=1e12
     )
     task.start()
+    timing.count(pixels=region_pixels(region, res))
+    timing.annotate(task_id=getattr(task, 'id', None))
     return
 
 # --------------------------------------------------------
@@ -74,18 +110,31 @@ def to_asset(flood_img, bounds, save_path, res=250):
     #     bounds: the ROI
     #     cloud_path: the name of the Cloud Bucket to upload the file (as a string)
     #     res: the resolution (in meters) per pixel of the image
+    #     dfo_id: the DFO event ID, read from the image if not given
+    #     catalog: optional catalog.EventCatalog to take the event dates from
     #
     # Returns:
     #     - Saves the image into the GEE Code Editor Asset path
 
 # --------------------------------------------------------
-def to_gcs(flood_img, bounds, cloud_path, name_prefix='DFO', res=250):
+@timing.traced
+def to_gcs(flood_img, bounds, cloud_path, name_prefix='DFO', res=250,
+           dfo_id=None, catalog=None):
 
-    start_formatted = ee.Date(flood_img.get('began')).format('yyyyMMdd').getInfo()
-    end_formatted = ee.Date(flood_img.get('ended')).format('yyyyMMdd').getInfo()
-    index = flood_img.get('id').getInfo()
+    if dfo_id is None:
+        index = flood_img.get('id').getInfo()
+    else:
+        index = dfo_id
+
+    if catalog is None:
+        start_formatted = ee.Date(flood_img.get('began')).format('yyyyMMdd').getInfo()
+        end_formatted = ee.Date(flood_img.get('ended')).format('yyyyMMdd').getInfo()
+    else:
+        start_formatted = catalog.began(index, '%Y%m%d')
+        end_formatted = catalog.ended(index, '%Y%m%d')
     save_name = name_prefix + "_" + str(index) + "_From_" + str(start_formatted) + "_to_" + str(end_formatted)
     save_csb = str(save_name)
+    region = bounds.getInfo()['coordinates']
 
     # ------------ EXPORT RESULTS! ------------ #
     task = ee.batch.Export.image.toCloudStorage(
@@ -93,9 +142,11 @@ def to_gcs(flood_img, bounds, cloud_path, name_prefix='DFO', res=250):
         description="ExportToCSB DFO" + str(index),
         bucket=cloud_path,
         fileNamePrefix=save_csb,
-        region=bounds.getInfo()['coordinates'],
+        region=region,
         scale=res,
         maxPixels=1e12
     )
     task.start()
+    timing.count(pixels=region_pixels(region, res))
+    timing.annotate(task_id=getattr(task, 'id', None))
     return
@@ -3,25 +3,33 @@ import ee
 
 ee.Initialize()
 
+from flood_detection.utils import timing
+from flood_detection.utils.slope import check_class_thresh
+
 # Series of functions to extract overlapping watersheds from roi region. We use
 # HydroSheds database provided a different levels. Also - functions for islands
 # shapefiles are provided as HydroSheds does not cover some small islands.
+@timing.traced
 def get_watersheds_level5(dfo_feature):
     basins = ee.FeatureCollection('ft:1IHRHUiWkgPXOzwNweeM89CzPYSfokjLlz7_0OTQl')
     return basins.filterBounds(dfo_feature)
 
+@timing.traced
 def get_watersheds_level4(dfo_feature):
     basins = ee.FeatureCollection('ft:1JRW4YKfVTZKLAH4x4JRsggsHZoXRRUQKTIOYgJOW')
     return basins.filterBounds(dfo_feature)
 
+@timing.traced
 def get_watersheds_level3(dfo_feature):
     basins = ee.FeatureCollection('ft:1asIZ7d9NqNIubAp2dNMvnAfRMd-9ih7kjcLnIzv6')
     return basins.filterBounds(dfo_feature)
 
+@timing.traced
 def get_islands(dfo_feature):
     islands = ee.FeatureCollection('ft:14BijFeJ0MiV1CeP7FBst8P4Kf1Se0HK5Sfh78hJB')
     return islands.filterBounds(dfo_feature)
 
+@timing.traced
 def get_american_somoa(dfo_feature):
     asm = ee.FeatureCollection('ft:1C79v82bd1QfIsdGfDFOo2sz2XIHJCiVnXWXBeX0_')
     return asm.filterBounds(dfo_feature)
@@ -29,23 +37,65 @@ def get_american_somoa(dfo_feature):
 # applySlopeMask() applies a mask to remove pixels that are greater than a
 # certain slope based on SRTM 90-m DEM V4 the only parameter is the slope
 # threshold, which is default to 5%
-def apply_slope_mask(img, thresh=5):
-    srtm = ee.Image("USGS/GMTED2010")
-    slope = ee.Terrain.slope(srtm)
+# 'slope_classes' is the asset ID (or ee.Image) of the precomputed slope
+# classes exported from get_slope_classes(). The slope is then read from the
+# asset instead of running ee.Terrain.slope for every event, and any whole
+# degree threshold from 0 to 13 can be used (others raise a ValueError).
+@timing.traced
+def apply_slope_mask(img, thresh=5, slope_classes=None):
+    if slope_classes is None:
+        srtm = ee.Image("USGS/GMTED2010")
+        slope = ee.Terrain.slope(srtm)
+    else:
+        check_class_thresh(thresh)
+        slope = ee.Image(slope_classes)
     masked = img.updateMask(slope.lte(thresh))
     return masked.set({'slope_threshold': thresh})
 
+# Slope classes of GMTED2010 to export once as an asset at the 250-m GFD
+# resolution (see utils/slope.py): class k means k - 1 < slope <= k degrees,
+# class 14 anything over 13 degrees and class 15 no DEM data
+def get_slope_classes():
+    slope = ee.Terrain.slope(ee.Image("USGS/GMTED2010"))
+    return slope.ceil().min(14).unmask(15).toByte().rename(['slope_class'])
+
+# Permanent water masks precomputed at the 250-m GFD resolution (see
+# utils/water_mask.py and get_perm_water_exports()). Set these to the asset
+# IDs once exported, e.g. misc.PERM_WATER_ASSET = "...". With None the masks
+# are built from the 30-m JRC dataset on the fly, as before.
+PERM_WATER_ASSET = None
+YEARLY_PERM_ASSET = None
+
+# The one definition of permanent water (JRC transition class 1) used by the
+# flood maps and the population functions in flood_stats/pop_utils.py
+@timing.traced
+def perm_water(unmask=True):
+    if PERM_WATER_ASSET is not None:
+        perm = ee.Image(PERM_WATER_ASSET).select([0], ['transition'])
+    else:
+        perm = ee.Image("JRC/GSW1_0/GlobalSurfaceWater")\
+                    .select("transition").eq(1)
+    if unmask:
+        perm = perm.unmask()
+    return perm
+
 # this returns the permanent water mask from the JRC Global Surface Water
 # dataset. It gets the permanent water from the transistions layer
+@timing.traced
 def get_jrc_perm(roi_bounds):
-    jrc_perm_water = ee.Image("JRC/GSW1_0/GlobalSurfaceWater")\
-                    .select("transition").eq(1).unmask()
+    jrc_perm_water = perm_water()
     return jrc_perm_water.select(['transition'],['jrc_perm_water']).clip(roi_bounds)
 
+@timing.traced
 def get_jrc_yearly_perm(began, roi):
     ee_began = ee.Date(began)
     jrc_year = ee.Algorithms.If(ee_began.get('year')\
                     .gt(2018), 2018, ee_began.get('year'))
+    if YEARLY_PERM_ASSET is not None:
+        jrc_perm = ee.Image(ee.ImageCollection(YEARLY_PERM_ASSET)\
+                        .filterMetadata('year', "equals", jrc_year).first())\
+                        .select([0], ['jrc_perm_yearly']).unmask()
+        return jrc_perm.updateMask(jrc_perm)
     jrc_perm = ee.Image(ee.ImageCollection('JRC/GSW1_1/YearlyHistory')\
                     .filterBounds(roi)
                     .filterMetadata('year', "equals", jrc_year).first())\
@@ -53,6 +103,23 @@ def get_jrc_yearly_perm(began, roi):
                     .select(['remapped'],['jrc_perm_yearly'])
     return jrc_perm.updateMask(jrc_perm)
 
+# Permanent water masks to export once at the 250-m GFD resolution for
+# PERM_WATER_ASSET and YEARLY_PERM_ASSET (one image per year with a 'year'
+# property). Nearest neighbour resampling, the same the 30-m masks get when
+# the flood maps are exported at 250 m.
+def get_perm_water_exports():
+    proj = ee.Projection('EPSG:4326').atScale(250)
+    transition = ee.Image("JRC/GSW1_0/GlobalSurfaceWater")\
+                    .select("transition").eq(1).unmask()\
+                    .reproject(proj).toByte()
+    def yearly(img):
+        perm = img.remap([0, 1, 2, 3], [0, 0, 0, 1]).unmask()\
+                  .reproject(proj).toByte()
+        return perm.copyProperties(img, ['year'])
+    yearly_perm = ee.ImageCollection('JRC/GSW1_1/YearlyHistory').map(yearly)
+    return transition, yearly_perm
+
+@timing.traced
 def get_countries (roi):
     countries = ee.FeatureCollection("USDOS/LSIB/2013");
     img_country = countries.filterBounds(roi)
@@ -0,0 +1,2331 @@
+# Offline stand-in for the Earth Engine client
+#
+# modis_toolbox, export, misc, otsu and pop_utils call ee.Initialize() when
+# they are imported and every run of main_gfd.py or main_popstats.py needs
+# credentials and the live service, so its timings and round trips change
+# from one run to the next. This module implements the part of the ee API
+# those modules use on NumPy arrays covering one window of the 250-m GFD grid
+# (tiled_raster.py), and takes the place of the ee package once installed:
+#
+#     from flood_detection.utils import offline_ee
+#
+#     session = offline_ee.Session(window, root="offline")
+#     session.add_modis(stack, dates)          # modis_local RAW_BANDS layout
+#     session.add_image("JRC/GSW1_0/GlobalSurfaceWater",
+#                       {"transition": transition})
+#     session.add_table("USDOS/LSIB/2013", countries)   # GeoJSON features
+#     ...
+#     offline_ee.run_script("main_gfd.py", session)
+#
+# main_gfd.py maps the events with modis.py and modis_toolbox.py, which are
+# still Python 2, so it only runs offline under Python 2.7 (with numpy and
+# shapely). main_popstats.py runs under Python 2.7 and 3. The smoke run in
+# benchmarks/offline_run.py sets up a session for both scripts and runs them.
+#
+# Assets that are not added to the session are read from 'root/assets': an
+# image from <asset id>.npz, a collection from the .npz files in <asset id>/
+# and a table from <asset id>.geojson. Exports write there too, so the flood
+# maps exported by main_gfd.py are the 'gfd_v3' collection main_popstats.py
+# reads in the next run. Cloud Storage exports go to 'root/gcs/<bucket>'
+# (.npz images, CSV tables).
+#
+# Each getInfo() is an ee.data.computeValue() call and each task start an
+# ee.data.startProcessing() call, as in the real client, so timing.start()
+# counts the round trips of an offline run the same way. The session counts
+# them as well ('round_trips').
+#
+# Differences from Earth Engine:
+#   - everything is computed eagerly when it is called, both branches of
+#     ee.Algorithms.If() included, and a missing asset or band raises
+#     EEException right away instead of at getInfo() or export time
+#   - all images are on the session grid: scale, crs, reproject() and
+#     maxPixels are ignored and projection().nominalScale() is 250 m
+#   - reduceRegion() and clip() take the pixels with their center inside the
+#     geometry (zonal.polygon_mask), no fractional pixel weights
+#   - stratifiedSample() draws its points with a seeded NumPy RandomState, the
+#     same seed gives the same sample offline but not the one EE takes
+#   - export tasks run when they are started, the first status() is
+#     already COMPLETED (or FAILED)
+#   - only the operators of the repo's expressions are supported by
+#     Image.expression(): b('name'), arithmetic, comparisons, && and ||
+
+import calendar
+import csv
+import datetime
+import json
+import os
+import re
+import runpy
+import sys
+import threading
+import types
+from collections import OrderedDict
+
+import numpy as np
+
+from flood_detection.utils import tiled_raster
+
+_STRINGS = (str, type(u""))
+_NUMBERS = (int, float, np.number, np.bool_)
+
+# Nominal scale of every image, in meters
+SCALE = round(tiled_raster.PIXEL_DEG * 111319.49, 2)
+
+# Joda date patterns of Date.format() and their strftime() directives
+JODA_PATTERNS = [("yyyy", "%Y"), ("yy", "%y"), ("MM", "%m"), ("dd", "%d"),
+                 ("DDD", "%j"), ("HH", "%H"), ("mm", "%M"), ("ss", "%S")]
+
+DATE_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d",
+                "%Y-%m", "%Y"]
+
+UNIT_MS = {"second": 1000, "minute": 60 * 1000, "hour": 3600 * 1000,
+           "day": 86400 * 1000, "week": 7 * 86400 * 1000}
+
+_session = None
+_previous_modules = None
+
+
+class EEException(Exception):
+    pass
+
+
+def _current():
+    if _session is None:
+        raise EEException("No offline session, see offline_ee.install()")
+    return _session
+
+
+def _py(value):
+    """Plain Python value of a Number, String, List, ... (images, features,
+    collections, geometries and dates are kept as they are)"""
+    if isinstance(value, (Element, Geometry, Date, DateRange, Filter, Array,
+                          Projection)):
+        return value
+    if isinstance(value, ComputedObject):
+        return _py(value._value)
+    if isinstance(value, (list, tuple)):
+        return [_py(v) for v in value]
+    if isinstance(value, dict):
+        return OrderedDict((k, _py(v)) for k, v in value.items())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _wrap(value):
+    """The ee object for a property or list item"""
+    if isinstance(value, ComputedObject):
+        return value
+    if isinstance(value, (bool, np.bool_)):
+        return Number(int(value))
+    if isinstance(value, _NUMBERS):
+        return Number(value)
+    if isinstance(value, _STRINGS):
+        return String(value)
+    if isinstance(value, (list, tuple)):
+        return List(value)
+    if isinstance(value, dict):
+        return Dictionary(value)
+    return ComputedObject(value)
+
+
+def _info(value):
+    """What getInfo() returns for a value"""
+    if isinstance(value, ComputedObject):
+        return value._info()
+    if isinstance(value, (list, tuple)):
+        return [_info(v) for v in value]
+    if isinstance(value, dict):
+        return OrderedDict((k, _info(v)) for k, v in value.items())
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _number(value):
+    value = _py(value)
+    if isinstance(value, np.generic):
+        value = value.item()
+    return value
+
+
+def _truthy(value):
+    value = _py(value)
+    if value is None:
+        return False
+    if isinstance(value, _NUMBERS):
+        return value != 0
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Session: the grid, the assets and the round trips of an offline run
+
+class Session(object):
+    """
+    Assets of an offline run on one window of the GFD grid.
+
+    Args:
+        window: (row slice, col slice) of the GFD grid that all images cover
+        root: directory of the assets on disk and of the exports
+    """
+
+    def __init__(self, window, root="offline_ee"):
+        from flood_stats import zonal
+
+        self.window = window
+        self.grid = zonal.Grid.from_window(window)
+        self.shape = self.grid.shape
+        self.root = root
+        self.images = {}
+        self.collections = {}
+        self.tables = {}
+        self.tasks = OrderedDict()
+        self.round_trips = 0
+        self.lock = threading.Lock()
+        self._masks = {}
+
+    def bounds(self):
+        return tiled_raster.window_to_bounds(self.window)
+
+    def band(self, values):
+        """A band on the session grid, NaN values masked"""
+        values = np.asarray(values) if not np.ma.isMaskedArray(values) \
+            else values
+        if values.shape != self.shape:
+            raise ValueError("Band of shape {0}, the session grid is {1}"
+                             .format(values.shape, self.shape))
+        if values.dtype.kind == "f":
+            return np.ma.masked_invalid(values)
+        return np.ma.array(values, mask=np.ma.getmaskarray(values))
+
+    def image(self, bands, properties=None):
+        """Image of arrays on the session grid, 'bands' name -> array"""
+        bands = OrderedDict((name, self.band(values))
+                            for name, values in bands.items())
+        return Image._make(bands, properties)
+
+    def add_image(self, asset_id, bands, properties=None):
+        image = self.image(bands, properties)
+        self.images[asset_id] = _asset_properties(image, asset_id)
+        return self.images[asset_id]
+
+    def add_collection(self, asset_id, images):
+        """Collection of (bands, properties) pairs"""
+        self.collections.setdefault(asset_id, [])
+        for bands, properties in images:
+            image = self.image(bands, properties)
+            index = image._props.get("system:index",
+                                     str(len(self.collections[asset_id])))
+            self.collections[asset_id].append(_asset_properties(
+                image, "{0}/{1}".format(asset_id, index)))
+        return self.collections[asset_id]
+
+    def add_table(self, asset_id, features):
+        """Table of GeoJSON features (or a GeoJSON FeatureCollection)"""
+        if isinstance(features, dict):
+            features = features["features"]
+        self.tables[asset_id] = [Feature(f) for f in features]
+        return self.tables[asset_id]
+
+    def add_modis(self, stack, dates, products=None):
+        """
+        MODIS GQ and GA collections of a stack in the RAW_BANDS layout of
+        modis_local.py. 'products' gives MOD09 (Terra) or MYD09 (Aqua) for
+        each image, by default the first image of a day is Terra and the
+        second Aqua, as in stack_cache.py.
+        """
+        from flood_detection import modis_local
+        from flood_detection.utils import stack_cache
+
+        layout = {"GQ": [("sur_refl_b01", "red_250m"),
+                         ("sur_refl_b02", "nir_250m")],
+                  "GA": [("sur_refl_b01", "red_500m"),
+                         ("sur_refl_b03", "blue"), ("sur_refl_b04", "green"),
+                         ("sur_refl_b07", "swir"), ("state_1km", "state_1km")]}
+        index = dict((name, i) for i, name in enumerate(modis_local.RAW_BANDS))
+        days = modis_local.as_days(dates)
+        seen = {}
+        for t, day in enumerate(days):
+            if products is None:
+                product = stack_cache.PRODUCTS[seen.get(day, 0) % 2]
+                seen[day] = seen.get(day, 0) + 1
+            else:
+                product = products[t]
+            millis = _millis(str(day))
+            props = {"system:time_start": millis,
+                     "system:index": str(day).replace("-", "_")}
+            for kind, bands in layout.items():
+                values = OrderedDict()
+                for ee_name, name in bands:
+                    band = self.band(np.asarray(stack[t, index[name]]))
+                    if name == "state_1km":
+                        band = np.ma.array(band.filled(0).astype(np.uint16),
+                                           mask=np.ma.getmaskarray(band))
+                    values[ee_name] = band
+                self.collections.setdefault(
+                    "MODIS/006/{0}{1}".format(product, kind), []).append(
+                    Image._make(values, props))
+
+    def geometry_mask(self, geometry):
+        """Pixels of the grid with their center inside a Geometry"""
+        from flood_stats import zonal
+
+        geojson = geometry._info()
+        key = json.dumps(geojson, sort_keys=True)
+        with self.lock:
+            mask = self._masks.get(key)
+        if mask is None:
+            mask = zonal.polygon_mask(geojson, self.grid)
+            with self.lock:
+                self._masks[key] = mask
+        return mask
+
+    def compute(self, value):
+        with self.lock:
+            self.round_trips += 1
+        return _info(value)
+
+    # ---- assets on disk
+
+    def asset_path(self, asset_id, ext=""):
+        return os.path.join(self.root, "assets", *asset_id.split("/")) + ext
+
+    def load(self, asset_id, kind=None):
+        """Image, list of images (collection) or list of features (table)"""
+        if asset_id in self.images and kind in (None, "image"):
+            return self.images[asset_id]
+        if asset_id in self.collections and kind in (None, "collection"):
+            return _sorted(self.collections[asset_id], "system:time_start")
+        if asset_id in self.tables and kind in (None, "table"):
+            return self.tables[asset_id]
+        path = self.asset_path(asset_id)
+        if kind in (None, "image") and os.path.exists(path + ".npz"):
+            return self.read_image(path + ".npz", asset_id)
+        if kind in (None, "collection") and os.path.isdir(path):
+            return [self.read_image(os.path.join(path, name),
+                                    asset_id + "/" + name[:-4])
+                    for name in sorted(os.listdir(path))
+                    if name.endswith(".npz")]
+        if kind in (None, "table") and os.path.exists(path + ".geojson"):
+            with open(path + ".geojson") as f:
+                return [Feature(ft) for ft in json.load(f)["features"]]
+        raise EEException("Asset '{0}' not found (offline session)."
+                          .format(asset_id))
+
+    def region_window(self, region):
+        """Window of the grid (relative to the session) covering a region"""
+        if region is None:
+            return (slice(0, self.shape[0]), slice(0, self.shape[1]))
+        rows, cols = tiled_raster.bounds_to_window(region._shape().bounds)
+        r0, c0 = self.window[0].start, self.window[1].start
+        return (slice(min(max(rows.start - r0, 0), self.shape[0]),
+                      min(max(rows.stop - r0, 0), self.shape[0])),
+                slice(min(max(cols.start - c0, 0), self.shape[1]),
+                      min(max(cols.stop - c0, 0), self.shape[1])))
+
+    def write_image(self, path, image, region=None):
+        """Write the bands of an image within the bounds of a region"""
+        rows, cols = self.region_window(region)
+        arrays = {}
+        for i, band in enumerate(image._bands.values()):
+            arrays["data_{0}".format(i)] = np.ma.getdata(band)[rows, cols]
+            arrays["mask_{0}".format(i)] = np.ma.getmaskarray(band)[rows, cols]
+        r0, c0 = self.window[0].start, self.window[1].start
+        meta = {"bands": list(image._bands),
+                "properties": _info(image._props),
+                "window": [[rows.start + r0, rows.stop + r0],
+                           [cols.start + c0, cols.stop + c0]],
+                "footprint": None if region is None else region._info()}
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, meta=np.array(json.dumps(meta)), **arrays)
+        os.rename(tmp, path)
+
+    def read_image(self, path, asset_id=None):
+        """Image written by write_image(), masked outside its window"""
+        with np.load(path) as npz:
+            meta = json.loads(str(npz["meta"]))
+            (r0, r1), (c0, c1) = meta["window"]
+            dst = (slice(max(r0 - self.window[0].start, 0),
+                         min(r1 - self.window[0].start, self.shape[0])),
+                   slice(max(c0 - self.window[1].start, 0),
+                         min(c1 - self.window[1].start, self.shape[1])))
+            src = (slice(dst[0].start + self.window[0].start - r0,
+                         dst[0].stop + self.window[0].start - r0),
+                   slice(dst[1].start + self.window[1].start - c0,
+                         dst[1].stop + self.window[1].start - c0))
+            bands = OrderedDict()
+            for i, name in enumerate(meta["bands"]):
+                values = npz["data_{0}".format(i)]
+                band = np.ma.array(np.zeros(self.shape, values.dtype),
+                                   mask=np.ones(self.shape, bool))
+                if dst[0].stop > dst[0].start and dst[1].stop > dst[1].start:
+                    band.data[dst] = values[src]
+                    band.mask[dst] = npz["mask_{0}".format(i)][src]
+                bands[name] = band
+        footprint = meta["footprint"]
+        image = Image._make(bands, meta["properties"],
+                            None if footprint is None else Geometry(footprint))
+        if asset_id is not None:
+            image = _asset_properties(image, asset_id)
+        return image
+
+    def write_table(self, path, collection, selectors=None):
+        """CSV of the properties of the features, like a table export"""
+        from flood_detection.batch import open_csv
+
+        rows = []
+        names = set()
+        for i, ft in enumerate(collection._elements):
+            row = OrderedDict([("system:index", str(i))])
+            for name, value in ft._props.items():
+                value = _info(value)
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value)
+                row[name] = "" if value is None else value
+            geometry = getattr(ft, "_geometry", None)
+            row[".geo"] = "" if geometry is None else \
+                json.dumps(geometry._info())
+            names.update(k for k in row if k not in ("system:index", ".geo"))
+            rows.append(row)
+        fields = ["system:index"] + (selectors or sorted(names)) + [".geo"]
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + ".tmp"
+        with open_csv(tmp, "w") as f:
+            writer = csv.DictWriter(f, fields, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.rename(tmp, path)
+
+
+def _asset_properties(image, asset_id):
+    props = OrderedDict(image._props)
+    props.setdefault("system:index", asset_id.rsplit("/", 1)[-1])
+    props["system:id"] = asset_id
+    return Image._make(image._bands, props, image._footprint)
+
+
+# ---------------------------------------------------------------------------
+# Client side objects: numbers, strings, dates, lists, dictionaries, arrays
+
+class ComputedObject(object):
+
+    def __init__(self, value=None):
+        self._value = _py(value)
+
+    def getInfo(self):
+        return data.computeValue(self)
+
+    def _info(self):
+        return _info(self._value)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, self._info())
+
+
+class Number(ComputedObject):
+
+    def __init__(self, number):
+        ComputedObject.__init__(self, _number(number))
+
+    def _op(self, other, fn):
+        return Number(fn(self._value, _number(other)))
+
+    def add(self, other):
+        return self._op(other, lambda a, b: a + b)
+
+    def subtract(self, other):
+        return self._op(other, lambda a, b: a - b)
+
+    def multiply(self, other):
+        return self._op(other, lambda a, b: a * b)
+
+    # Division by zero is 0, as in Earth Engine
+    def divide(self, other):
+        return self._op(other, lambda a, b: 0 if b == 0 else float(a) / b)
+
+    def pow(self, other):
+        return self._op(other, lambda a, b: float(a) ** b)
+
+    def min(self, other):
+        return self._op(other, min)
+
+    def max(self, other):
+        return self._op(other, max)
+
+    def gt(self, other):
+        return self._op(other, lambda a, b: int(a > b))
+
+    def gte(self, other):
+        return self._op(other, lambda a, b: int(a >= b))
+
+    def lt(self, other):
+        return self._op(other, lambda a, b: int(a < b))
+
+    def lte(self, other):
+        return self._op(other, lambda a, b: int(a <= b))
+
+    def eq(self, other):
+        return self._op(other, lambda a, b: int(a == b))
+
+    def neq(self, other):
+        return self._op(other, lambda a, b: int(a != b))
+
+    def And(self, other):
+        return self._op(other, lambda a, b: int(bool(a) and bool(b)))
+
+    def Or(self, other):
+        return self._op(other, lambda a, b: int(bool(a) or bool(b)))
+
+    def abs(self):
+        return Number(abs(self._value))
+
+    def round(self):
+        return Number(float(np.round(self._value)))
+
+    def floor(self):
+        return Number(float(np.floor(self._value)))
+
+    def ceil(self):
+        return Number(float(np.ceil(self._value)))
+
+    def int(self):
+        return Number(int(self._value))
+
+    toInt = int
+
+    def float(self):
+        return Number(float(self._value))
+
+    def format(self, pattern="%s"):
+        return String(pattern % self._value)
+
+
+class String(ComputedObject):
+
+    def __init__(self, string):
+        ComputedObject.__init__(self, _py(string))
+
+    def cat(self, other):
+        return String(str(self._value) + str(_py(other)))
+
+    def length(self):
+        return Number(len(self._value))
+
+
+def _millis(value):
+    value = _py(value)
+    if isinstance(value, Date):
+        return value._value
+    if isinstance(value, _NUMBERS):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.timetuple()) * 1000 + \
+            value.microsecond // 1000
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple()) * 1000
+    if isinstance(value, _STRINGS):
+        text = value.strip().rstrip("Z").split(".")[0]
+        for fmt in DATE_FORMATS:
+            try:
+                return _millis(datetime.datetime.strptime(text, fmt))
+            except ValueError:
+                pass
+    raise EEException("Date: can't parse {0!r}".format(value))
+
+
+def _add_months(dt, months):
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+
+def _unit(unit):
+    unit = str(_py(unit)).lower()
+    return unit[:-1] if unit.endswith("s") else unit
+
+
+class Date(ComputedObject):
+
+    def __init__(self, date, tz=None):
+        ComputedObject.__init__(self)
+        self._value = _millis(date)
+
+    def _datetime(self):
+        return datetime.datetime(1970, 1, 1) + \
+            datetime.timedelta(milliseconds=self._value)
+
+    def millis(self):
+        return Number(self._value)
+
+    def advance(self, delta, unit):
+        delta, unit = _number(delta), _unit(unit)
+        if unit in UNIT_MS:
+            return Date(int(round(self._value + delta * UNIT_MS[unit])))
+        if unit in ("month", "year"):
+            months = int(delta) * (12 if unit == "year" else 1)
+            return Date(_add_months(self._datetime(), months))
+        raise EEException("Date.advance: unknown unit {0!r}".format(unit))
+
+    def difference(self, start, unit):
+        unit = _unit(unit)
+        diff = self._value - Date(start)._value
+        if unit in UNIT_MS:
+            return Number(float(diff) / UNIT_MS[unit])
+        if unit == "month":
+            return Number(diff / (30.436875 * UNIT_MS["day"]))
+        if unit == "year":
+            return Number(diff / (365.2425 * UNIT_MS["day"]))
+        raise EEException("Date.difference: unknown unit {0!r}".format(unit))
+
+    def get(self, unit, tz=None):
+        dt = self._datetime()
+        unit = _unit(unit)
+        values = {"year": dt.year, "month": dt.month, "day": dt.day,
+                  "hour": dt.hour, "minute": dt.minute, "second": dt.second,
+                  "week": dt.isocalendar()[1]}
+        if unit not in values:
+            raise EEException("Date.get: unknown unit {0!r}".format(unit))
+        return Number(values[unit])
+
+    def format(self, format=None, tz=None):
+        if format is None:
+            return String(self._datetime().strftime("%Y-%m-%dT%H:%M:%S"))
+        pattern = "|".join(["'[^']*'"] + [joda for joda, _ in JODA_PATTERNS])
+        directives = dict(JODA_PATTERNS)
+
+        def convert(match):
+            token = match.group(0)
+            if token.startswith("'"):
+                return token[1:-1].replace("%", "%%")
+            return directives[token]
+        fmt = re.sub(pattern, convert, _py(format))
+        return String(self._datetime().strftime(fmt))
+
+    def _info(self):
+        return OrderedDict([("type", "Date"), ("value", self._value)])
+
+
+class DateRange(ComputedObject):
+
+    def __init__(self, start, end=None, tz=None):
+        ComputedObject.__init__(self)
+        start = Date(start)
+        end = start.advance(1, "day") if end is None else Date(end)
+        self._value = [start._value, end._value]
+
+    def start(self):
+        return Date(self._value[0])
+
+    def end(self):
+        return Date(self._value[1])
+
+    def contains(self, date):
+        millis = _millis(date)
+        return Number(int(self._value[0] <= millis < self._value[1]))
+
+    def _info(self):
+        return OrderedDict([("type", "DateRange"), ("dates", self._value)])
+
+
+class List(ComputedObject):
+
+    def __init__(self, items):
+        ComputedObject.__init__(self, list(_py(items)))
+
+    @staticmethod
+    def sequence(start, end=None, step=1, count=None):
+        start, end, step = _number(start), _number(end), _number(step)
+        if count is not None:
+            return List([start + i * step for i in range(int(_number(count)))])
+        values = []
+        value = start
+        while value <= end:
+            values.append(value)
+            value += step
+        return List(values)
+
+    def get(self, index):
+        index = int(_number(index))
+        try:
+            return _wrap(self._value[index])
+        except IndexError:
+            raise EEException("List.get: List index must be between {0} and "
+                              "{1}: {2}".format(-len(self._value),
+                                                len(self._value) - 1, index))
+
+    def size(self):
+        return Number(len(self._value))
+
+    length = size
+
+    def add(self, element):
+        return List(self._value + [_py(element)])
+
+    def cat(self, other):
+        return List(self._value + list(_py(other)))
+
+    def slice(self, start, end=None, step=None):
+        return List(self._value[int(_number(start)):
+                                None if end is None else int(_number(end)):
+                                None if step is None else int(_number(step))])
+
+    def map(self, baseAlgorithm, dropNulls=False):
+        out = [_py(baseAlgorithm(_wrap(item))) for item in self._value]
+        if dropNulls:
+            out = [item for item in out if item is not None]
+        return List(out)
+
+    def iterate(self, function, first):
+        result = first
+        for item in self._value:
+            result = function(_wrap(item), _wrap(result))
+        return _wrap(_py(result))
+
+    def sort(self, keys=None):
+        if keys is None:
+            return List(sorted(self._value))
+        order = np.argsort(np.asarray(_py(keys)), kind="mergesort")
+        return List([self._value[i] for i in order])
+
+    def reduce(self, reducer):
+        return _wrap(reducer._apply(np.asarray(self._value, np.float64)))
+
+    def contains(self, element):
+        return Number(int(_py(element) in self._value))
+
+
+class Dictionary(ComputedObject):
+
+    def __init__(self, opt_dict=None):
+        ComputedObject.__init__(self, OrderedDict(_py(opt_dict) or {}))
+
+    def get(self, key, defaultValue=None):
+        key = _py(key)
+        if key not in self._value:
+            if defaultValue is not None:
+                return _wrap(defaultValue)
+            raise EEException("Dictionary.get: Dictionary does not contain "
+                              "key: {0}.".format(key))
+        return _wrap(self._value[key])
+
+    def set(self, key, value):
+        out = OrderedDict(self._value)
+        out[_py(key)] = _py(value)
+        return Dictionary(out)
+
+    def keys(self):
+        return List(list(self._value))
+
+    def values(self, keys=None):
+        return List([self._value[k] for k in (_py(keys) or self._value)])
+
+    def contains(self, key):
+        return Number(int(_py(key) in self._value))
+
+
+class Array(ComputedObject):
+
+    def __init__(self, values, pixelType=None):
+        ComputedObject.__init__(self)
+        values = _py(values)
+        self._value = values._value if isinstance(values, Array) else \
+            np.asarray(values, np.float64)
+
+    def _op(self, other, fn):
+        other = _py(other)
+        other = other._value if isinstance(other, Array) else other
+        return Array(fn(self._value, np.asarray(other, np.float64)))
+
+    def add(self, other):
+        return self._op(other, np.add)
+
+    def subtract(self, other):
+        return self._op(other, np.subtract)
+
+    def multiply(self, other):
+        return self._op(other, np.multiply)
+
+    def divide(self, other):
+        def divide(a, b):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.where(b == 0, 0.0, np.true_divide(a, b))
+        return self._op(other, divide)
+
+    def pow(self, other):
+        return self._op(other, np.power)
+
+    def length(self):
+        return Array(self._value.shape)
+
+    def get(self, position):
+        return Number(float(self._value[tuple(int(_number(p))
+                                              for p in _py(position))]))
+
+    def slice(self, axis=0, start=0, end=None, step=1):
+        index = [slice(None)] * self._value.ndim
+        index[int(_number(axis))] = slice(
+            int(_number(start)), None if end is None else int(_number(end)),
+            int(_number(step)))
+        return Array(self._value[tuple(index)])
+
+    def reduce(self, reducer, axes, fieldAxis=None):
+        values = self._value
+        for axis in sorted((int(_number(a)) for a in _py(axes)), reverse=True):
+            values = np.expand_dims(np.apply_along_axis(
+                lambda v: reducer._apply(v), axis, values), axis)
+        return Array(values)
+
+    def sort(self, keys=None):
+        keys = self._value if keys is None else np.asarray(_py(keys),
+                                                           np.float64)
+        return Array(self._value[np.argsort(keys, kind="mergesort")])
+
+    def toList(self):
+        return List(self._value.tolist())
+
+
+# ---------------------------------------------------------------------------
+# Reducers, filters and joins
+
+class Reducer(object):
+    """
+    Reduces 1-D arrays of values (reduceRegion, reduceColumns, Array.reduce)
+    or stacks of masked images along their first axis (collections, bands)
+    """
+
+    def __init__(self, name, options=None):
+        self.name = name
+        self.options = options or {}
+
+    @staticmethod
+    def sum():
+        return Reducer("sum")
+
+    @staticmethod
+    def mean():
+        return Reducer("mean")
+
+    @staticmethod
+    def median(maxBuckets=None, minBucketWidth=None, maxRaw=None):
+        return Reducer("median")
+
+    @staticmethod
+    def min(numInputs=1):
+        return Reducer("min")
+
+    @staticmethod
+    def max(numInputs=1):
+        return Reducer("max")
+
+    @staticmethod
+    def count():
+        return Reducer("count")
+
+    @staticmethod
+    def first():
+        return Reducer("first")
+
+    @staticmethod
+    def histogram(maxBuckets=None, minBucketWidth=None, maxRaw=None):
+        return Reducer("histogram", {"maxBuckets": maxBuckets})
+
+    def _apply(self, values):
+        from flood_detection.utils import otsu_local
+
+        values = np.asarray(values, np.float64).ravel()
+        if self.name == "count":
+            return int(values.size)
+        if self.name == "sum":
+            return float(values.sum())
+        if values.size == 0:
+            return None
+        if self.name == "histogram":
+            return otsu_local.histogram(values,
+                                        self.options["maxBuckets"] or 255)
+        if self.name == "first":
+            return float(values[0])
+        return float(getattr(np, self.name)(values))
+
+    def _stack(self, stack):
+        """Pixel by pixel over a (n, y, x) masked array"""
+        mask = np.ma.getmaskarray(stack)
+        if self.name == "count":
+            return np.ma.array((~mask).sum(axis=0).astype(np.int64))
+        if stack.shape[0] == 0:
+            return np.ma.masked_all(stack.shape[1:])
+        if self.name == "first":
+            first = np.argmax(~mask, axis=0)
+            values = np.take_along_axis(np.ma.getdata(stack), first[None],
+                                        axis=0)[0]
+            return np.ma.array(values, mask=mask.all(axis=0))
+        if self.name == "sum":
+            dtype = np.float64 if stack.dtype.kind == "f" else np.int64
+            return np.ma.sum(stack, axis=0, dtype=dtype)
+        if self.name == "median":
+            return np.ma.median(stack, axis=0)
+        if self.name in ("mean", "min", "max"):
+            return getattr(np.ma, self.name)(stack, axis=0)
+        raise EEException("Reducer.{0} can't reduce images offline"
+                          .format(self.name))
+
+
+_OPERATORS = {
+    "equals": lambda a, b: a == b,
+    "not_equals": lambda a, b: a != b,
+    "less_than": lambda a, b: a is not None and a < b,
+    "greater_than": lambda a, b: a is not None and a > b,
+    "not_less_than": lambda a, b: a is not None and a >= b,
+    "not_greater_than": lambda a, b: a is not None and a <= b,
+    "less_than_or_equals": lambda a, b: a is not None and a <= b,
+    "greater_than_or_equals": lambda a, b: a is not None and a >= b,
+    "starts_with": lambda a, b: str(a).startswith(b),
+    "ends_with": lambda a, b: str(a).endswith(b),
+    "contains": lambda a, b: b in str(a),
+}
+
+
+def _property(element, name):
+    value = element._props.get(name)
+    if isinstance(value, Date):
+        return value._value
+    return value
+
+
+class Filter(ComputedObject):
+    """
+    A test of one element (collection filters) or of a pair of elements
+    (join conditions, left = primary and right = secondary)
+    """
+
+    def __init__(self, test=None):
+        ComputedObject.__init__(self)
+        self._test = test
+
+    def __call__(self, left, right=None):
+        return bool(self._test(left, left if right is None else right))
+
+    @staticmethod
+    def _compare(op, leftField=None, rightValue=None, rightField=None,
+                 leftValue=None):
+        leftField, rightField = _py(leftField), _py(rightField)
+        leftValue, rightValue = _py(leftValue), _py(rightValue)
+
+        def test(left, right):
+            a = _property(left, leftField) if leftField is not None \
+                else leftValue
+            b = _property(right, rightField) if rightField is not None \
+                else rightValue
+            if a is None or b is None:
+                return False
+            return op(a, b)
+        return Filter(test)
+
+    @staticmethod
+    def equals(leftField=None, rightValue=None, rightField=None,
+               leftValue=None):
+        return Filter._compare(lambda a, b: a == b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def notEquals(leftField=None, rightValue=None, rightField=None,
+                  leftValue=None):
+        return Filter._compare(lambda a, b: a != b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def lessThan(leftField=None, rightValue=None, rightField=None,
+                 leftValue=None):
+        return Filter._compare(lambda a, b: a < b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def lessThanOrEquals(leftField=None, rightValue=None, rightField=None,
+                         leftValue=None):
+        return Filter._compare(lambda a, b: a <= b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def greaterThan(leftField=None, rightValue=None, rightField=None,
+                    leftValue=None):
+        return Filter._compare(lambda a, b: a > b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def greaterThanOrEquals(leftField=None, rightValue=None, rightField=None,
+                            leftValue=None):
+        return Filter._compare(lambda a, b: a >= b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def maxDifference(difference, leftField=None, rightValue=None,
+                      rightField=None, leftValue=None):
+        difference = _number(difference)
+        return Filter._compare(lambda a, b: abs(a - b) <= difference,
+                               leftField, rightValue, rightField, leftValue)
+
+    @staticmethod
+    def inList(leftField=None, rightValue=None, rightField=None,
+               leftValue=None):
+        return Filter._compare(lambda a, b: a in b, leftField, rightValue,
+                               rightField, leftValue)
+
+    @staticmethod
+    def eq(name, value):
+        return Filter.equals(name, value)
+
+    @staticmethod
+    def neq(name, value):
+        return Filter.notEquals(name, value)
+
+    @staticmethod
+    def lt(name, value):
+        return Filter.lessThan(name, value)
+
+    @staticmethod
+    def lte(name, value):
+        return Filter.lessThanOrEquals(name, value)
+
+    @staticmethod
+    def gt(name, value):
+        return Filter.greaterThan(name, value)
+
+    @staticmethod
+    def gte(name, value):
+        return Filter.greaterThanOrEquals(name, value)
+
+    @staticmethod
+    def metadata(name, operator, value):
+        op = _OPERATORS.get(str(_py(operator)).lower())
+        if op is None:
+            raise EEException("Filter.metadata: unknown operator {0!r}"
+                              .format(operator))
+        name, value = _py(name), _py(value)
+        return Filter(lambda left, right: op(_property(left, name), value))
+
+    @staticmethod
+    def date(start, opt_end=None):
+        start, end = DateRange(start, opt_end)._value
+
+        def test(left, right):
+            millis = _property(left, "system:time_start")
+            return millis is not None and start <= millis < end
+        return Filter(test)
+
+    @staticmethod
+    def bounds(geometry, errorMargin=None):
+        geometry = _geometry(geometry)
+        return Filter(lambda left, right: left._intersects(geometry))
+
+    @staticmethod
+    def And(*filters):
+        filters = _varargs(filters)
+        return Filter(lambda left, right: all(f(left, right)
+                                              for f in filters))
+
+    @staticmethod
+    def Or(*filters):
+        filters = _varargs(filters)
+        return Filter(lambda left, right: any(f(left, right)
+                                              for f in filters))
+
+    def Not(self):
+        return Filter(lambda left, right: not self(left, right))
+
+
+class Join(object):
+
+    def __init__(self, kind, **options):
+        self.kind = kind
+        self.options = options
+
+    @staticmethod
+    def inner(primaryKey="primary", secondaryKey="secondary",
+              measureKey=None):
+        return Join("inner", primaryKey=primaryKey, secondaryKey=secondaryKey)
+
+    @staticmethod
+    def simple():
+        return Join("simple")
+
+    @staticmethod
+    def saveAll(matchesKey, ordering=None, ascending=True, measureKey=None,
+                outer=False):
+        return Join("saveAll", matchesKey=matchesKey, ordering=ordering,
+                    ascending=ascending, outer=outer)
+
+    @staticmethod
+    def saveFirst(matchKey, ordering=None, ascending=True, measureKey=None,
+                  outer=False):
+        return Join("saveFirst", matchesKey=matchKey, ordering=ordering,
+                    ascending=ascending, outer=outer)
+
+    def apply(self, primary, secondary, condition):
+        primary, secondary = _py(primary), _py(secondary)
+        out = []
+        for left in primary._elements:
+            matches = [right for right in secondary._elements
+                       if condition(left, right)]
+            if self.kind == "inner":
+                out.extend(Feature(None, {self.options["primaryKey"]: left,
+                                          self.options["secondaryKey"]: right})
+                           for right in matches)
+            elif self.kind == "simple":
+                if matches:
+                    out.append(left)
+            else:
+                if not matches and not self.options["outer"]:
+                    continue
+                if self.options["ordering"] is not None:
+                    matches = _sorted(matches, self.options["ordering"],
+                                      self.options["ascending"])
+                if self.kind == "saveFirst":
+                    matches = matches[0] if matches else None
+                out.append(left.set(self.options["matchesKey"], matches))
+        if self.kind == "inner":
+            return FeatureCollection(out)
+        return primary._make(out, primary._props)
+
+
+def _varargs(args):
+    if len(args) == 1 and isinstance(args[0], (list, tuple)):
+        return list(args[0])
+    return list(args)
+
+
+def _sorted(elements, prop, ascending=True):
+    prop = _py(prop)
+
+    def key(element):
+        value = _property(element, prop)
+        return (value is not None, value)
+    return sorted(elements, key=key, reverse=not _truthy(ascending))
+
+
+# ---------------------------------------------------------------------------
+# Geometries
+
+def _geometry(value):
+    value = _py(value)
+    if isinstance(value, Feature):
+        return value._geometry
+    if isinstance(value, FeatureCollection):
+        return value.geometry()
+    if value is None:
+        return None
+    return Geometry(value)
+
+
+class Geometry(ComputedObject):
+
+    def __init__(self, geo_json, opt_proj=None, opt_geodesic=None):
+        ComputedObject.__init__(self)
+        geo_json = _py(geo_json)
+        if isinstance(geo_json, Geometry):
+            geo_json = geo_json._value
+        elif hasattr(geo_json, "__geo_interface__"):
+            geo_json = geo_json.__geo_interface__
+        if not isinstance(geo_json, dict) or "type" not in geo_json:
+            raise EEException("Geometry: invalid GeoJSON {0!r}"
+                              .format(geo_json))
+        if geo_json["type"] == "Feature":
+            geo_json = geo_json["geometry"]
+        # Tuples to lists, as getInfo() returns them
+        self._value = json.loads(json.dumps(geo_json))
+        self._cached_shape = None
+
+    @staticmethod
+    def Polygon(coords, proj=None, geodesic=None, maxError=None,
+                evenOdd=None):
+        return Geometry({"type": "Polygon", "coordinates": _py(coords)})
+
+    @staticmethod
+    def Rectangle(coords, proj=None, geodesic=None, evenOdd=None):
+        coords = np.asarray(_py(coords), np.float64).ravel()
+        west, south, east, north = coords
+        return Geometry({"type": "Polygon", "coordinates": [[
+            [west, south], [east, south], [east, north], [west, north],
+            [west, south]]]})
+
+    @staticmethod
+    def Point(coords, proj=None):
+        return Geometry({"type": "Point", "coordinates": _py(coords)})
+
+    def _shape(self):
+        if self._cached_shape is None:
+            from shapely.geometry import shape
+
+            self._cached_shape = shape(self._value)
+        return self._cached_shape
+
+    @classmethod
+    def _from_shape(cls, geometry):
+        from shapely.geometry import mapping
+
+        return cls(mapping(geometry))
+
+    def _intersects(self, other):
+        return self._shape().intersects(other._shape())
+
+    def bounds(self, maxError=None, proj=None):
+        if self._shape().is_empty:
+            raise EEException("Geometry.bounds: the geometry is empty")
+        return Geometry.Rectangle(self._shape().bounds)
+
+    def simplify(self, maxError, proj=None):
+        from flood_detection.utils import slope
+
+        tolerance = float(_number(maxError)) / slope.METERS_PER_DEGREE
+        return Geometry._from_shape(self._shape().simplify(
+            tolerance, preserve_topology=True))
+
+    def union(self, right, maxError=None, proj=None):
+        return Geometry._from_shape(self._shape().union(
+            _geometry(right)._shape()))
+
+    def intersects(self, right, maxError=None, proj=None):
+        return Number(int(self._intersects(_geometry(right))))
+
+    def coordinates(self):
+        return List(self._value.get("coordinates", []))
+
+    def type(self):
+        return String(self._value["type"])
+
+    def _info(self):
+        return self._value
+
+
+# ---------------------------------------------------------------------------
+# Elements: images, features and collections
+
+class Element(ComputedObject):
+
+    def __init__(self):
+        ComputedObject.__init__(self)
+        self._props = OrderedDict()
+
+    # Shallow copy with its own properties, for set() and copyProperties()
+    def _copy(self):
+        out = self.__class__.__new__(self.__class__)
+        out.__dict__.update(self.__dict__)
+        out._props = OrderedDict(self._props)
+        return out
+
+    def get(self, property):
+        return _wrap(self._props.get(_py(property)))
+
+    def set(self, *args):
+        if len(args) == 1:
+            props = _py(args[0])
+        else:
+            props = OrderedDict([(args[0], args[1])])
+        out = self._copy()
+        out._props.update((str(k), _py(v)) for k, v in props.items())
+        return out
+
+    def copyProperties(self, source=None, properties=None, exclude=None):
+        source = _py(source)
+        names = _py(properties)
+        if names is None:
+            names = [k for k in source._props if not k.startswith("system:")]
+        exclude = _py(exclude) or []
+        out = self._copy()
+        for name in names:
+            if name in source._props and name not in exclude:
+                out._props[name] = source._props[name]
+        return out
+
+    def propertyNames(self):
+        return List(list(self._props))
+
+    def toDictionary(self, properties=None):
+        names = _py(properties) or [k for k in self._props
+                                    if not k.startswith("system:")]
+        return Dictionary(OrderedDict((k, self._props[k]) for k in names
+                                      if k in self._props))
+
+
+def _name_pattern(selector):
+    return re.compile("(?:{0})$".format(selector))
+
+
+def _data(band):
+    return np.ma.getdata(band)
+
+
+def _binary_band(fn, a, b):
+    with np.errstate(all="ignore"):
+        values = fn(_data(a), _data(b))
+    return np.ma.array(values, mask=np.ma.getmaskarray(a) |
+                       np.ma.getmaskarray(b))
+
+
+def _wide(values):
+    """Integers as int64 so sums and products don't overflow"""
+    return values.astype(np.int64) if values.dtype.kind in "uib" else values
+
+
+def _divide(a, b):
+    return np.where(b == 0, 0, np.true_divide(a, b))
+
+
+def _cast(band, dtype):
+    dtype = np.dtype(dtype)
+    values = np.ma.getdata(band)
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        with np.errstate(invalid="ignore"):
+            values = np.nan_to_num(values.astype(np.float64))
+            values = np.clip(np.trunc(values), info.min, info.max)
+    return np.ma.array(values.astype(dtype), mask=np.ma.getmaskarray(band))
+
+
+class Image(Element):
+
+    def __init__(self, args=None, version=None):
+        Element.__init__(self)
+        self._bands = OrderedDict()
+        self._footprint = None
+        if isinstance(args, ComputedObject) and not isinstance(args, Element):
+            if args._value is None:
+                raise EEException("Image: the value is null, e.g. first() "
+                                  "of an empty collection")
+            args = _py(args)
+        if args is None:
+            return
+        if isinstance(args, Image):
+            source = args
+        elif isinstance(args, _NUMBERS):
+            source = Image.constant(args)
+        elif isinstance(args, _STRINGS):
+            source = _current().load(args, "image")
+        elif isinstance(args, (list, tuple)):
+            source = Image.cat(*args)
+        else:
+            raise EEException("Image: can't make an image from {0!r}"
+                              .format(args))
+        self._bands = OrderedDict(source._bands)
+        self._props = OrderedDict(source._props)
+        self._footprint = source._footprint
+
+    @classmethod
+    def _make(cls, bands, properties=None, footprint=None):
+        image = cls()
+        image._bands = OrderedDict(bands)
+        image._props = OrderedDict(properties or {})
+        image._footprint = footprint
+        return image
+
+    def _copy(self):
+        return Image._make(self._bands, self._props, self._footprint)
+
+    def _with_bands(self, bands):
+        return Image._make(bands, self._props, self._footprint)
+
+    def _map_bands(self, fn):
+        return self._with_bands((name, fn(band))
+                                for name, band in self._bands.items())
+
+    def _intersects(self, geometry):
+        return self._footprint is None or self._footprint._intersects(geometry)
+
+    # ---- constructors
+
+    @staticmethod
+    def constant(value):
+        values = np.asarray(_py(value))
+        shape = _current().shape
+        if values.ndim == 0:
+            values = values[None]
+        return Image._make(
+            (("constant" if len(values) == 1 else "constant_{0}".format(i),
+              np.ma.array(np.full(shape, v, values.dtype)))
+             for i, v in enumerate(values)))
+
+    @staticmethod
+    def cat(*images):
+        out = OrderedDict()
+        first = None
+        for image in _varargs(images):
+            image = Image(image)
+            first = first or image
+            for name, band in image._bands.items():
+                out[_unique_name(out, name)] = band
+        if first is None:
+            return Image()
+        return first._with_bands(out)
+
+    @staticmethod
+    def pixelArea():
+        session = _current()
+        area = np.repeat(session.grid.pixel_area()[:, None], session.shape[1],
+                         axis=1)
+        return Image._make([("area", np.ma.array(area))])
+
+    # ---- bands
+
+    def bandNames(self):
+        return List(list(self._bands))
+
+    def _selected(self, selectors):
+        names = list(self._bands)
+        out = []
+        for selector in selectors:
+            selector = _py(selector)
+            if isinstance(selector, _NUMBERS):
+                if not -len(names) <= int(selector) < len(names):
+                    raise EEException("Image.select: band index {0} out of "
+                                      "range".format(selector))
+                out.append(names[int(selector)])
+                continue
+            matched = [n for n in names if _name_pattern(selector).match(n)]
+            if not matched:
+                raise EEException("Image.select: Pattern '{0}' did not match "
+                                  "any bands.".format(selector))
+            out.extend(matched)
+        return out
+
+    def select(self, *args, **kwargs):
+        selectors = kwargs.get("opt_selectors", kwargs.get("bandSelectors"))
+        names = kwargs.get("opt_names", kwargs.get("newNames"))
+        if selectors is None:
+            if len(args) == 2 and isinstance(args[0], (list, tuple, List)) \
+                    and isinstance(args[1], (list, tuple, List)):
+                selectors, names = args
+            else:
+                selectors = _varargs(args)
+        selectors = _py(selectors)
+        if not isinstance(selectors, list):
+            selectors = [selectors]
+        selected = self._selected(selectors)
+        if names is None:
+            return self._with_bands((n, self._bands[n]) for n in selected)
+        names = _py(names)
+        if len(names) != len(selected):
+            raise EEException("Image.select: {0} names for {1} bands"
+                              .format(len(names), len(selected)))
+        return self._with_bands((new, self._bands[old])
+                                for old, new in zip(selected, names))
+
+    def rename(self, *names):
+        names = _py(_varargs(names))
+        if len(names) != len(self._bands):
+            raise EEException("Image.rename: {0} names for {1} bands"
+                              .format(len(names), len(self._bands)))
+        return self._with_bands(zip(names, self._bands.values()))
+
+    def addBands(self, srcImg, names=None, overwrite=False):
+        source = Image(srcImg)
+        if names is not None:
+            source = source.select(names)
+        out = OrderedDict(self._bands)
+        for name, band in source._bands.items():
+            if not overwrite:
+                name = _unique_name(out, name)
+            out[name] = band
+        return self._with_bands(out)
+
+    # ---- pixel operations
+
+    def _binary(self, other, fn, dtype=None):
+        other = Image(other)
+        a, b = list(self._bands.items()), list(other._bands.items())
+        if len(b) == 1:
+            pairs = [(name, band, b[0][1]) for name, band in a]
+        elif len(a) == 1:
+            pairs = [(name, a[0][1], band) for name, band in b]
+        elif len(a) == len(b):
+            pairs = [(name, x, y) for (name, x), (_, y) in zip(a, b)]
+        else:
+            raise EEException("Image: can't combine {0} bands with {1} bands"
+                              .format(len(a), len(b)))
+        out = OrderedDict()
+        for name, x, y in pairs:
+            band = _binary_band(fn, x, y)
+            out[name] = band if dtype is None else band.astype(dtype)
+        footprint = self._footprint or other._footprint
+        return Image._make(out, self._props, footprint)
+
+    def add(self, image2):
+        return self._binary(image2, lambda a, b: _wide(a) + _wide(b))
+
+    def subtract(self, image2):
+        return self._binary(image2, lambda a, b: _wide(a) - _wide(b))
+
+    def multiply(self, image2):
+        return self._binary(image2, lambda a, b: _wide(a) * _wide(b))
+
+    # Division by zero is 0, as in Earth Engine
+    def divide(self, image2):
+        return self._binary(image2, _divide)
+
+    def pow(self, image2):
+        return self._binary(image2, lambda a, b: np.power(
+            a.astype(np.float64), b))
+
+    def min(self, image2):
+        return self._binary(image2, np.minimum)
+
+    def max(self, image2):
+        return self._binary(image2, np.maximum)
+
+    def lt(self, image2):
+        return self._binary(image2, np.less, np.uint8)
+
+    def lte(self, image2):
+        return self._binary(image2, np.less_equal, np.uint8)
+
+    def gt(self, image2):
+        return self._binary(image2, np.greater, np.uint8)
+
+    def gte(self, image2):
+        return self._binary(image2, np.greater_equal, np.uint8)
+
+    def eq(self, image2):
+        return self._binary(image2, np.equal, np.uint8)
+
+    def neq(self, image2):
+        return self._binary(image2, np.not_equal, np.uint8)
+
+    def And(self, image2):
+        return self._binary(image2, lambda a, b: (a != 0) & (b != 0),
+                            np.uint8)
+
+    def Or(self, image2):
+        return self._binary(image2, lambda a, b: (a != 0) | (b != 0),
+                            np.uint8)
+
+    def Not(self):
+        return self._map_bands(lambda band: (band == 0).astype(np.uint8))
+
+    def bitwiseAnd(self, image2):
+        return self._binary(image2, lambda a, b: a.astype(np.int64) &
+                            np.asarray(b).astype(np.int64))
+
+    def bitwiseOr(self, image2):
+        return self._binary(image2, lambda a, b: a.astype(np.int64) |
+                            np.asarray(b).astype(np.int64))
+
+    def rightShift(self, image2):
+        return self._binary(image2, lambda a, b: a.astype(np.int64) >>
+                            np.asarray(b).astype(np.int64))
+
+    def leftShift(self, image2):
+        return self._binary(image2, lambda a, b: a.astype(np.int64) <<
+                            np.asarray(b).astype(np.int64))
+
+    def abs(self):
+        return self._map_bands(np.ma.abs)
+
+    def ceil(self):
+        return self._map_bands(np.ma.ceil)
+
+    def floor(self):
+        return self._map_bands(np.ma.floor)
+
+    def round(self):
+        return self._map_bands(np.ma.round)
+
+    def remap(self, from_, to, defaultValue=None, bandName=None):
+        lookup = dict(zip(_py(from_), _py(to)))
+        band = self._bands[bandName or list(self._bands)[0]]
+        values = _data(band)
+        out = np.zeros(values.shape, np.asarray(list(lookup.values())).dtype)
+        matched = np.zeros(values.shape, bool)
+        for key, value in lookup.items():
+            hit = values == key
+            out[hit] = value
+            matched |= hit
+        if defaultValue is not None:
+            out[~matched] = _number(defaultValue)
+            matched[:] = True
+        return self._with_bands([("remapped", np.ma.array(
+            out, mask=np.ma.getmaskarray(band) | ~matched))])
+
+    def expression(self, expression, opt_map=None):
+        """Evaluate an expression of the repo's form, e.g.
+        "float(b('nir_250m') + 13.5) / float(b('red_250m') + 1081.1)" """
+        variables = {}
+
+        def band(match):
+            selector = match.group(1) or match.group(2)
+            if selector is None:
+                selector = int(match.group(3))
+            key = "_b{0}".format(len(variables))
+            variables[key] = self._bands[self._selected([selector])[0]]
+            return key
+        text = re.sub(r"b\(\s*(?:'([^']*)'|\"([^\"]*)\"|(\d+))\s*\)", band,
+                      _py(expression))
+        for name, value in (_py(opt_map) or {}).items():
+            value = Image(value)
+            variables[name] = list(value._bands.values())[0]
+        # || and && bind looser than the comparisons, unlike | and &
+        text = " | ".join(
+            "(" + " & ".join("(" + t + ")" for t in part.split("&&")) + ")"
+            for part in text.split("||"))
+        namespace = {"__builtins__": {},
+                     "float": lambda x: np.ma.asarray(x).astype(np.float64),
+                     "int": lambda x: np.ma.asarray(x).astype(np.int64),
+                     "abs": np.ma.abs, "sqrt": np.ma.sqrt, "exp": np.ma.exp,
+                     "log": np.ma.log, "min": np.ma.minimum,
+                     "max": np.ma.maximum}
+        namespace.update(variables)
+        with np.errstate(all="ignore"):
+            try:
+                value = eval(text, namespace)
+            except Exception as e:
+                raise EEException("Image.expression: {0} in {1!r}"
+                                  .format(e, expression))
+        value = np.ma.asarray(value)
+        if value.ndim == 0:
+            value = np.ma.array(np.full(_current().shape, value))
+        if value.dtype == bool:
+            value = value.astype(np.uint8)
+        return self._with_bands([("constant", value)])
+
+    # ---- types
+
+    def toFloat(self):
+        return self._map_bands(lambda band: _cast(band, np.float32))
+
+    def toDouble(self):
+        return self._map_bands(lambda band: _cast(band, np.float64))
+
+    def toByte(self):
+        return self._map_bands(lambda band: _cast(band, np.uint8))
+
+    byte = toUint8 = uint8 = toByte
+
+    def toUint16(self):
+        return self._map_bands(lambda band: _cast(band, np.uint16))
+
+    uint16 = toUint16
+
+    def toInt8(self):
+        return self._map_bands(lambda band: _cast(band, np.int8))
+
+    int8 = toInt8
+
+    def toInt16(self):
+        return self._map_bands(lambda band: _cast(band, np.int16))
+
+    int16 = toInt16
+
+    def toInt(self):
+        return self._map_bands(lambda band: _cast(band, np.int32))
+
+    int = toInt32 = int32 = toInt
+
+    def toInt64(self):
+        return self._map_bands(lambda band: _cast(band, np.int64))
+
+    # ---- masks
+
+    def _mask_values(self, mask):
+        mask = Image(mask)
+        bands = list(mask._bands.values())
+        if len(bands) == 1:
+            bands = bands * len(self._bands)
+        elif len(bands) != len(self._bands):
+            raise EEException("Image.updateMask: {0} mask bands for {1} bands"
+                              .format(len(bands), len(self._bands)))
+        return [~np.ma.getmaskarray(m) & (np.ma.getdata(m) != 0)
+                for m in bands]
+
+    def updateMask(self, mask):
+        valid = self._mask_values(mask)
+        return self._with_bands(
+            (name, np.ma.array(_data(band), mask=np.ma.getmaskarray(band) |
+                               ~v))
+            for (name, band), v in zip(self._bands.items(), valid))
+
+    def mask(self, mask=None):
+        if mask is None:
+            return self._map_bands(lambda band: np.ma.array(
+                (~np.ma.getmaskarray(band)).astype(np.uint8)))
+        # Setting the mask replaces it, masked pixels read as 0
+        valid = self._mask_values(mask)
+        return self._with_bands(
+            (name, np.ma.array(band.filled(0), mask=~v))
+            for (name, band), v in zip(self._bands.items(), valid))
+
+    def selfMask(self):
+        return self.updateMask(self)
+
+    def unmask(self, value=None, sameFootprint=True):
+        fill = 0 if value is None else _py(value)
+        if isinstance(fill, Image):
+            fill_bands = list(fill._bands.values())
+            if len(fill_bands) == 1:
+                fill_bands = fill_bands * len(self._bands)
+            return self._with_bands(
+                (name, np.ma.array(np.where(np.ma.getmaskarray(band),
+                                            _data(f), _data(band))))
+                for (name, band), f in zip(self._bands.items(), fill_bands))
+        return self._map_bands(lambda band: np.ma.array(band.filled(fill)))
+
+    def _region_mask(self, geometry=None):
+        geometry = _geometry(geometry) if geometry is not None \
+            else self._footprint
+        if geometry is None:
+            return np.ones(_current().shape, bool)
+        return _current().geometry_mask(geometry)
+
+    def clip(self, geometry):
+        geometry = _geometry(geometry)
+        inside = _current().geometry_mask(geometry)
+        return Image._make(
+            ((name, np.ma.array(_data(band),
+                                mask=np.ma.getmaskarray(band) | ~inside))
+             for name, band in self._bands.items()),
+            self._props, geometry)
+
+    def paint(self, featureCollection, color=0, width=None):
+        if width is not None:
+            raise EEException("Image.paint: outlines ('width') are not "
+                              "supported offline")
+        features = FeatureCollection(featureCollection)._elements
+        color = _py(color)
+        bands = OrderedDict((name, np.ma.array(_data(band).copy(),
+                                               mask=np.ma.getmaskarray(band)))
+                            for name, band in self._bands.items())
+        for ft in features:
+            if ft._geometry is None:
+                continue
+            inside = _current().geometry_mask(ft._geometry)
+            value = ft._props.get(color) if isinstance(color, _STRINGS) \
+                else color
+            for band in bands.values():
+                band.data[inside] = value
+                band.mask[inside] = False
+        return self._with_bands(bands)
+
+    # ---- reductions
+
+    def reduce(self, reducer):
+        if not self._bands:
+            return self._with_bands([])
+        stack = np.ma.array([_data(b) for b in self._bands.values()],
+                            mask=[np.ma.getmaskarray(b)
+                                  for b in self._bands.values()])
+        return self._with_bands([(reducer.name, reducer._stack(stack))])
+
+    def reduceRegion(self, reducer, geometry=None, scale=None, crs=None,
+                     crsTransform=None, bestEffort=False, maxPixels=None,
+                     tileScale=1):
+        inside = self._region_mask(geometry)
+        out = OrderedDict()
+        for name, band in self._bands.items():
+            valid = inside & ~np.ma.getmaskarray(band)
+            out[name] = reducer._apply(_data(band)[valid])
+        return Dictionary(out)
+
+    def stratifiedSample(self, numPoints, classBand=None, region=None,
+                         scale=None, projection=None, seed=0,
+                         classValues=None, classPoints=None, dropNulls=True,
+                         tileScale=1, geometries=False):
+        names = list(self._bands)
+        classes = self._bands[classBand or names[0]]
+        valid = ~np.ma.getmaskarray(classes) & self._region_mask(region)
+        if dropNulls:
+            for band in self._bands.values():
+                valid &= ~np.ma.getmaskarray(band)
+        rows, cols = np.nonzero(valid)
+        values = _data(classes)[rows, cols]
+        points = dict(zip(_py(classValues) or [], _py(classPoints) or []))
+        rng = np.random.RandomState(int(_number(seed)))
+        grid = _current().grid
+        features = []
+        for value in np.unique(values):
+            index = np.nonzero(values == value)[0]
+            n = int(_number(points.get(value.item(), numPoints)))
+            if len(index) > n:
+                index = np.sort(rng.choice(index, n, replace=False))
+            for i in index:
+                props = OrderedDict(
+                    (name, _number(_data(band)[rows[i], cols[i]]))
+                    for name, band in self._bands.items())
+                geometry = None
+                if geometries:
+                    geometry = Geometry.Point(
+                        [grid.west + (cols[i] + 0.5) * grid.pixel_width,
+                         grid.north - (rows[i] + 0.5) * grid.pixel_height])
+                features.append(Feature(geometry, props))
+        return FeatureCollection(features)
+
+    # ---- projection and geometry
+
+    def projection(self):
+        return Projection("EPSG:4326")
+
+    def reproject(self, crs, crsTransform=None, scale=None):
+        return self
+
+    def resample(self, mode="bilinear"):
+        return self
+
+    def geometry(self, maxError=None, proj=None, geodesics=None):
+        if self._footprint is not None:
+            return self._footprint
+        return Geometry.Rectangle(_current().bounds())
+
+    def _info(self):
+        bands = []
+        for name, band in self._bands.items():
+            kind = band.dtype.kind
+            precision = "int" if kind in "uib" else \
+                ("float" if band.dtype.itemsize <= 4 else "double")
+            bands.append(OrderedDict([("id", name), ("data_type", OrderedDict(
+                [("type", "PixelType"), ("precision", precision)]))]))
+        info = OrderedDict([("type", "Image"), ("bands", bands)])
+        if "system:id" in self._props:
+            info["id"] = self._props["system:id"]
+        info["properties"] = _info(self._props)
+        return info
+
+
+def _unique_name(bands, name):
+    if name not in bands:
+        return name
+    i = 1
+    while "{0}_{1}".format(name, i) in bands:
+        i += 1
+    return "{0}_{1}".format(name, i)
+
+
+class Projection(ComputedObject):
+
+    def __init__(self, crs="EPSG:4326", transform=None, transformWkt=None):
+        ComputedObject.__init__(self, {"crs": _py(crs)})
+
+    def atScale(self, meters):
+        return self
+
+    def nominalScale(self):
+        return Number(SCALE)
+
+
+class Feature(Element):
+
+    def __init__(self, geom=None, opt_properties=None):
+        Element.__init__(self)
+        self._geometry = None
+        geom = _py(geom)
+        if isinstance(geom, Feature):
+            self._geometry = geom._geometry
+            self._props = OrderedDict(geom._props)
+        elif isinstance(geom, dict) and geom.get("type") == "Feature":
+            if geom.get("geometry") is not None:
+                self._geometry = Geometry(geom["geometry"])
+            self._props = OrderedDict(geom.get("properties") or {})
+            if geom.get("id") is not None:
+                self._props.setdefault("system:index", str(geom["id"]))
+        elif geom is not None:
+            self._geometry = _geometry(geom)
+        if opt_properties is not None:
+            self._props.update((str(k), _py(v))
+                               for k, v in _py(opt_properties).items())
+
+    def _copy(self):
+        return Feature(self)
+
+    def geometry(self, maxError=None, proj=None, geodesics=None):
+        return self._geometry
+
+    def setGeometry(self, geometry=None):
+        out = self._copy()
+        out._geometry = _geometry(geometry)
+        return out
+
+    def simplify(self, maxError, proj=None):
+        out = self._copy()
+        if out._geometry is not None:
+            out._geometry = out._geometry.simplify(maxError)
+        return out
+
+    def bounds(self, maxError=None, proj=None):
+        return self.setGeometry(self._geometry.bounds())
+
+    def _intersects(self, geometry):
+        return self._geometry is not None and \
+            self._geometry._intersects(geometry)
+
+    def _info(self):
+        info = OrderedDict([("type", "Feature"),
+                            ("geometry", None if self._geometry is None
+                             else self._geometry._info())])
+        if "system:index" in self._props:
+            info["id"] = self._props["system:index"]
+        info["properties"] = _info(OrderedDict(
+            (k, v) for k, v in self._props.items()
+            if not k.startswith("system:")))
+        return info
+
+
+class Collection(Element):
+
+    _type = "Collection"
+
+    def __init__(self):
+        Element.__init__(self)
+        self._elements = []
+
+    @classmethod
+    def _make(cls, elements, properties=None):
+        collection = cls.__new__(cls)
+        Collection.__init__(collection)
+        collection._elements = list(elements)
+        collection._props = OrderedDict(properties or {})
+        return collection
+
+    def _copy(self):
+        return self._make(self._elements, self._props)
+
+    # ---- filtering and sorting
+
+    def filter(self, filter):
+        return self._make([e for e in self._elements if filter(e)],
+                          self._props)
+
+    def filterMetadata(self, name, operator, value):
+        return self.filter(Filter.metadata(name, operator, value))
+
+    def filterDate(self, start, opt_end=None):
+        start = _py(start)
+        if isinstance(start, DateRange):
+            start, opt_end = start.start(), start.end()
+        return self.filter(Filter.date(start, opt_end))
+
+    def filterBounds(self, geometry):
+        return self.filter(Filter.bounds(geometry))
+
+    def sort(self, prop, opt_ascending=True):
+        return self._make(_sorted(self._elements, prop, opt_ascending),
+                          self._props)
+
+    def limit(self, maximum, opt_property=None, opt_ascending=True):
+        elements = self._elements
+        if opt_property is not None:
+            elements = _sorted(elements, opt_property, opt_ascending)
+        return self._make(elements[:int(_number(maximum))], self._props)
+
+    def distinct(self, properties):
+        names = _py(properties)
+        names = [names] if isinstance(names, _STRINGS) else names
+        seen = set()
+        out = []
+        for element in self._elements:
+            key = json.dumps([_info(element._props.get(n)) for n in names],
+                             default=str)
+            if key not in seen:
+                seen.add(key)
+                out.append(element)
+        return self._make(out, self._props)
+
+    def merge(self, collection2):
+        return self._make(self._elements + _py(collection2)._elements,
+                          self._props)
+
+    # ---- mapping and iteration
+
+    def map(self, algorithm, opt_dropNulls=False):
+        out = [_py(algorithm(element)) for element in self._elements]
+        if opt_dropNulls:
+            out = [element for element in out if element is not None]
+        return self._make(out, self._props)
+
+    def iterate(self, algorithm, first=None):
+        result = first
+        for element in self._elements:
+            result = algorithm(element, _wrap(result))
+        return _wrap(_py(result))
+
+    def flatten(self):
+        return FeatureCollection._make(
+            [ft for c in self._elements for ft in _py(c)._elements],
+            self._props)
+
+    # ---- accessors and aggregates
+
+    def first(self):
+        if not self._elements:
+            return ComputedObject(None)
+        return self._elements[0]
+
+    def size(self):
+        return Number(len(self._elements))
+
+    def toList(self, count, offset=0):
+        offset = int(_number(offset))
+        return List(self._elements[offset:offset + int(_number(count))])
+
+    def aggregate_array(self, property):
+        property = _py(property)
+        return List([_property(e, property) for e in self._elements
+                     if _property(e, property) is not None])
+
+    def _aggregate(self, property, reducer):
+        values = _py(self.aggregate_array(property))
+        return _wrap(reducer._apply(values))
+
+    def aggregate_max(self, property):
+        return self._aggregate(property, Reducer.max())
+
+    def aggregate_min(self, property):
+        return self._aggregate(property, Reducer.min())
+
+    def aggregate_sum(self, property):
+        return self._aggregate(property, Reducer.sum())
+
+    def aggregate_mean(self, property):
+        return self._aggregate(property, Reducer.mean())
+
+    def aggregate_count(self, property):
+        return self._aggregate(property, Reducer.count())
+
+    def reduceColumns(self, reducer, selectors, weightSelectors=None):
+        name = _py(selectors)[0]
+        values = [_property(e, name) for e in self._elements]
+        values = [v for v in values if v is not None]
+        return Dictionary({reducer.name: reducer._apply(values)})
+
+    def _info(self):
+        return OrderedDict([("type", self._type),
+                            ("features", [_info(e) for e in self._elements]),
+                            ("properties", _info(self._props))])
+
+
+class ImageCollection(Collection):
+
+    _type = "ImageCollection"
+
+    def __init__(self, args=None):
+        Collection.__init__(self)
+        args = _py(args)
+        if args is None:
+            return
+        if isinstance(args, _STRINGS):
+            self._elements = list(_current().load(args, "collection"))
+        elif isinstance(args, Collection):
+            self._elements = list(args._elements)
+            self._props = OrderedDict(args._props)
+        elif isinstance(args, Image):
+            self._elements = [args]
+        elif isinstance(args, (list, tuple)):
+            self._elements = [Image(image) for image in args]
+        else:
+            raise EEException("ImageCollection: can't make a collection from "
+                              "{0!r}".format(args))
+
+    @staticmethod
+    def fromImages(images):
+        return ImageCollection(_py(images))
+
+    def select(self, *args, **kwargs):
+        return self.map(lambda image: image.select(*args, **kwargs))
+
+    def _reduce(self, reducer, suffix=False):
+        names = []
+        for image in self._elements:
+            names.extend(n for n in image._bands if n not in names)
+        shape = _current().shape
+        out = OrderedDict()
+        for name in names:
+            bands = [image._bands.get(name) for image in self._elements]
+            dtypes = [b.dtype for b in bands if b is not None]
+            stack = np.ma.array(
+                [_data(b) if b is not None else np.zeros(shape, dtypes[0])
+                 for b in bands],
+                mask=[np.ma.getmaskarray(b) if b is not None
+                      else np.ones(shape, bool) for b in bands])
+            key = "{0}_{1}".format(name, reducer.name) if suffix else name
+            out[key] = reducer._stack(stack)
+        return Image._make(out)
+
+    def sum(self):
+        return self._reduce(Reducer.sum())
+
+    def mean(self):
+        return self._reduce(Reducer.mean())
+
+    def median(self):
+        return self._reduce(Reducer.median())
+
+    def min(self):
+        return self._reduce(Reducer.min())
+
+    def max(self):
+        return self._reduce(Reducer.max())
+
+    def count(self):
+        return self._reduce(Reducer.count())
+
+    def mosaic(self):
+        return ImageCollection._make(self._elements[::-1])._reduce(
+            Reducer.first())
+
+    def reduce(self, reducer, parallelScale=1):
+        return self._reduce(reducer, suffix=True)
+
+
+class FeatureCollection(Collection):
+
+    _type = "FeatureCollection"
+
+    def __init__(self, args=None, opt_column=None):
+        Collection.__init__(self)
+        args = _py(args)
+        if args is None:
+            return
+        if isinstance(args, _STRINGS):
+            self._elements = list(_current().load(args, "table"))
+        elif isinstance(args, Collection):
+            self._elements = list(args._elements)
+            self._props = OrderedDict(args._props)
+        elif isinstance(args, (Feature, Geometry)):
+            self._elements = [Feature(args)]
+        elif isinstance(args, dict) and \
+                args.get("type") == "FeatureCollection":
+            self._elements = [Feature(ft) for ft in args["features"]]
+        elif isinstance(args, (list, tuple)):
+            self._elements = [ft if isinstance(ft, Feature) else Feature(ft)
+                              for ft in args]
+        else:
+            raise EEException("FeatureCollection: can't make a collection "
+                              "from {0!r}".format(args))
+
+    def geometry(self, maxError=None):
+        from shapely.ops import unary_union
+
+        shapes = [ft._geometry._shape() for ft in self._elements
+                  if getattr(ft, "_geometry", None) is not None]
+        return Geometry._from_shape(unary_union(shapes))
+
+    def union(self, maxError=None):
+        return FeatureCollection([Feature(self.geometry())])
+
+
+# ---------------------------------------------------------------------------
+# ee.Algorithms and ee.Terrain
+
+class Algorithms(object):
+
+    @staticmethod
+    def If(condition=None, trueCase=None, falseCase=None):
+        return _wrap(trueCase if _truthy(condition) else falseCase)
+
+
+class Terrain(object):
+
+    @staticmethod
+    def slope(input):
+        from flood_detection.utils import slope
+
+        dem = list(Image(input)._bands.values())[0]
+        values = slope.grid_slope_degrees(dem.filled(0),
+                                          _current().window[0])
+        return Image._make([("slope", np.ma.array(
+            values, mask=np.ma.getmaskarray(dem)))])
+
+
+# ---------------------------------------------------------------------------
+# ee.data and ee.batch
+
+def _compute_value(obj):
+    return _current().compute(obj)
+
+
+def _start_processing(task_id, params):
+    session = _current()
+    with session.lock:
+        session.round_trips += 1
+        task = session.tasks[task_id]
+    task._run()
+    return {"taskId": task_id, "started": "OK"}
+
+
+def _get_task_status(task_ids):
+    session = _current()
+    with session.lock:
+        session.round_trips += 1
+    if isinstance(task_ids, _STRINGS):
+        task_ids = [task_ids]
+    return [session.tasks[i]._status() for i in task_ids]
+
+
+data = types.ModuleType("ee.data")
+data.computeValue = _compute_value
+data.startProcessing = _start_processing
+data.getTaskStatus = _get_task_status
+
+
+class Task(object):
+
+    def __init__(self, task_type, description, run):
+        session = _current()
+        with session.lock:
+            self.id = "OFFLINE{0:06d}".format(len(session.tasks) + 1)
+            session.tasks[self.id] = self
+        self.task_type = task_type
+        self.config = {"description": description}
+        self.state = "UNSUBMITTED"
+        self.error_message = None
+        self._export = run
+
+    def _run(self):
+        try:
+            self._export()
+            self.state = "COMPLETED"
+        except Exception as e:
+            self.state = "FAILED"
+            self.error_message = str(e)
+
+    def _status(self):
+        status = {"id": self.id, "state": self.state,
+                  "task_type": self.task_type,
+                  "description": self.config["description"]}
+        if self.error_message is not None:
+            status["error_message"] = self.error_message
+        return status
+
+    def start(self):
+        data.startProcessing(self.id, self.config)
+
+    def status(self):
+        return data.getTaskStatus(self.id)[0]
+
+    def active(self):
+        return self.state in ("READY", "RUNNING")
+
+
+def _region(region):
+    if region is None:
+        return None
+    region = _py(region)
+    if isinstance(region, (list, tuple)):
+        return Geometry.Polygon(region)
+    return _geometry(region)
+
+
+class _ImageExport(object):
+
+    @staticmethod
+    def toAsset(image, description="myExportImageTask", assetId=None,
+                pyramidingPolicy=None, dimensions=None, region=None,
+                scale=None, crs=None, crsTransform=None, maxPixels=None,
+                **kwargs):
+        session = _current()
+        region = _region(region)
+
+        def run():
+            session.write_image(session.asset_path(assetId, ".npz"),
+                                Image(image), region)
+        return Task("EXPORT_IMAGE", description, run)
+
+    @staticmethod
+    def toCloudStorage(image, description="myExportImageTask", bucket=None,
+                       fileNamePrefix=None, dimensions=None, region=None,
+                       scale=None, crs=None, crsTransform=None,
+                       maxPixels=None, **kwargs):
+        session = _current()
+        region = _region(region)
+        path = os.path.join(session.root, "gcs", bucket,
+                            (fileNamePrefix or description) + ".npz")
+        return Task("EXPORT_IMAGE", description,
+                    lambda: session.write_image(path, Image(image), region))
+
+
+class _TableExport(object):
+
+    @staticmethod
+    def toCloudStorage(collection, description="myExportTableTask",
+                       bucket=None, fileNamePrefix=None, fileFormat=None,
+                       selectors=None, **kwargs):
+        session = _current()
+        if fileFormat is not None and str(fileFormat).upper() != "CSV":
+            raise EEException("Export.table: only CSV is supported offline")
+        path = os.path.join(session.root, "gcs", bucket,
+                            (fileNamePrefix or description) + ".csv")
+        return Task("EXPORT_FEATURES", description,
+                    lambda: session.write_table(
+                        path, FeatureCollection(collection), _py(selectors)))
+
+    @staticmethod
+    def toAsset(collection, description="myExportTableTask", assetId=None,
+                **kwargs):
+        session = _current()
+
+        def run():
+            path = session.asset_path(assetId, ".geojson")
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path + ".tmp", "w") as f:
+                json.dump(FeatureCollection(collection)._info(), f)
+            os.rename(path + ".tmp", path)
+        return Task("EXPORT_FEATURES", description, run)
+
+
+class Export(object):
+    image = _ImageExport
+    table = _TableExport
+
+
+batch = types.ModuleType("ee.batch")
+batch.Export = Export
+batch.Task = Task
+
+
+def Initialize(*args, **kwargs):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# Installing the stand-in
+
+def install(session):
+    """
+    Use this module as the ee package (sys.modules['ee']) with 'session' as
+    the data. Call before importing the modules that import ee.
+    """
+    global _session, _previous_modules
+    _session = session
+    if _previous_modules is None:
+        _previous_modules = dict((name, sys.modules.get(name))
+                                 for name in ["ee", "ee.data", "ee.batch"])
+    sys.modules["ee"] = sys.modules[__name__]
+    sys.modules["ee.data"] = data
+    sys.modules["ee.batch"] = batch
+    return session
+
+
+def uninstall():
+    """Put back the modules install() replaced"""
+    global _session, _previous_modules
+    if _previous_modules is not None:
+        for name, module in _previous_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    _session = None
+    _previous_modules = None
+
+
+def run_script(path, session):
+    """Run a script (e.g. main_gfd.py) as __main__ against 'session'"""
+    install(session)
+    try:
+        return runpy.run_path(path, run_name="__main__")
+    finally:
+        uninstall()
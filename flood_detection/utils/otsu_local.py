@@ -0,0 +1,99 @@
+# coding: utf-8
+
+# Local (NumPy) Otsu thresholding for many histograms at once.
+#
+# otsu.get_threshold() maps calc_bss over every split index, re-slicing and
+# re-reducing the histogram each time. Here the between sum of squares for all
+# splits comes from cumulative sums, and a whole batch of histograms (events x
+# bands) is handled as 2-D arrays in one call.
+import numpy as np
+
+
+# Division that returns 0 where the denominator is 0, same as ee.Number.divide
+def _divide(a, b):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.true_divide(a, b)
+    return np.where(b == 0, 0.0, out)
+
+
+# Compute between sum of squares for every split of every histogram.
+#   counts, means - (n_histograms, n_buckets) arrays of bucket counts and
+#                   bucket means, shorter histograms padded with zero counts
+#   lengths - optional number of real buckets in each histogram
+# Split i (0-based) puts buckets 0..i in the first class, same as
+# calc_bss(i + 1) in otsu.get_threshold().
+def between_sum_squares(counts, means, lengths=None):
+    counts = np.atleast_2d(np.asarray(counts, np.float64))
+    means = np.atleast_2d(np.asarray(means, np.float64))
+
+    total = counts.sum(axis=1, keepdims=True)
+    summed = (means * counts).sum(axis=1, keepdims=True)
+    mean = _divide(summed, total)
+
+    a_count = np.cumsum(counts, axis=1)
+    a_mean = _divide(np.cumsum(means * counts, axis=1), a_count)
+    b_count = total - a_count
+    b_mean = _divide(summed - a_count * a_mean, b_count)
+    bss = a_count * (a_mean - mean) ** 2 + b_count * (b_mean - mean) ** 2
+
+    # A split that ends on an empty bucket has the same classes as the split
+    # before it. Copy the BSS over so these tie exactly, as they do in EE, and
+    # are not decided by rounding in the cumulative sums.
+    k = np.arange(counts.shape[1])[None, :]
+    last = np.maximum.accumulate(np.where((counts > 0) | (k == 0), k, 0), axis=1)
+    bss = np.take_along_axis(bss, last, axis=1)
+
+    if lengths is not None:
+        valid = np.arange(counts.shape[1])[None, :] < np.asarray(lengths)[:, None]
+        bss = np.where(valid, bss, -np.inf)
+    return bss
+
+
+# Return the bucket mean corresponding to the maximum BSS for each histogram.
+# Ties go to the last bucket, like sorting the means by BSS in
+# otsu.get_threshold() and taking the last one.
+def get_thresholds(counts, means, lengths=None):
+    means = np.atleast_2d(np.asarray(means, np.float64))
+    bss = between_sum_squares(counts, means, lengths)
+    n = bss.shape[1]
+    best = n - 1 - np.argmax(bss[:, ::-1], axis=1)
+    return means[np.arange(means.shape[0]), best]
+
+
+# Stack histograms as returned by ee.Reducer.histogram().getInfo() (dicts with
+# 'histogram' and 'bucketMeans') into padded 2-D arrays
+def stack_histograms(histograms):
+    lengths = np.array([len(h["histogram"]) for h in histograms])
+    counts = np.zeros((len(histograms), lengths.max()))
+    means = np.zeros((len(histograms), lengths.max()))
+    for i, h in enumerate(histograms):
+        counts[i, :lengths[i]] = h["histogram"]
+        means[i, :lengths[i]] = h["bucketMeans"]
+    return counts, means, lengths
+
+
+# Same as otsu.get_threshold() for a list of histogram dictionaries
+def get_threshold(histograms):
+    if isinstance(histograms, dict):
+        return get_thresholds(*stack_histograms([histograms]))[0]
+    return get_thresholds(*stack_histograms(histograms))
+
+
+# Build a histogram of 'values' in the same dictionary format as
+# ee.Reducer.histogram(), using equal width buckets between the min and max
+def histogram(values, max_buckets=255):
+    values = np.asarray(values, np.float64)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return {"histogram": [], "bucketMeans": [], "bucketMin": 0,
+                "bucketWidth": 0}
+    lo, hi = values.min(), values.max()
+    width = (hi - lo) / max_buckets if hi > lo else 1.0
+    idx = np.minimum(((values - lo) / width).astype(np.int64), max_buckets - 1)
+    counts = np.bincount(idx, minlength=max_buckets).astype(np.float64)
+    sums = np.bincount(idx, weights=values, minlength=max_buckets)
+    bucket_means = _divide(sums, counts)
+    empty = counts == 0
+    bucket_means[empty] = lo + (np.arange(max_buckets)[empty] + 0.5) * width
+    return {"histogram": counts.tolist(), "bucketMeans": bucket_means.tolist(),
+            "bucketMin": lo, "bucketWidth": width}
@@ -0,0 +1,85 @@
+# MODIS state_1km QA bit layout and lookup table decoder
+#
+# QA Band information is available at:
+# http://modis-sr.ltdri.org/guide/MOD09_UserGuide_v1_3.pdf
+# Table 16: 1-kilometer State QA Descriptions (16-bit)
+#
+# QA_BITS is the one definition of the bits we use, modis_toolbox builds the
+# Earth Engine QA bands from it and the local engine decodes with QA_LUT, a
+# 65,536 entry table from every state_1km value to a packed byte:
+#
+#   bits 0-1: cloud_state  ==> 0: "clear", 1: "cloudy", 2: "mixed", 3: "not set"
+#   bit 2:    cloud_shadow ==> 0: "no", 1: "yes"
+#   bit 3:    ice_flag     ==> 0: "no", 1: "yes"
+#   bit 4:    snow_flag    ==> 0: "no snow", 1: "snow"
+#   bit 5:    mask         ==> 1 where qa_mask() removes the pixel
+#   bit 7:    no data (only set by decode() for masked pixels)
+#
+# so decoding and masking a whole stack is a single gather per pixel.
+
+import numpy as np
+
+# (band name, first bit, last bit) in state_1km
+QA_BITS = [("cloud_state", 0, 1),
+           ("cloud_shadow", 2, 2),
+           ("ice_flag", 12, 12),
+           ("snow_flag", 15, 15)]
+
+# QA values that are masked out by qa_mask(): cloudy or mixed, cloud shadow,
+# ice and snow
+MASK_VALUES = {"cloud_state": [1, 2],
+               "cloud_shadow": [1],
+               "ice_flag": [1],
+               "snow_flag": [1]}
+
+# Position of each field in the packed byte
+PACKED_SHIFT = {"cloud_state": 0, "cloud_shadow": 2, "ice_flag": 3,
+                "snow_flag": 4, "mask": 5}
+NO_DATA = 0x80
+
+
+# Integer with bits start to end (inclusive) set
+def bit_pattern(start, end):
+    pattern = 0
+    for i in range(start, end + 1):
+        pattern += pow(2, i)
+    return pattern
+
+
+def build_lut():
+    state = np.arange(65536, dtype=np.uint32)
+    packed = np.zeros(65536, np.uint8)
+    mask = np.zeros(65536, bool)
+    for name, start, end in QA_BITS:
+        value = (state & bit_pattern(start, end)) >> start
+        packed |= (value << PACKED_SHIFT[name]).astype(np.uint8)
+        mask |= np.isin(value, MASK_VALUES[name])
+    packed |= (mask.astype(np.uint8) << PACKED_SHIFT["mask"])
+    return packed
+
+QA_LUT = build_lut()
+
+
+# Decode a state_1km array to packed QA bytes with one table lookup. NaN
+# (masked) pixels get the NO_DATA byte.
+def decode(state):
+    state = np.asarray(state)
+    if state.dtype.kind == "f":
+        valid = np.isfinite(state)
+        packed = QA_LUT[np.where(valid, state, 0).astype(np.uint16)]
+        packed[~valid] = NO_DATA
+        return packed
+    return QA_LUT[state.astype(np.uint16)]
+
+
+# Get one field from packed QA bytes as float32, NaN where there is no data
+def unpack(packed, name):
+    width = 2 if name == "cloud_state" else 1
+    value = ((packed >> PACKED_SHIFT[name]) & (2 ** width - 1)).astype(np.float32)
+    value[(packed & NO_DATA) > 0] = np.nan
+    return value
+
+
+# True where the pixel is clear of clouds, shadow, ice and snow and has data
+def clear(packed):
+    return (packed & (NO_DATA | (1 << PACKED_SHIFT["mask"]))) == 0
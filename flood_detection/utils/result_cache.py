@@ -0,0 +1,236 @@
+# Cache of the DFO results and intermediate products of an event, for the
+# local engine (modis_local.py)
+#
+# The validation study maps every event four times: 'standard' and 'otsu'
+# thresholds with 2 and 3-day composites. Each run of dfo() preprocesses the
+# stack, computes the Otsu thresholds and thresholds every image again, while
+# only the compositing at the end differs between methods. EventResults keeps
+# each product keyed by a hash of the inputs it depends on:
+#
+#   thresholds  - event, roi, threshold type, strata, seed
+#   flags       - event, roi, thresholds (the per-image water flags)
+#   clear       - event, roi (clear views and percent clear views)
+#   dfo         - all of the above, composite, slope threshold and classes
+#
+# where the event is (DFO ID, source of the stack, stack version or digest,
+# image dates, began, ended). Products are
+# computed once, kept in memory for the other methods and stored under 'root',
+# so the four methods cost one preprocessing pass and four composites, and a
+# rerun reads the results back:
+#
+#     results = EventResults(ResultCache("cache/results"), 4098, "h26v06",
+#                            stack, dates, began, ended, roi_mask, strata)
+#     for threshold in ["standard", "otsu"]:
+#         for my_comp in ["2Day", "3Day"]:
+#             flood_map = results.dfo(threshold, my_comp)
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from flood_detection import modis_local
+from flood_detection.utils import slope, tiled_raster
+
+# Bump when modis_local changes the results, so old entries are not read again
+CODE_VERSION = 1
+
+
+def array_digest(array):
+    """Stable hash of an array, '' for None"""
+    if array is None:
+        return ""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str((array.dtype.str, array.shape)).encode("utf-8"))
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def input_key(kind, inputs):
+    """Hash of a product kind and its inputs (JSON serializable)"""
+    key = json.dumps([kind, CODE_VERSION, inputs], sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Products stored under 'root' as <kind>/<key>.npz
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, kind, key):
+        return os.path.join(self.root, kind, key + ".npz")
+
+    def has(self, kind, key):
+        return os.path.exists(self._path(kind, key))
+
+    def get(self, kind, key):
+        """Dictionary of the stored arrays, None if there is no entry"""
+        path = self._path(kind, key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return dict((name, f[name]) for name in f.files)
+
+    def put(self, kind, key, arrays):
+        path = self._path(kind, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.rename(tmp, path)
+
+
+class EventResults(object):
+    """
+    DFO results of one event for any threshold type, composite and slope
+    threshold, sharing the intermediate products.
+
+    Args:
+        cache: ResultCache
+        dfo_id: event ID
+        source: name of where the stack comes from (e.g. the tile of a
+                stack_cache.StackCache)
+        stack, dates, began, ended, roi_mask, strata, seed, preprocessed:
+                see modis_local.dfo()
+        slope_classes: slope classes of the roi window (utils/slope.py), to
+                       apply slope thresholds
+        stack_version: tag that changes whenever the stack of 'source'
+                       changes, part of the key instead of the stack itself.
+                       Without it the key has a digest of the whole stack.
+    """
+
+    def __init__(self, cache, dfo_id, source, stack, dates, began, ended,
+                 roi_mask=None, strata=None, seed=0, preprocessed=False,
+                 slope_classes=None, stack_version=None):
+        self.cache = cache
+        self.began = str(np.datetime64(began, "D"))
+        self.ended = str(np.datetime64(ended, "D"))
+        self.stack, self.dates = stack, dates
+        self.roi_mask = None if roi_mask is None else np.asarray(roi_mask,
+                                                                 bool)
+        self.strata = strata
+        self.seed = seed
+        self.preprocessed = preprocessed
+        self.slope_classes = slope_classes
+        if stack_version is None:
+            stack_version = array_digest(stack)
+        self.event = [int(dfo_id), str(source), str(stack_version),
+                      array_digest(modis_local.as_days(dates)), self.began,
+                      self.ended, array_digest(self.roi_mask)]
+        self._modis = None
+        self._days = None
+        self._memory = {}
+
+    def _product(self, kind, inputs, compute):
+        key = input_key(kind, self.event + inputs)
+        if key not in self._memory:
+            arrays = self.cache.get(kind, key)
+            if arrays is None:
+                arrays = compute()
+                self.cache.put(kind, key, arrays)
+            self._memory[key] = arrays
+        return self._memory[key]
+
+    # Preprocessed bands of the event, computed once
+    def modis(self):
+        if self._modis is None:
+            stack, self._days = modis_local.select_stack(
+                self.stack, self.dates, self.began, self.ended)
+            if self.preprocessed:
+                self._modis = modis_local.from_stack(
+                    stack, modis_local.PREPROCESSED_BANDS)
+            else:
+                self._modis = modis_local.preprocess(
+                    modis_local.from_stack(stack, modis_local.RAW_BANDS))
+        return self._modis
+
+    def thresholds(self, threshold):
+        if threshold == "standard":
+            return modis_local.STANDARD_THRESHOLDS
+
+        def compute():
+            thresh = modis_local.otsu_thresholds(self.modis(), self.strata,
+                                                 self.roi_mask, seed=self.seed)
+            return {"b1b2": thresh["b1b2"], "b7": thresh["b7"]}
+
+        arrays = self._product("thresholds",
+                               [array_digest(self.strata), self.seed], compute)
+        return {"b1b2": float(arrays["b1b2"]), "b7": float(arrays["b7"]),
+                "base_res": None}
+
+    def flags(self, thresh_dict):
+        """Water flags (time, y, x) of the images and their days"""
+        def compute():
+            modis = self.modis()
+            flags = modis_local.water_flag(modis, thresh_dict["b1b2"],
+                                           thresh_dict["b7"])
+            return {"flags": tiled_raster.pack(flags, 1),
+                    "shape": np.array(flags.shape),
+                    "days": self._days.astype(np.int64)}
+
+        arrays = self._product("flags", [thresh_dict["b1b2"],
+                                         thresh_dict["b7"]], compute)
+        shape = tuple(arrays["shape"])
+        flags = tiled_raster.unpack(arrays["flags"], 1, int(np.prod(shape)))
+        return flags.reshape(shape), arrays["days"].astype("datetime64[D]")
+
+    def clear(self):
+        """Clear views and percent clear views"""
+        def compute():
+            clear_views, clear_perc = modis_local.get_clear_views(self.modis())
+            return {"clear_views": clear_views, "clear_perc": clear_perc}
+
+        arrays = self._product("clear", [], compute)
+        return arrays["clear_views"], arrays["clear_perc"]
+
+    def dfo(self, threshold="standard", my_comp="3Day", composite="join",
+            slope_thresh=None):
+        """
+        Same image as modis_local.dfo() (without get_max), with the slope
+        mask of 'slope_thresh' applied if given
+        """
+        modis_local.check_options(threshold, my_comp, False, self.strata)
+        if composite not in modis_local.COMPOSITES:
+            raise ValueError("'composite' options are 'join' or 'rolling'")
+        if slope_thresh is not None and self.slope_classes is None:
+            raise ValueError("'slope_thresh' needs the 'slope_classes'")
+        thresh_dict = self.thresholds(threshold)
+        comp_days = modis_local.composite_days(self.began, my_comp)
+
+        # The composite does not depend on how it is built, 'composite' is
+        # left out of the key
+        def compute():
+            flags, days = self.flags(thresh_dict)
+            comp_counts = modis_local.COMPOSITES[composite](
+                flags, days, modis_local.LAG_DAYS[my_comp])
+            flooded, duration = modis_local.flood_extent_freq(
+                (comp_counts >= comp_days).astype(np.uint8))
+            clear_views, clear_perc = self.clear()
+            img = modis_local.final_image(flooded, duration, clear_views,
+                                          clear_perc, thresh_dict, self.began,
+                                          self.ended, threshold, comp_days,
+                                          self.roi_mask)
+            if slope_thresh is not None:
+                keep = slope.class_mask(self.slope_classes, slope_thresh)
+                for name in img.band_names():
+                    band = img.select(name)
+                    img.bands[name] = np.where(keep, band, band.dtype.type(0))
+            return dict(img.bands)
+
+        slope_digest = ""
+        if slope_thresh is not None:
+            slope_digest = array_digest(self.slope_classes)
+        arrays = self._product("dfo", [threshold, thresh_dict["b1b2"],
+                                       thresh_dict["b7"], my_comp,
+                                       slope_thresh, slope_digest], compute)
+        img = modis_local.final_image(
+            arrays["flooded"], arrays["duration"], arrays["clear_views"],
+            arrays["clear_perc"], thresh_dict, self.began, self.ended,
+            threshold, comp_days)
+        if slope_thresh is not None:
+            img.set({"slope_threshold": slope_thresh})
+        return img
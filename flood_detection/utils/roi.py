@@ -0,0 +1,185 @@
+# ROI preparation: simplified event geometries and rasterized roi masks
+#
+# The roi of an event is the union of its level 4 basins (see basins.py), often
+# tens of thousands of vertices, and modis.dfo() clips every image to it while
+# the pop_utils functions reduce over the raw country/FPU polygons. Vertices
+# closer together than the 250-m output pixels do not change the result, so
+# here geometries are simplified with a tolerance tied to the GFD grid (half
+# a pixel by default) and the roi of each event is rasterized once to a mask
+# on that grid, which is cached per event:
+#
+#     masks = RoiMasks("data/roi_masks")
+#     roi_mask, window = masks.mask(dfo_id, watershed)
+#
+# The mask is the 'roi_mask' of modis_local.dfo()/dfo_fused() and of the
+# tiling loaders. On Earth Engine, ee_simplify() and ee_mask() do the same for
+# modis.dfo(roi_mask=...), which masks the images instead of clipping them.
+# area_report() shows how much the simplification changed each geometry.
+#
+# Needs shapely >= 2.0.
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from flood_detection.utils import basins, tiled_raster
+
+# Simplification tolerance, in degrees and in meters for Earth Engine
+TOLERANCE = tiled_raster.PIXEL_DEG / 2
+EE_MAX_ERROR = 125
+
+# Radius of the authalic sphere, for areas in square km
+EARTH_RADIUS_KM = 6371.007181
+
+
+def simplify(geometry, tolerance=TOLERANCE):
+    """Simplified shapely geometry of a GeoJSON dict or shapely geometry"""
+    simplified = basins.to_shape(geometry).simplify(tolerance,
+                                                    preserve_topology=True)
+    return basins.to_shape(simplified)
+
+
+def equal_area(geometry):
+    """A lon/lat geometry in the sinusoidal projection, in km"""
+    import shapely
+
+    def project(coords):
+        lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+        return np.column_stack([EARTH_RADIUS_KM * lon * np.cos(lat),
+                                EARTH_RADIUS_KM * lat])
+
+    return basins.to_shape(shapely.transform(basins.to_shape(geometry),
+                                             project))
+
+
+def area_change(original, simplified):
+    """Vertices and area of a geometry before and after simplification"""
+    import shapely
+
+    original, simplified = equal_area(original), equal_area(simplified)
+    area = original.area
+    moved = original.symmetric_difference(simplified).area
+    return OrderedDict([
+        ("vertices", int(shapely.get_num_coordinates(original))),
+        ("vertices_simplified", int(shapely.get_num_coordinates(simplified))),
+        ("area_km2", area),
+        ("area_simplified_km2", simplified.area),
+        ("area_change_pct", 100 * (simplified.area - area) / area
+         if area else 0.0),
+        ("moved_km2", moved),
+        ("moved_pct", 100 * moved / area if area else 0.0),
+    ])
+
+
+def area_report(geometries, tolerance=TOLERANCE, path=None):
+    """
+    How much the simplification changes each geometry: vertices before and
+    after, area change and the area between the two outlines (moved_km2).
+
+    Args:
+        geometries: dict of ID to GeoJSON (or shapely) geometry
+        path: optional CSV to write the report to
+
+    Returns:
+        list of rows (OrderedDicts), one per geometry
+    """
+    rows = []
+    for key in sorted(geometries):
+        if geometries[key] is None:
+            continue
+        row = OrderedDict([("id", key)])
+        row.update(area_change(geometries[key],
+                               simplify(geometries[key], tolerance)))
+        rows.append(row)
+    if path is not None and rows:
+        import csv
+        from flood_detection.batch import open_csv
+
+        with open_csv(path, "w") as f:
+            writer = csv.DictWriter(f, list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+def rasterize(geometry):
+    """
+    Mask of the GFD grid pixels with their center inside a geometry, and the
+    window of the grid it covers
+    """
+    from shapely.geometry import mapping
+    from flood_stats import zonal
+
+    geometry = basins.to_shape(geometry)
+    window = tiled_raster.bounds_to_window(geometry.bounds)
+    grid = zonal.Grid.from_window(window)
+    return zonal.polygon_mask(mapping(geometry), grid), window
+
+
+class RoiMasks(object):
+    """
+    Rasterized roi masks of events, cached under 'root' as <event>.npz. A mask
+    is rebuilt when the simplified geometry of the event changes.
+    """
+
+    def __init__(self, root, tolerance=TOLERANCE):
+        self.root = root
+        self.tolerance = tolerance
+
+    def _path(self, key):
+        return os.path.join(self.root, "{0}.npz".format(key))
+
+    def mask(self, key, geometry):
+        """
+        The roi mask of an event and its window of the GFD grid
+
+        Args:
+            key: event ID
+            geometry: GeoJSON (or shapely) geometry of the roi
+        """
+        simplified = simplify(geometry, self.tolerance)
+        digest = hashlib.sha1(simplified.wkb).hexdigest()
+        path = self._path(key)
+        if os.path.exists(path):
+            with np.load(path) as f:
+                if str(f["digest"]) == digest:
+                    rows, cols = f["window"]
+                    window = (slice(int(rows[0]), int(rows[1])),
+                              slice(int(cols[0]), int(cols[1])))
+                    shape = (rows[1] - rows[0], cols[1] - cols[0])
+                    mask = tiled_raster.unpack(f["mask"], 1,
+                                               shape[0] * shape[1])
+                    return mask.reshape(shape).astype(bool), window
+
+        mask, window = rasterize(simplified)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, digest=digest, mask=tiled_raster.pack(mask, 1),
+                 window=[[window[0].start, window[0].stop],
+                         [window[1].start, window[1].stop]])
+        os.rename(tmp, path)
+        return mask, window
+
+
+def ee_simplify(roi, max_error=EE_MAX_ERROR):
+    """Simplify an ee.Geometry to within 'max_error' meters"""
+    return roi.simplify(max_error)
+
+
+def ee_simplify_features(features, max_error=EE_MAX_ERROR):
+    """Simplify the geometries of an ee.FeatureCollection"""
+    return features.map(lambda ft: ft.simplify(max_error))
+
+
+def ee_mask(roi):
+    """
+    The roi rasterized as an ee.Image mask (1 inside, masked outside), for
+    updateMask() instead of clip()
+    """
+    import ee
+
+    return ee.Image(0).byte().paint(ee.FeatureCollection([ee.Feature(roi)]),
+                                    1).selfMask().rename("roi")
@@ -0,0 +1,115 @@
+# Precomputed slope mask for the GFD grid
+#
+# misc.apply_slope_mask() used to run ee.Terrain.slope on GMTED2010 for every
+# event, although the slope never changes. The slope is computed once here on
+# the 250-m GFD grid and stored in a tiled_raster.TiledRaster as slope classes
+# of 4 bits:
+#
+#   class 0: flat (slope 0)
+#   class k (1 - 13): k - 1 < slope <= k degrees
+#   class 14: slope > 13 degrees
+#   class 15: no DEM data, masked out for every threshold
+#
+# so one stored raster gives the mask for any whole degree threshold from 0 to
+# 13 with 'classes <= thresh', the same as slope.lte(thresh) in Earth Engine
+# where pixels without DEM data are masked too.
+# The slope classes can be exported to an asset once (misc.get_slope_classes)
+# for the Earth Engine version, or built locally from a DEM reader with
+# build_slope_classes().
+
+import numpy as np
+
+from flood_detection.utils import tiled_raster
+
+SLOPE_CLASS_BITS = 4
+NODATA_CLASS = 2 ** SLOPE_CLASS_BITS - 1
+MAX_CLASS = NODATA_CLASS - 1
+METERS_PER_DEGREE = 111319.49
+
+
+# Slope in degrees from a DEM with the same 4 neighbour differences as
+# ee.Terrain.slope (one sided on the edges of the array). 'pixel_size' is the
+# pixel height in meters, 'pixel_width' the width if different, either a
+# number or one value per row (pixels get narrower away from the equator on a
+# lon/lat grid).
+def slope_degrees(dem, pixel_size=250.0, pixel_width=None):
+    dem = np.asarray(dem, np.float64)
+    if pixel_width is None:
+        pixel_width = pixel_size
+    pixel_width = np.asarray(pixel_width, np.float64)
+    if pixel_width.ndim == 1:
+        pixel_width = pixel_width[:, None]
+    dz_dy = np.gradient(dem, axis=0) / pixel_size
+    dz_dx = np.gradient(dem, axis=1) / pixel_width
+    return np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+
+# Slope on rows of the GFD grid, pixel widths shrink with the latitude
+def grid_slope_degrees(dem, rows):
+    pixel_size = tiled_raster.PIXEL_DEG * METERS_PER_DEGREE
+    widths = pixel_size * np.cos(np.radians(tiled_raster.row_latitudes(rows)))
+    return slope_degrees(dem, pixel_size, widths)
+
+
+def slope_classes(slope):
+    slope = np.asarray(slope, np.float64)
+    finite = np.isfinite(slope)
+    classes = np.clip(np.ceil(np.where(finite, slope, 0)), 0, MAX_CLASS)
+    return np.where(finite, classes, NODATA_CLASS).astype(np.uint8)
+
+
+# The slope classes only give the mask of whole degree thresholds below
+# MAX_CLASS (classes <= thresh), raise for any other threshold
+def check_class_thresh(thresh):
+    if thresh != int(thresh) or not 0 <= thresh < MAX_CLASS:
+        raise ValueError("Slope classes support whole degree thresholds "
+                         "from 0 to {0}".format(MAX_CLASS - 1))
+
+
+# True where the slope is at or below 'thresh' degrees, never where there is
+# no DEM data
+def class_mask(classes, thresh=5):
+    check_class_thresh(thresh)
+    return np.asarray(classes) <= thresh
+
+
+def open_store(root):
+    return tiled_raster.TiledRaster(root, bits=SLOPE_CLASS_BITS,
+                                    description="GMTED2010 slope classes")
+
+
+# Compute and store the slope classes of every tile in lon/lat 'bounds'.
+# 'read_dem' takes a (row slice, col slice) window of the GFD grid and returns
+# the elevation there in meters. Windows are read with one extra pixel around
+# the tile so the slope on tile edges matches a slope of the whole DEM.
+# Tiles that are already stored are skipped.
+def build_slope_classes(store, read_dem, bounds=(-180, -90, 180, 90)):
+    for tile in store.tiles_for_window(tiled_raster.bounds_to_window(bounds)):
+        if tile in store.tiles:
+            continue
+        rows, cols = store.tile_window(tile)
+        halo = (slice(max(rows.start - 1, 0),
+                      min(rows.stop + 1, tiled_raster.GRID_SHAPE[0])),
+                slice(max(cols.start - 1, 0),
+                      min(cols.stop + 1, tiled_raster.GRID_SHAPE[1])))
+        slope = grid_slope_degrees(read_dem(halo), halo[0])
+        store.write_tile(tile, slope_classes(
+            slope[rows.start - halo[0].start:rows.stop - halo[0].start,
+                  cols.start - halo[1].start:cols.stop - halo[1].start]))
+        print("Slope classes for tile {0} stored".format(tile))
+
+
+# Slope mask of a window of the GFD grid, read from the stored classes
+def slope_mask(store, window, thresh=5):
+    return class_mask(store.read_window(window), thresh)
+
+
+# Local version of misc.apply_slope_mask() for a modis_local.LocalImage on
+# 'window' of the GFD grid. Pixels above the slope threshold are set to 0,
+# like pixels outside the roi.
+def apply_slope_mask(img, store, window, thresh=5):
+    keep = slope_mask(store, window, thresh)
+    for name in img.band_names():
+        band = img.select(name)
+        img.bands[name] = np.where(keep, band, band.dtype.type(0))
+    return img.set({"slope_threshold": thresh})
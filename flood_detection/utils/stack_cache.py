@@ -0,0 +1,244 @@
+# On-disk cache of preprocessed MODIS stacks for the local DFO engine
+# (modis_local.py).
+#
+# Images are stored after the GQ/GA join, pan-sharpening, b1b2 ratio and QA
+# decoding (the PREPROCESSED_BANDS of modis_local), keyed by (tile, date,
+# product). Overlapping events in the same tile and season read the same bytes
+# instead of fetching and preprocessing the MODIS collections again.
+#
+# Layout: one memory-mapped .npy chunk per tile and month with shape
+# (days, products, band, y, x). Because Terra and Aqua are next to each other
+# for every day, a date range within a chunk reshapes to a (time, band, y, x)
+# stack without copying, which is what modis_local.dfo() reads. Chunk files
+# are named by a hash of their key and the cache version, and the least
+# recently used chunks are deleted once the cache grows over 'max_bytes'.
+#
+# The index of what is stored is written when a chunk is added or deleted and
+# on flush()/close(), not on every put(). Images put after the last flush are
+# not in the index of a new StackCache and are computed again. Use the cache as
+# a context manager, or call close(), to keep them.
+
+import calendar
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from flood_detection import modis_local
+
+# Bump when the preprocessing changes so old chunks are not read again
+CACHE_VERSION = 1
+
+# Terra (MOD09) and Aqua (MYD09) in the order they are stored for each day
+PRODUCTS = ["MOD09", "MYD09"]
+
+
+def chunk_id(tile, year, month):
+    key = json.dumps([str(tile), year, month, CACHE_VERSION,
+                      modis_local.PREPROCESSED_BANDS])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class StackCache(object):
+
+    def __init__(self, root, max_bytes=50e9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index_file = os.path.join(root, "index.json")
+        self.chunks = {}
+        self.index = {}
+        self.dirty = False
+        if not os.path.exists(root):
+            os.makedirs(root)
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    def _save_index(self):
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.rename(tmp, self.index_file)
+        self.dirty = False
+
+    # Write the stored images and the index to disk
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            for chunk in self.chunks.values():
+                chunk.flush()
+            self._save_index()
+
+    def close(self):
+        self.flush()
+        self.chunks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _path(self, cid):
+        return os.path.join(self.root, cid + ".npy")
+
+    def _touch(self, cid):
+        self.index[cid]["last_used"] = time.time()
+
+    # Open (or create) the chunk for a tile and month
+    def _chunk(self, tile, date, shape=None):
+        date = np.datetime64(date, "D").astype(object)
+        cid = chunk_id(tile, date.year, date.month)
+        if cid in self.chunks:
+            return cid, self.chunks[cid]
+        path = self._path(cid)
+        if cid in self.index and os.path.exists(path):
+            chunk = np.load(path, mmap_mode="r+")
+        elif shape is None:
+            return cid, None
+        else:
+            n_days = calendar.monthrange(date.year, date.month)[1]
+            chunk = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32,
+                shape=(n_days, len(PRODUCTS),
+                       len(modis_local.PREPROCESSED_BANDS)) + tuple(shape))
+            # Days that were never stored are NaN, get_range() refuses to
+            # read them unless asked to
+            chunk[:] = np.nan
+            self.index[cid] = {"tile": str(tile), "year": date.year,
+                               "month": date.month, "present": [],
+                               "size": os.path.getsize(path),
+                               "last_used": time.time()}
+            self._save_index()
+            self._evict(keep=cid)
+        self.chunks[cid] = chunk
+        return cid, chunk
+
+    # Delete the least recently used chunks until the cache is under max_bytes
+    def _evict(self, keep=None):
+        total = sum(c["size"] for c in self.index.values())
+        for cid in sorted(self.index, key=lambda c: self.index[c]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if cid == keep:
+                continue
+            total -= self.index[cid]["size"]
+            self.chunks.pop(cid, None)
+            if os.path.exists(self._path(cid)):
+                os.remove(self._path(cid))
+            del self.index[cid]
+        self._save_index()
+
+    # Store one preprocessed image, a (band, y, x) array in the order of
+    # modis_local.PREPROCESSED_BANDS
+    def put(self, tile, date, product, image):
+        image = np.asarray(image, np.float32)
+        with self.lock:
+            cid, chunk = self._chunk(tile, date, shape=image.shape[1:])
+            day = np.datetime64(date, "D").astype(object).day - 1
+            chunk[day, PRODUCTS.index(product)] = image
+            entry = [day, PRODUCTS.index(product)]
+            if entry not in self.index[cid]["present"]:
+                self.index[cid]["present"].append(entry)
+            self._touch(cid)
+            self.dirty = True
+
+    def has(self, tile, date, product):
+        cid = chunk_id(tile, *self._year_month(date))
+        if cid not in self.index:
+            return False
+        day = np.datetime64(date, "D").astype(object).day - 1
+        return [day, PRODUCTS.index(product)] in self.index[cid]["present"]
+
+    # Read one image as a read-only view of the memory-mapped chunk
+    def get(self, tile, date, product):
+        if not self.has(tile, date, product):
+            return None
+        with self.lock:
+            cid, chunk = self._chunk(tile, date)
+            self._touch(cid)
+        day = np.datetime64(date, "D").astype(object).day - 1
+        view = chunk[day, PRODUCTS.index(product)]
+        view.flags.writeable = False
+        return view
+
+    def get_or_compute(self, tile, date, product, compute):
+        image = self.get(tile, date, product)
+        if image is None:
+            self.put(tile, date, product, compute())
+            image = self.get(tile, date, product)
+        return image
+
+    # Store a raw (time, band, y, x) stack of one product (RAW_BANDS order),
+    # preprocessing it first
+    def put_raw_stack(self, tile, dates, product, stack):
+        modis = modis_local.preprocess(
+                    modis_local.from_stack(stack, modis_local.RAW_BANDS))
+        preprocessed = modis_local.to_stack(modis,
+                                            modis_local.PREPROCESSED_BANDS)
+        for date, image in zip(modis_local.as_days(dates), preprocessed):
+            self.put(tile, date, product, image)
+        self.flush()
+
+    # (date, product) of the images between 'start' and 'end' (exclusive)
+    # that were never put
+    def missing(self, tile, start, end):
+        return [(day, product)
+                for day in np.arange(np.datetime64(start, "D"),
+                                     np.datetime64(end, "D"))
+                for product in PRODUCTS if not self.has(tile, day, product)]
+
+    # Preprocessed (time, band, y, x) stack and image dates between 'start'
+    # and 'end' (exclusive). Terra and Aqua alternate along the time axis.
+    # Within one month this is a view of the chunk, across months the chunks
+    # are concatenated. Raises a KeyError when an image in the range was never
+    # put, as a NaN image would read like a fully clouded day. Set
+    # 'allow_missing' to get them as NaN anyway (e.g. Aqua before 2002-07-04).
+    def get_range(self, tile, start, end, allow_missing=False):
+        start = np.datetime64(start, "D")
+        end = np.datetime64(end, "D")
+        if not allow_missing:
+            missing = self.missing(tile, start, end)
+            if missing:
+                raise KeyError("Tile {0} has {1} images missing from {2} to "
+                               "{3}, first {4} {5}".format(
+                                   tile, len(missing), start, end,
+                                   missing[0][0], missing[0][1]))
+        parts = []
+        day = start
+        while day < end:
+            month_end = (day.astype("datetime64[M]") + 1).astype("datetime64[D]")
+            stop = min(month_end, end)
+            with self.lock:
+                cid, chunk = self._chunk(tile, day)
+                if chunk is None:
+                    raise KeyError("Tile {0} has nothing cached for {1}"
+                                   .format(tile, day))
+                self._touch(cid)
+            first = day.astype(object).day - 1
+            view = chunk[first:first + (stop - day).astype(int)]
+            parts.append(view.reshape((-1,) + view.shape[2:]))
+            day = stop
+        stack = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        stack.flags.writeable = False
+        dates = np.repeat(np.arange(start, end), len(PRODUCTS))
+        return stack, dates
+
+    # Everything modis_local.dfo() needs for an event, with the same buffered
+    # date range as modis.dfo()
+    def load_event(self, tile, began, ended, allow_missing=False):
+        return self.get_range(tile, np.datetime64(began, "D") - 2,
+                              np.datetime64(ended, "D") + 3, allow_missing)
+
+    def size(self):
+        return sum(c["size"] for c in self.index.values())
+
+    def _year_month(self, date):
+        date = np.datetime64(date, "D").astype(object)
+        return date.year, date.month
@@ -0,0 +1,186 @@
+# Tiled, bit-packed rasters on the global 250-m GFD grid
+#
+# Static layers that every event is masked with (slope classes, JRC permanent
+# water) are precomputed once on the grid the flood maps are exported on and
+# stored here as square tiles. Each tile is a small binary file of values
+# packed 'bits' to a byte (1 bit for a boolean mask, 4 bits for slope classes)
+# and the tiles that exist are listed in a JSON index, which is also the
+# spatial index: the tiles an roi touches follow from its bounds, so a read
+# only opens those files. Tiles that were never written read as 'fill'.
+# Recently read tiles can be kept unpacked in an in-process LRU cache
+# ('cache_tiles'), so events next to each other share the reads.
+#
+# Grid: EPSG:4326, top left corner at (-180, 90), PIXEL_DEG degrees a pixel
+# (250 m at the equator, the 'res=250' of export.to_asset).
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+PIXEL_DEG = 250 / 111319.49
+GRID_ORIGIN = (-180.0, 90.0)
+GRID_SHAPE = (int(np.ceil(180 / PIXEL_DEG)), int(np.ceil(360 / PIXEL_DEG)))
+TILE_SIZE = 1024
+
+
+# Pack integer values of 'bits' bits each (1, 2, 4 or 8) into bytes
+def pack(values, bits):
+    per_byte = 8 // bits
+    values = np.asarray(values, np.uint8).ravel()
+    pad = (-values.size) % per_byte
+    if pad:
+        values = np.concatenate([values, np.zeros(pad, np.uint8)])
+    shifts = (np.arange(per_byte) * bits).astype(np.uint8)
+    values = values.reshape(-1, per_byte) << shifts
+    return np.bitwise_or.reduce(values, axis=1).astype(np.uint8)
+
+
+def unpack(data, bits, size):
+    per_byte = 8 // bits
+    shifts = (np.arange(per_byte) * bits).astype(np.uint8)
+    values = (np.asarray(data, np.uint8)[:, None] >> shifts) & ((1 << bits) - 1)
+    return values.ravel()[:size]
+
+
+# Pixel window (row slice, col slice) of the grid covering lon/lat bounds
+# (west, south, east, north)
+def bounds_to_window(bounds):
+    west, south, east, north = bounds
+    col0 = int(np.floor((west - GRID_ORIGIN[0]) / PIXEL_DEG))
+    col1 = int(np.ceil((east - GRID_ORIGIN[0]) / PIXEL_DEG))
+    row0 = int(np.floor((GRID_ORIGIN[1] - north) / PIXEL_DEG))
+    row1 = int(np.ceil((GRID_ORIGIN[1] - south) / PIXEL_DEG))
+    return (slice(max(row0, 0), min(row1, GRID_SHAPE[0])),
+            slice(max(col0, 0), min(col1, GRID_SHAPE[1])))
+
+
+def window_to_bounds(window):
+    rows, cols = window
+    return (GRID_ORIGIN[0] + cols.start * PIXEL_DEG,
+            GRID_ORIGIN[1] - rows.stop * PIXEL_DEG,
+            GRID_ORIGIN[0] + cols.stop * PIXEL_DEG,
+            GRID_ORIGIN[1] - rows.start * PIXEL_DEG)
+
+
+# Latitude of the center of each row in a row slice
+def row_latitudes(rows):
+    return GRID_ORIGIN[1] - (np.arange(rows.start, rows.stop) + 0.5) * PIXEL_DEG
+
+
+class TiledRaster(object):
+
+    def __init__(self, root, bits=1, tile_size=TILE_SIZE, fill=0,
+                 description="", cache_tiles=0):
+        self.root = root
+        self.cache_tiles = cache_tiles
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.index_file = os.path.join(root, "index.json")
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                meta = json.load(f)
+            if meta["pixel_deg"] != PIXEL_DEG:
+                raise ValueError("{0} is not on the GFD grid".format(root))
+        else:
+            if bits not in [1, 2, 4, 8]:
+                raise ValueError("'bits' options are 1, 2, 4 or 8")
+            if not os.path.exists(root):
+                os.makedirs(root)
+            meta = {"bits": bits, "tile_size": tile_size, "fill": fill,
+                    "pixel_deg": PIXEL_DEG, "description": description,
+                    "tiles": []}
+        self.bits = meta["bits"]
+        self.tile_size = meta["tile_size"]
+        self.fill = meta["fill"]
+        self.description = meta["description"]
+        self.tiles = set(tuple(t) for t in meta["tiles"])
+        if not os.path.exists(self.index_file):
+            self._save_index()
+
+    def _save_index(self):
+        meta = {"bits": self.bits, "tile_size": self.tile_size,
+                "fill": self.fill, "pixel_deg": PIXEL_DEG,
+                "description": self.description,
+                "tiles": sorted(list(t) for t in self.tiles)}
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp, self.index_file)
+
+    def _path(self, tile):
+        return os.path.join(self.root, "{0}_{1}.bin".format(*tile))
+
+    # Window of the grid covered by a tile
+    def tile_window(self, tile):
+        r, c = tile[0] * self.tile_size, tile[1] * self.tile_size
+        return (slice(r, min(r + self.tile_size, GRID_SHAPE[0])),
+                slice(c, min(c + self.tile_size, GRID_SHAPE[1])))
+
+    # (tile row, tile col) of every tile a window touches
+    def tiles_for_window(self, window):
+        rows, cols = window
+        return [(tr, tc)
+                for tr in range(rows.start // self.tile_size,
+                                (rows.stop - 1) // self.tile_size + 1)
+                for tc in range(cols.start // self.tile_size,
+                                (cols.stop - 1) // self.tile_size + 1)]
+
+    def write_tile(self, tile, values):
+        rows, cols = self.tile_window(tile)
+        values = np.asarray(values)
+        if values.shape != (rows.stop - rows.start, cols.stop - cols.start):
+            raise ValueError("Tile {0} must have shape {1}".format(
+                tile, (rows.stop - rows.start, cols.stop - cols.start)))
+        if values.max() >= 2 ** self.bits:
+            raise ValueError("Values do not fit in {0} bits".format(self.bits))
+        tmp = self._path(tile) + ".tmp"
+        pack(values, self.bits).tofile(tmp)
+        os.rename(tmp, self._path(tile))
+        self.tiles.add(tuple(tile))
+        with self.lock:
+            self.cache.pop(tuple(tile), None)
+        self._save_index()
+
+    # Unpacked values of a tile. Cached tiles are shared, do not modify them.
+    def read_tile(self, tile):
+        tile = tuple(tile)
+        with self.lock:
+            if tile in self.cache:
+                self.cache[tile] = self.cache.pop(tile)
+                return self.cache[tile]
+        rows, cols = self.tile_window(tile)
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        if tile not in self.tiles:
+            return np.full(shape, self.fill, np.uint8)
+        data = np.fromfile(self._path(tile), np.uint8)
+        values = unpack(data, self.bits, shape[0] * shape[1]).reshape(shape)
+        if self.cache_tiles > 0:
+            values.flags.writeable = False
+            with self.lock:
+                self.cache[tile] = values
+                while len(self.cache) > self.cache_tiles:
+                    self.cache.popitem(last=False)
+        return values
+
+    # Values of a window of the grid, only the tiles it touches are read
+    def read_window(self, window):
+        rows, cols = window
+        out = np.empty((rows.stop - rows.start, cols.stop - cols.start),
+                       np.uint8)
+        for tile in self.tiles_for_window(window):
+            t_rows, t_cols = self.tile_window(tile)
+            r0, r1 = max(rows.start, t_rows.start), min(rows.stop, t_rows.stop)
+            c0, c1 = max(cols.start, t_cols.start), min(cols.stop, t_cols.stop)
+            out[r0 - rows.start:r1 - rows.start, c0 - cols.start:c1 - cols.start] = \
+                self.read_tile(tile)[r0 - t_rows.start:r1 - t_rows.start,
+                                     c0 - t_cols.start:c1 - t_cols.start]
+        return out
+
+    # Values inside lon/lat bounds (west, south, east, north) and the window
+    # of the grid they cover
+    def read(self, bounds):
+        window = bounds_to_window(bounds)
+        return self.read_window(window), window
@@ -0,0 +1,359 @@
+# Per-stage timing of the DFO pipeline
+#
+# All a run of modis.dfo() printed was "Collected and pre-processed MODIS
+# Images" and "DFO Flood Dectection Complete". Here the stages of modis.dfo()
+# and the misc, export and pop_utils functions are wrapped in spans that
+# record, for each event:
+#
+#   duration        - wall time of the stage, in seconds
+#   round_trips     - requests to the Earth Engine server (ee.data calls, e.g.
+#                     each getInfo() and task start)
+#   response_bytes  - size of the JSON the server sent back
+#   pixels, bytes   - counts added by the stage, e.g. the export region
+#
+# When a stage ends its counts are added to the stage around it, so the
+# 'event' span has the totals of the event. Spans are written as JSON lines
+# while the batch runs and can be turned into a Chrome trace (chrome://tracing,
+# Perfetto) and a per stage summary afterwards:
+#
+#     timing.start("traces/gfd_v3.jsonl", "traces/gfd_v3.trace.json")
+#     runner = batch.BatchRunner(timing.per_event(map_event), ...)
+#     runner.run(id_list)
+#     timing.stop()
+#     rows = timing.summary(["traces/gfd_v3.jsonl"], "traces/summary.csv")
+#
+# Earth Engine builds the graph lazily: the collection filtering, the saveAll
+# join and the compositing only cost client time in their own spans, their
+# server time is spent in the getInfo() or export task that needs them. The
+# export spans record the task IDs, the task list has their run times.
+#
+# Nothing is recorded (and ee is not touched) until start() is called.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+# Functions of ee.data that each send one request to the server
+EE_CALLS = ["getInfo", "getValue", "computeValue", "getList", "getMapId",
+            "getThumbId", "getDownloadId", "getTableDownloadId",
+            "computePixels", "computeImages", "computeFeatures", "getPixels",
+            "getAsset", "getAssetAcl", "listAssets", "listImages",
+            "listFeatures", "createAsset", "copyAsset", "renameAsset",
+            "deleteAsset", "updateAsset", "newTaskId", "startProcessing",
+            "exportImage", "exportTable", "exportVideo", "exportMap",
+            "getTaskStatus", "getTaskList", "getOperation", "listOperations",
+            "cancelTask", "cancelOperation"]
+
+SUMMARY_FIELDS = ["stage", "calls", "events", "errors", "total_s", "mean_s",
+                  "max_s", "round_trips", "response_bytes", "pixels", "bytes"]
+
+_tracer = None
+_local = threading.local()
+
+
+class Span(object):
+
+    def __init__(self, name, event, fields):
+        self.name = name
+        self.event = event
+        self.fields = OrderedDict(fields)
+        self.counts = OrderedDict([("round_trips", 0), ("response_bytes", 0)])
+        self.start = time.time()
+
+    def add(self, counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def record(self, error=None):
+        record = OrderedDict([("stage", self.name), ("event", self.event),
+                              ("start", self.start),
+                              ("duration", time.time() - self.start),
+                              ("pid", os.getpid()),
+                              ("thread", threading.current_thread().name)])
+        record.update(self.counts)
+        record.update(self.fields)
+        if error is not None:
+            record["error"] = error
+        return record
+
+
+class Tracer(object):
+    """
+    Writes the spans of all threads to 'path' (JSON lines)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def _spans():
+    if not hasattr(_local, "spans"):
+        _local.spans = []
+        _local.event = None
+    return _local.spans
+
+
+def _wrap_ee_call(fn):
+    @wraps(fn)
+    def call(*args, **kwargs):
+        result = fn(*args, **kwargs)
+        if _tracer is not None and _spans():
+            try:
+                size = len(json.dumps(result, default=str))
+            except (TypeError, ValueError):
+                size = 0
+            _spans()[-1].add({"round_trips": 1, "response_bytes": size})
+        return result
+    call._timing_original = fn
+    return call
+
+
+def _patch_ee():
+    import ee
+
+    for name in EE_CALLS:
+        fn = getattr(ee.data, name, None)
+        if fn is not None and not hasattr(fn, "_timing_original"):
+            setattr(ee.data, name, _wrap_ee_call(fn))
+
+
+def _unpatch_ee():
+    import ee
+
+    for name in EE_CALLS:
+        fn = getattr(ee.data, name, None)
+        if fn is not None and hasattr(fn, "_timing_original"):
+            setattr(ee.data, name, fn._timing_original)
+
+
+def start(path, chrome_path=None, ee_calls=True):
+    """
+    Record spans to 'path' until stop(), and write them as a Chrome trace
+    to 'chrome_path' on stop(). With ee_calls the ee.data requests are
+    counted (needs the ee package).
+    """
+    global _tracer
+    if _tracer is not None:
+        stop()
+    _tracer = Tracer(path)
+    _tracer.chrome_path = chrome_path
+    _tracer.ee_calls = ee_calls
+    if ee_calls:
+        _patch_ee()
+    return _tracer
+
+
+def stop():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    if tracer.ee_calls:
+        _unpatch_ee()
+    tracer.close()
+    if tracer.chrome_path is not None:
+        to_chrome([tracer.path], tracer.chrome_path)
+
+
+def enabled():
+    return _tracer is not None
+
+
+def begin(name, **fields):
+    """Open a span in the current thread, closed by end()"""
+    if _tracer is None:
+        return None
+    span = Span(name, getattr(_local, "event", None), fields)
+    _spans().append(span)
+    return span
+
+
+def end(span=None, error=None):
+    """
+    Close the innermost span, or 'span' and the spans left open inside it
+    (e.g. by an exception between begin() and end())
+    """
+    if _tracer is None:
+        return
+    spans = _spans()
+    if not spans or (span is not None and span not in spans):
+        return
+    while spans:
+        current = spans.pop()
+        if span is None or current is span:
+            _tracer.write(current.record(error))
+        else:
+            _tracer.write(current.record("not closed"))
+        if spans:
+            spans[-1].add(current.counts)
+        if span is None or current is span:
+            break
+
+
+def count(**counts):
+    """Add counts (e.g. pixels=..., bytes=...) to the innermost span"""
+    if _tracer is not None and _spans():
+        _spans()[-1].add(counts)
+
+
+def annotate(**fields):
+    """Set fields (e.g. task_id=...) of the innermost span"""
+    if _tracer is not None and _spans():
+        _spans()[-1].fields.update(fields)
+
+
+class stage(object):
+    """
+    Span around a block:
+
+        with timing.stage("otsu.sample", points=2500):
+            ...
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.span = None
+
+    def __enter__(self):
+        self.span = begin(self.name, **self.fields)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is not None:
+            end(self.span, None if exc_type is None else exc_type.__name__)
+        return False
+
+
+def traced(fn):
+    """Span around every call of a function, named <module>.<function>"""
+    name = "{0}.{1}".format(fn.__module__.rsplit(".", 1)[-1], fn.__name__)
+
+    @wraps(fn)
+    def call(*args, **kwargs):
+        if _tracer is None:
+            return fn(*args, **kwargs)
+        with stage(name):
+            return fn(*args, **kwargs)
+    return call
+
+
+class event(object):
+    """Spans opened in the block belong to an event, inside an 'event' span"""
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.stage = stage("event")
+
+    def __enter__(self):
+        _spans()
+        self.previous = _local.event
+        _local.event = self.event_id
+        return self.stage.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self.stage.__exit__(exc_type, exc, tb)
+        finally:
+            _local.event = self.previous
+
+
+def per_event(map_event):
+    """A function of one event ID (e.g. for BatchRunner) run inside event()"""
+    @wraps(map_event)
+    def call(event_id):
+        with event(event_id):
+            return map_event(event_id)
+    return call
+
+
+def read(paths):
+    """Records of JSON lines trace files"""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def to_chrome(paths, out_path):
+    """Write the spans of trace files in the Chrome trace event format"""
+    threads = {}
+    events = []
+    timing_keys = ["stage", "start", "duration", "pid", "thread"]
+    for r in read(paths):
+        tid = threads.setdefault((r["pid"], r["thread"]), len(threads) + 1)
+        args = dict((k, v) for k, v in r.items() if k not in timing_keys)
+        events.append({"name": r["stage"], "cat": "dfo", "ph": "X",
+                       "ts": int(r["start"] * 1e6),
+                       "dur": int(r["duration"] * 1e6),
+                       "pid": r["pid"], "tid": tid, "args": args})
+    for (pid, thread), tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid,
+                       "tid": tid, "args": {"name": thread}})
+    tmp = out_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.rename(tmp, out_path)
+
+
+def summary(paths, path=None):
+    """
+    Totals per stage over trace files (e.g. all runs of a batch).
+
+    Args:
+        paths: JSON lines trace files
+        path: optional CSV to write the summary to
+
+    Returns:
+        list of rows (OrderedDicts) with SUMMARY_FIELDS, one per stage
+    """
+    stages = OrderedDict()
+    for r in read(paths):
+        row = stages.get(r["stage"])
+        if row is None:
+            row = stages[r["stage"]] = OrderedDict(
+                (name, 0) for name in SUMMARY_FIELDS)
+            row["stage"] = r["stage"]
+            row["events"] = set()
+        row["calls"] += 1
+        row["events"].add(r.get("event"))
+        row["errors"] += int("error" in r)
+        row["total_s"] += r["duration"]
+        row["max_s"] = max(row["max_s"], r["duration"])
+        for name in ["round_trips", "response_bytes", "pixels", "bytes"]:
+            row[name] += r.get(name, 0)
+    rows = []
+    for row in stages.values():
+        row["events"] = len(row["events"] - set([None]))
+        row["mean_s"] = row["total_s"] / row["calls"]
+        rows.append(row)
+    if path is not None and rows:
+        import csv
+        from flood_detection.batch import open_csv
+
+        with open_csv(path, "w") as f:
+            writer = csv.DictWriter(f, SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
@@ -0,0 +1,91 @@
+# Permanent water masks from the JRC Global Surface Water dataset, precomputed
+# on the 250-m GFD grid
+#
+# The flood maps (misc.get_jrc_perm), the Otsu strata (misc.get_jrc_yearly_perm)
+# and every population function in flood_stats/pop_utils.py mask permanent
+# water. Instead of rebuilding transition == 1 from the 30-m dataset and
+# resampling it for every event, the masks are stored once as 1-bit
+# tiled_raster.TiledRaster layers:
+#
+#   <root>/transition      - JRC transition class 1 (permanent water)
+#   <root>/yearly_<year>   - JRC yearly history class 3 (permanent water)
+#
+# and a mask for an roi is a read of the tiles it touches. Recently used tiles
+# stay in memory, so detection and population stats for the same event read
+# them once. The Earth Engine side uses the same layers exported as assets,
+# see misc.perm_water().
+
+import os
+
+import numpy as np
+
+from flood_detection.utils import tiled_raster
+
+# Years of the JRC yearly history. Later events use the last year, same as
+# misc.get_jrc_yearly_perm()
+JRC_YEARS = (1984, 2018)
+
+
+def jrc_year(began):
+    year = np.datetime64(began, "D").astype(object).year
+    if year < JRC_YEARS[0]:
+        raise ValueError("No JRC yearly history before {0}".format(JRC_YEARS[0]))
+    return min(year, JRC_YEARS[1])
+
+
+class PermanentWater(object):
+
+    def __init__(self, root, cache_tiles=64):
+        self.root = root
+        self.cache_tiles = cache_tiles
+        self.transition = self._store("transition",
+                                      "JRC GSW transition == 1")
+        self.yearly = {}
+
+    def _store(self, name, description):
+        return tiled_raster.TiledRaster(os.path.join(self.root, name), bits=1,
+                                        description=description,
+                                        cache_tiles=self.cache_tiles)
+
+    def yearly_store(self, year):
+        if year not in self.yearly:
+            self.yearly[year] = self._store(
+                "yearly_{0}".format(year),
+                "JRC GSW yearly history {0} == 3".format(year))
+        return self.yearly[year]
+
+    # Boolean permanent water of a window of the GFD grid
+    def perm(self, window):
+        return self.transition.read_window(window).astype(bool)
+
+    # Boolean permanent water in the year of 'began', the Otsu strata
+    def yearly_perm(self, began, window):
+        store = self.yearly_store(jrc_year(began))
+        return store.read_window(window).astype(bool)
+
+    # Permanent water inside lon/lat bounds and the window it covers
+    def perm_bounds(self, bounds):
+        window = tiled_raster.bounds_to_window(bounds)
+        return self.perm(window), window
+
+    # Store the masks of every tile in lon/lat 'bounds'.
+    #   read_transition: takes a window of the GFD grid and returns the JRC
+    #                    transition classes resampled to it
+    #   read_yearly: takes a year and a window and returns the JRC yearly
+    #                history classes, or None to only store the transition
+    def build(self, read_transition, read_yearly=None,
+              bounds=(-180, -90, 180, 90), years=range(JRC_YEARS[0],
+                                                       JRC_YEARS[1] + 1)):
+        layers = [(self.transition, read_transition, 1)]
+        if read_yearly is not None:
+            for year in years:
+                layers.append((self.yearly_store(year),
+                               lambda w, y=year: read_yearly(y, w), 3))
+        window = tiled_raster.bounds_to_window(bounds)
+        for store, read, value in layers:
+            for tile in store.tiles_for_window(window):
+                if tile in store.tiles:
+                    continue
+                store.write_tile(tile, np.asarray(read(store.tile_window(tile)))
+                                 == value)
+            print("{0} stored".format(store.description))
@@ -0,0 +1,195 @@
+# Batch runner for the population exposure of many flood events, used by
+# main_popstats.py
+#
+# main_popstats.py used to run getFloodPopbyCountry_GHSLTimeSeries and start one
+# Export.table.toCloudStorage task per event, ~900 tiny CSVs that were then
+# compiled by hand. Here events are grouped: the stats function is mapped over
+# a group of flood images server side and the group is exported as one table.
+# Only a bounded number of export tasks run at the same time, and the event
+# IDs of every finished group are written to a checkpoint (the same
+# CheckpointStore as main_gfd.py), so a re-run only exports new events.
+#
+# The local mode runs a function that computes the rows of one event (e.g.
+# with flood_stats.zonal) in a pool of threads and appends them all to one
+# output CSV, skipping the events that are already in it.
+
+import csv
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from flood_detection.batch import is_quota_error, open_csv
+
+# Earth Engine task states
+DONE_STATES = ["COMPLETED"]
+FAILED_STATES = ["FAILED", "CANCELLED", "CANCEL_REQUESTED"]
+
+
+def groups(id_list, group_size):
+    id_list = list(id_list)
+    return [id_list[i:i + group_size]
+            for i in range(0, len(id_list), group_size)]
+
+
+# Stats of a group of events as one FeatureCollection. 'stats_fn' takes a
+# flood image and returns a FeatureCollection, like the pop_utils functions.
+def grouped_stats(gfd, id_group, stats_fn):
+    import ee
+
+    floods = gfd.filter(ee.Filter.inList('id', id_group))
+    return ee.FeatureCollection(floods.map(stats_fn)).flatten()
+
+
+# Starts Earth Engine tasks with at most 'max_tasks' running at a time. The
+# running tasks are polled every 'poll' seconds while waiting for a free slot.
+class TaskQueue(object):
+
+    def __init__(self, max_tasks=10, poll=30, on_done=None, on_failed=None,
+                 rate_limiter=None, sleep=time.sleep):
+        self.max_tasks = max_tasks
+        self.poll = poll
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.rate_limiter = rate_limiter
+        self.sleep = sleep
+        self.running = []
+
+    def _update(self):
+        still_running = []
+        for task, key in self.running:
+            status = task.status()
+            if status["state"] in DONE_STATES:
+                if self.on_done is not None:
+                    self.on_done(key)
+            elif status["state"] in FAILED_STATES:
+                if self.on_failed is not None:
+                    self.on_failed(key, status.get("error_message", ""))
+            else:
+                still_running.append((task, key))
+        self.running = still_running
+
+    def submit(self, task, key):
+        self._update()
+        while len(self.running) >= self.max_tasks:
+            self.sleep(self.poll)
+            self._update()
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        task.start()
+        self.running.append((task, key))
+
+    def wait(self):
+        self._update()
+        while self.running:
+            self.sleep(self.poll)
+            self._update()
+
+
+class PopStatsRunner(object):
+    # Args:
+    #    checkpoint: CheckpointStore with the events already exported
+    #    group_size: number of events per reduction and export
+    #    max_tasks: number of export tasks running at the same time
+    #    rate_limiter: optional flood_detection.batch.TokenBucket, one token
+    #                  is taken per task started
+    def __init__(self, checkpoint, group_size=25, max_tasks=10,
+                 rate_limiter=None, poll=30, sleep=time.sleep):
+        self.checkpoint = checkpoint
+        self.group_size = group_size
+        self.queue = TaskQueue(max_tasks, poll, self._done, self._failed,
+                               rate_limiter, sleep)
+
+    def _done(self, id_group):
+        for event_id in id_group:
+            self.checkpoint.mark_done(event_id)
+        print("Exported DFO {0} - {1}".format(id_group[0], id_group[-1]))
+
+    def _failed(self, id_group, message):
+        for event_id in id_group:
+            self.checkpoint.mark_failed(event_id, "Export Error", message)
+        print("Export Error DFO {0} - {1}: {2}".format(id_group[0],
+                                                       id_group[-1], message))
+
+    def new_ids(self, id_list):
+        done = set(self.checkpoint.completed())
+        return [i for i in id_list if i not in done]
+
+    # Export the stats of all events that are not in the checkpoint, one
+    # table per group of events. A group that fails to start is logged as an
+    # Export Error and the run moves on to the next group, quota errors are
+    # raised.
+    #    gfd: ee.ImageCollection of flood maps with an 'id' property
+    #    stats_fn: function from a flood image to a FeatureCollection
+    #    export_fn: takes the FeatureCollection and a name for the group and
+    #               returns an (unstarted) export task
+    def run_ee(self, gfd, id_list, stats_fn, export_fn):
+        todo = self.new_ids(id_list)
+        print("{0} events to export in groups of {1}, {2} already done"
+              .format(len(todo), self.group_size, len(id_list) - len(todo)))
+        for id_group in groups(todo, self.group_size):
+            try:
+                stats = grouped_stats(gfd, id_group, stats_fn)
+                name = "{0}_{1}".format(id_group[0], id_group[-1])
+                self.queue.submit(export_fn(stats, name), id_group)
+            except Exception as e:
+                if is_quota_error(e):
+                    raise
+                self._failed(id_group, str(e))
+        self.queue.wait()
+
+
+# Event IDs already in an output CSV
+def ids_in_output(path, id_field="index"):
+    if not os.path.exists(path):
+        return set()
+    with open_csv(path, "r") as f:
+        return set(int(float(row[id_field])) for row in csv.DictReader(f))
+
+
+# Compute the rows of every event not in 'output' with 'event_rows' (a
+# function from an event ID to a list of row dicts) using 'workers' threads,
+# and append them to 'output' as they finish. Returns the IDs that failed.
+def run_local(id_list, event_rows, output, id_field="index", workers=4,
+              log_file=None):
+    done = ids_in_output(output, id_field)
+    todo = [i for i in id_list if i not in done]
+    print("{0} events to compute, {1} already in {2}"
+          .format(len(todo), len(id_list) - len(todo), output))
+    failed = []
+    state = {"fields": None}
+    if os.path.exists(output):
+        with open_csv(output, "r") as f:
+            state["fields"] = next(csv.reader(f), None)
+
+    def compute(event_id):
+        try:
+            return event_id, event_rows(event_id), None
+        except Exception as e:
+            return event_id, None, str(e)
+
+    pool = ThreadPool(workers)
+    try:
+        for event_id, rows, error in pool.imap_unordered(compute, todo):
+            if error is not None:
+                failed.append(event_id)
+                print("Calculation Error {0} - {1}".format(event_id, error))
+                if log_file is not None:
+                    with open_csv(log_file, "a") as f:
+                        csv.writer(f).writerow(["Calculation Error", event_id,
+                                                error])
+                continue
+            if not rows:
+                continue
+            # Rows are written here, in the main thread, as events finish
+            with open_csv(output, "a") as f:
+                if state["fields"] is None:
+                    state["fields"] = list(rows[0].keys())
+                    csv.writer(f).writerow(state["fields"])
+                writer = csv.DictWriter(f, state["fields"],
+                                        extrasaction="ignore")
+                for row in rows:
+                    writer.writerow(row)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
@@ -0,0 +1,210 @@
+# Bootstrap of the validation metrics against the number of validation points
+#
+# validation.sensitivity() draws a few samples of every size for every flood.
+# The accuracy-vs-points curves need thousands of replicates to be smooth, so
+# here the replicates of every (method, flood) are split into chunks that run
+# in a pool of worker processes. The workers write the confusion counts
+# straight into one shared array:
+#
+#     counts[method, flood, replicate, level] = tp, tn, fp, fn
+#
+# (-1 for levels larger than the number of points of a flood), and the
+# confidence bands of every metric are percentiles over the replicates.
+#
+# Every replicate has its own random stream, seeded from (seed, method, flood,
+# replicate), so the results do not depend on the number of processes or on
+# the chunking:
+#
+#     points = pd.read_csv("data/gfd_validation_sensitivity.csv")
+#     result = bootstrap(points, np.arange(0, 400), replicates=2000, seed=1)
+#     curves = result.bands(pooled=True)
+
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+from flood_stats import validation
+
+# Shared state of the worker processes, set by _init_worker
+_worker = {}
+
+
+def replicate_rng(seed, method, flood, replicate):
+    """Random stream of one replicate"""
+    return np.random.default_rng(np.random.SeedSequence(
+        seed, spawn_key=(method, flood, replicate)))
+
+
+def _init_worker(buf, shape, codes, members, bounds, levels, seed):
+    _worker.update(buf=buf, shape=shape, codes=codes, members=members,
+                   bounds=bounds, levels=levels, seed=seed)
+
+
+def _run_chunk(task):
+    m, f, start, stop = task
+    w = _worker
+    counts = np.frombuffer(w["buf"], dtype=np.int32).reshape(w["shape"])
+    flood_codes = w["codes"][m][w["members"][w["bounds"][f]:w["bounds"][f + 1]]]
+    valid = w["levels"] <= len(flood_codes)
+    for r in range(start, stop):
+        rng = replicate_rng(w["seed"], m, f, r)
+        counts[m, f, r, valid] = validation.sample_counts(
+            flood_codes, w["levels"][valid], 1, rng)[0]
+    return stop - start
+
+
+class BootstrapResult(object):
+    """
+    Confusion counts of the bootstrap replicates.
+
+    Args:
+        counts: int array (methods, floods, replicates, levels, 4), -1 where
+                a level is larger than the number of points of a flood
+        methods, floods, levels: labels of the axes
+        seed: entropy the replicate streams were seeded from
+    """
+
+    def __init__(self, counts, methods, floods, levels, seed):
+        self.counts = counts
+        self.methods = list(methods)
+        self.floods = np.asarray(floods)
+        self.levels = np.asarray(levels)
+        self.seed = seed
+
+    def metric(self, name, drop_no_tp=True):
+        """
+        A metric of every replicate, array (methods, floods, replicates,
+        levels). NaN for missing levels and, with 'drop_no_tp', for the
+        samples without true positives.
+        """
+        counts = self.counts.astype(float)
+        values = validation.metrics(counts)[name]
+        missing = self.counts[..., 0] < 0
+        if drop_no_tp:
+            missing |= self.counts[..., 0] == 0
+        values[missing] = np.nan
+        return values
+
+    def bands(self, metrics=validation.METRICS, alpha=0.05, pooled=False,
+              drop_no_tp=True):
+        """
+        Mean, standard deviation and (1 - alpha) percentile band of metrics
+        over the replicates.
+
+        Args:
+            pooled: one curve per method, from the mean over floods of every
+                    replicate (the curves of main_validation.ipynb), instead
+                    of one per flood and method
+
+        Returns:
+            DataFrame with columns Method, (Flood,) NumofPoints, metric, mean,
+            std, lower, upper and n, the number of replicates with a value
+        """
+        import pandas as pd
+
+        n_methods, n_floods, _, n_levels = self.counts.shape[:4]
+        frames = []
+        for name in metrics:
+            values = self.metric(name, drop_no_tp)
+            if pooled:
+                values = _nanmean(values, axis=1)[:, None]
+            # Replicates last: (methods, floods, levels, replicates)
+            values = np.moveaxis(values, 2, -1)
+            n = np.sum(~np.isnan(values), axis=-1)
+            lower, upper = _nanpercentile(
+                values, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+            mean = _nanmean(values, axis=-1)
+            std = _nanstd(values, axis=-1)
+            shape = mean.shape
+            table = OrderedDict([
+                ("Method", np.repeat(self.methods, shape[1] * shape[2]))])
+            if not pooled:
+                table["Flood"] = np.tile(np.repeat(self.floods, n_levels),
+                                         n_methods)
+            table["NumofPoints"] = np.tile(self.levels, shape[0] * shape[1])
+            table["metric"] = name
+            for column, array in [("mean", mean), ("std", std),
+                                  ("lower", lower), ("upper", upper),
+                                  ("n", n)]:
+                table[column] = array.ravel()
+            frames.append(pd.DataFrame(table))
+        bands = pd.concat(frames, ignore_index=True)
+        return bands[bands["n"] > 0].reset_index(drop=True)
+
+
+# numpy warns on all-NaN slices, which are expected here (levels larger than
+# a flood, no true positives)
+def _nanmean(values, axis):
+    count = np.sum(~np.isnan(values), axis=axis)
+    total = np.nansum(values, axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return total / count
+
+
+def _nanstd(values, axis):
+    mean = np.expand_dims(_nanmean(values, axis), axis)
+    return np.sqrt(_nanmean((values - mean) ** 2, axis))
+
+
+def _nanpercentile(values, q):
+    import warnings
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanpercentile(values, q, axis=-1)
+
+
+def bootstrap(points, sampling_levels, replicates=1000, seed=None,
+              methods=None, flood_field="dfoID", score_field="score",
+              processes=None, chunk_size=50):
+    """
+    Confusion counts of 'replicates' random samples of every size in
+    'sampling_levels' of the validation points of every flood and method.
+
+    Args:
+        points: DataFrame of validation points
+        sampling_levels: sample sizes
+        replicates: number of samples of each size
+        seed: seed of the replicate streams, random if None (the entropy used
+              is kept in the result)
+        methods: dict of method name to scores, see
+                 validation.method_scores(). The 'score_field' column is used
+                 as the only method if None.
+        processes: number of worker processes, all cores if None. 1 runs in
+                   this process.
+        chunk_size: replicates per task
+
+    Returns:
+        BootstrapResult
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    codes = validation.method_codes(points, methods, score_field)
+    floods, members, bounds = validation.flood_members(points, flood_field)
+    levels = np.asarray(sampling_levels, dtype=int)
+
+    shape = (len(codes), len(floods), replicates, len(levels),
+             validation.OTHER)
+    buf = multiprocessing.RawArray("i", int(np.prod(shape)))
+    counts = np.frombuffer(buf, dtype=np.int32).reshape(shape)
+    counts[:] = -1
+
+    tasks = [(m, f, start, min(start + chunk_size, replicates))
+             for m in range(len(codes)) for f in range(len(floods))
+             for start in range(0, replicates, chunk_size)]
+    initargs = (buf, shape, list(codes.values()), members, bounds, levels,
+                seed)
+    if processes == 1:
+        _init_worker(*initargs)
+        for task in tasks:
+            _run_chunk(task)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, initargs)
+        try:
+            for _ in pool.imap_unordered(_run_chunk, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    return BootstrapResult(counts, codes.keys(), floods, levels, seed)
@@ -2,12 +2,19 @@
 # This file is a collection of functions that can be applied to outputted map layers from other functions
 # within the C2S API
 
+from flood_detection.utils import timing
+
+# Simplify the country/FPU polygons to this error (in meters) before reducing
+# over them (flood_detection/utils/roi.py), None reduces over the raw polygons
+ZONE_MAX_ERROR = None
+
 # --------------------------------------------------------
 # The function below was written by Devin Routh to compute
 # the estimated number of people affected
 # by the flood (according to the WorldPop dataset).
 # --------------------------------------------------------
 
+@timing.traced
 def getFloodPopbyCountry_LandScan(flood_img):
     """
     Args:
@@ -26,12 +33,13 @@ def getFloodPopbyCountry_LandScan(flood_img):
     """
     import ee
     ee.Initialize()
+    from flood_detection.utils import misc
 
     roi_geo = flood_img.geometry()
 
     # Import the LandScan image collection & permannt water mask
     pop_all = ee.ImageCollection("projects/global-flood-db/landscan")
-    perm_water = ee.Image("JRC/GSW1_0/GlobalSurfaceWater").select("transition").eq(1).unmask()
+    perm_water = misc.perm_water()
 
     def maskImages(img):
         non_flood = img.select("flooded")
@@ -78,7 +86,7 @@ def getFloodPopbyCountry_LandScan(flood_img):
         scale= map_scale,
         maxPixels= 1e9)
 
-        sys_id = ee.String(flood_img.get('system:index')).getInfo()
+        sys_id = flood_img.get('system:index')
 
         area = area_sum.get("flooded")
         return ee.Feature(None, {"system:index":sys_id,
@@ -99,6 +107,7 @@ def getFloodPopbyCountry_LandScan(flood_img):
 # by the flood (according to the WorldPop dataset).
 # --------------------------------------------------------
 
+@timing.traced
 def getFloodPopbyCountry_GHSLTimeConstant(flood_img):
     """
     Args:
@@ -117,12 +126,13 @@ def getFloodPopbyCountry_GHSLTimeConstant(flood_img):
     """
     import ee
     ee.Initialize()
+    from flood_detection.utils import misc
 
     roi_geo = flood_img.geometry()
 
     # Import the LandScan image collection & permannt water mask - clip to the study area
     pop_all = ee.ImageCollection("JRC/GHSL/P2016/POP_GPW_GLOBE_V1")
-    perm_water = ee.Image("JRC/GSW1_0/GlobalSurfaceWater").select("transition").eq(1).unmask()
+    perm_water = misc.perm_water()
 
     def maskImages(img):
         non_flood = img.select("flooded")
@@ -178,7 +188,7 @@ def getFloodPopbyCountry_GHSLTimeConstant(flood_img):
         pop_2000 = pop_2000_sum.get("population_count")
         pop_2015 = pop_2015_sum.get("population_count")
         area = area_sum.get("flooded")
-        sys_id = ee.String(flood_img.get('system:index')).getInfo()
+        sys_id = flood_img.get('system:index')
 
         return ee.Feature(None, {"system:index":sys_id,
                             "id": index,
@@ -193,6 +203,7 @@ def getFloodPopbyCountry_GHSLTimeConstant(flood_img):
     country_stats = ee.FeatureCollection(flood_countries).map(getCountriesPop)
     return ee.FeatureCollection(country_stats).set({"id":index})
 
+@timing.traced
 def getFloodPopbyCountry_GHSLTimeSeries(floodImage):
     """
     Args:
@@ -211,10 +222,11 @@ def getFloodPopbyCountry_GHSLTimeSeries(floodImage):
     """
     import ee
     ee.Initialize()
+    from flood_detection.utils import misc, roi
 
     roiGEO = floodImage.geometry()
 
-    permWater = ee.Image("JRC/GSW1_0/GlobalSurfaceWater").select("transition").eq(1).unmask()
+    permWater = misc.perm_water()
     def maskImages(image):
         nonFlood = image.select("flooded")
         waterMask = nonFlood.multiply(permWater.neq(1))
@@ -254,6 +266,8 @@ def getFloodPopbyCountry_GHSLTimeSeries(floodImage):
     countries = ee.FeatureCollection('projects/global-flood-db/fpu')
     #countries = ee.FeatureCollection('ft:1tdSwUL7MVpOauSgRzqVTOwdfy17KDbw-1d9omPw')
     getcountries = countries.filterBounds(floodExtent.geometry().bounds())
+    if ZONE_MAX_ERROR is not None:
+        getcountries = roi.ee_simplify_features(getcountries, ZONE_MAX_ERROR)
 
     # Get area of flood in the scale of the flood map
     floodAreaImg = floodExtent.multiply(ee.Image.pixelArea())
@@ -278,7 +292,7 @@ def getFloodPopbyCountry_GHSLTimeSeries(floodImage):
         scale= map_scale,
         maxPixels= 1e9)
 
-        si = ee.String(floodImage.get('system:index')).getInfo()
+        si = floodImage.get('system:index')
 
         area = areasum.get("flooded")
         return ee.Feature(None, {"system:index":si,
@@ -294,6 +308,7 @@ def getFloodPopbyCountry_GHSLTimeSeries(floodImage):
     stat= ee.FeatureCollection(getcountries).map(countrieswithpop)
     return ee.FeatureCollection(stat).set({"id":index})
 
+@timing.traced
 def get_flood_PopbyCountryCIESEN(floodImage):
     """
     Args:
@@ -312,10 +327,11 @@ def get_flood_PopbyCountryCIESEN(floodImage):
     """
     import ee
     ee.Initialize()
+    from flood_detection.utils import misc
 
     roiGEO = floodImage.geometry()
 
-    permWater = ee.Image("JRC/GSW1_0/GlobalSurfaceWater").select("transition").eq(1)
+    permWater = misc.perm_water(unmask=False)
     def maskImages(image):
         nonFlood = image.select("flooded")
         waterMask = nonFlood.multiply(permWater.neq(1))
@@ -385,6 +401,7 @@ def get_flood_PopbyCountryCIESEN(floodImage):
     stat= ee.FeatureCollection(getcountries).map(countrieswithpop)
     return ee.FeatureCollection(stat).set({"Index":index})
 
+@timing.traced
 def get_flood_PopArea_CIESIN(floodImage):
     """
     Function to compute the estimated affected population and area (in square meters) of a flood event
@@ -459,6 +476,7 @@ def get_flood_PopArea_CIESIN(floodImage):
 
     return ee.Feature(ee.Geometry.Point([100,100]),results).copyProperties(floodImage)
 
+@timing.traced
 def get_flood_PopArea_CIESINdensity(floodImage):
     """
     Function to compute the estimated affected population and area (in square meters) of a flood event
@@ -478,10 +496,11 @@ def get_flood_PopArea_CIESINdensity(floodImage):
     """
     import ee
     ee.Initialize()
+    from flood_detection.utils import misc
 
     roiGEO = floodImage.geometry()
 
-    permWater = ee.Image("JRC/GSW1_0/GlobalSurfaceWater").select("transition").eq(1)
+    permWater = misc.perm_water(unmask=False)
     def maskImages(image):
         nonFlood = image.select("flooded")
         waterMask = nonFlood.multiply(permWater.neq(1))
@@ -543,6 +562,7 @@ def get_flood_PopArea_CIESINdensity(floodImage):
 
     return ee.Feature(ee.Geometry.Point([100,100]),results).copyProperties(floodImage)
 
+@timing.traced
 def get_flood_PopArea_WP(floodImage):
     """
     Function to compute the estimated affected population and area (in square meters) of a flood event
@@ -620,6 +640,60 @@ def get_flood_PopArea_WP(floodImage):
 
     return ee.Feature(ee.Geometry.Point([100,100]),results).copyProperties(floodImage)
 
+@timing.traced
+def getFloodPopSensitivity(floodImage, zones, popImages, settlement, scale=250):
+    """
+    Flood exposed population of several population products split by GHSL
+    settlement class, for every zone in one reduction (see
+    main_popsensitivity.txt). All products and classes are bands of one image
+    reduced with a single reduceRegions instead of one reduceRegion per
+    product, class and zone. Flooded fractions per zone and product can also be
+    computed locally with flood_stats.zonal.MultiExposure.
+
+    Args:
+        floodImage : image with a "flooded" band, e.g. the cleaned GFD sum
+        zones : ee.FeatureCollection of countries or watersheds
+        popImages : dict of product name -> single band population count image
+        settlement : GHSL settlement model image with a 'smod_code' band
+        scale : scale (in meters) of the reduction
+
+    Returns:
+        - the zones with the properties 'floodpop_<product>_<class>' and
+          'floodpop_<product>_tot' for the classes 'rural', 'semiurban' and
+          'urban', the columns of gfd_popsensitivity.csv
+
+    The products have different native scales. Counts are converted to people
+    per square meter in their own projection and multiplied by the pixel area
+    at 'scale', which keeps the population totals of each product.
+    """
+    import ee
+    ee.Initialize()
+    from flood_detection.utils import misc, roi
+
+    flooded = floodImage.select("flooded").gte(1).And(misc.perm_water().neq(1))
+    smod = settlement.select('smod_code')
+    classes = [("rural", smod.lte(1)),
+               ("semiurban", smod.eq(2)),
+               ("urban", smod.eq(3))]
+
+    bands = []
+    for name in sorted(popImages):
+        pop = ee.Image(popImages[name]).select([0])
+        density = pop.divide(ee.Image.pixelArea().reproject(pop.projection()))
+        flood_pop = density.multiply(ee.Image.pixelArea()).updateMask(flooded)
+        for class_name, class_mask in classes:
+            bands.append(flood_pop.multiply(class_mask)
+                         .rename(['floodpop_{0}_{1}'.format(name, class_name)]))
+        bands.append(flood_pop.multiply(smod.lte(3))
+                     .rename(['floodpop_{0}_tot'.format(name)]))
+
+    if ZONE_MAX_ERROR is not None:
+        zones = roi.ee_simplify_features(zones, ZONE_MAX_ERROR)
+    return ee.Image.cat(bands).reduceRegions(collection=zones,
+                                             reducer=ee.Reducer.sum(),
+                                             scale=scale,
+                                             tileScale=16)
+
 # --------------------------------------------------------
 # The function below was written by Devin Routh to output
 # precipitation data for each event in order to compute
@@ -627,6 +701,7 @@ def get_flood_PopArea_WP(floodImage):
 # a hyetograph.
 # --------------------------------------------------------
 
+@timing.traced
 def create_Flood_Precip_Series(dateRangeOI, roiGEO):
     """
     Function to compute the daily precipitation series for the event
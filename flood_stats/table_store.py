@@ -0,0 +1,209 @@
+# Columnar store for the compiled exposure and validation tables in data/
+#
+# The analysis inputs are wide CSVs that the notebook and the R scripts parse
+# in full and filter on every run. ingest() converts each of them once to a
+# typed Parquet dataset sorted on the columns the analyses filter by (year and
+# country for the event exposure tables, dfoID for the validation points), and
+# query() reads only the files, row groups and columns asked for:
+#
+#     store = TableStore("data/parquet")
+#     store.ingest_all()
+#     store.query("pop_ghsl_ts", columns=["index", "area", "exposed"],
+#                 filters={"year": 2010, "country": "Pakistan"})
+#
+# The tables are small (a few hundred KB of CSV), so only the exposure tables
+# are partitioned, on year. A partition per country or per event writes
+# thousands of tiny files that take longer to list and open than to read the
+# whole table. Filters on the sort columns use the min/max statistics of the
+# row groups instead, which skip the row groups without matching rows.
+#
+# Parquet needs pyarrow, which is only imported when the store is used.
+
+import glob
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+# Rows per Parquet row group, small enough for the row group statistics to
+# skip most of a table on a filter of its sort columns
+ROW_GROUP_ROWS = 1024
+
+# Source CSVs (globs, relative to data/), partition columns, sort columns and
+# column types of every table. Files matched by a glob are stacked, with the
+# part of the file name matched by '*' in the 'source_column'.
+TABLES = OrderedDict([
+    ("pop_ghsl_ts", {
+        "source": "compiled_pop_ghsl_ts_2019_08_04.csv",
+        "partition": ["year"],
+        "sort": ["country"],
+        "types": {"index": "int64", "year": "int64", "month": "int64",
+                  "day": "int64"}}),
+    ("pop_ghsl_ts_wbias", {
+        "source": "compiled_pop_ghsl_ts_wbias_2019_08_04.csv",
+        "partition": ["year"],
+        "sort": ["country"],
+        "types": {"index": "int64", "year": "int64", "month": "int64",
+                  "day": "int64"}}),
+    ("validation_sensitivity", {
+        "source": "gfd_validation_sensitivity.csv",
+        "sort": ["dfoID"],
+        "types": {"dfoID": "int64", "id": "int64", "strata": "int64",
+                  "validation": "int64", "score": "int64"}}),
+    ("validation_metrics", {
+        "source": "gfd_validation_metrics.csv",
+        "sort": ["Flood"],
+        "types": {}}),
+    ("flood_mechanism", {
+        "source": "gfd_floodmechanism.csv",
+        "sort": ["country"],
+        "types": {}}),
+    ("pop_sensitivity", {
+        "source": "gfd_popsensitivity.csv",
+        "sort": ["world_region"],
+        "types": {}}),
+    ("pop_sensitivity_regions", {
+        "source": "pop_sensitivity_analysis/sensitivity_analysis_*_20210105.csv",
+        "source_column": "region",
+        "sort": ["region"],
+        "types": {},
+        "drop": [".geo"]}),
+])
+
+
+def read_source(spec, data_dir=DATA_DIR):
+    """Read and type the source CSVs of a table as one DataFrame"""
+    import pandas as pd
+
+    pattern = os.path.join(data_dir, spec["source"])
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise IOError("No files match {0}".format(pattern))
+    prefix, suffix = pattern.split("*") if "*" in pattern else (pattern, "")
+    frames = []
+    for path in paths:
+        df = pd.read_csv(path)
+        if spec.get("source_column"):
+            df[spec["source_column"]] = path[len(prefix):len(path) - len(suffix)]
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+
+    # Row numbers written by pandas/R
+    drop = [c for c in df.columns if c == "" or c.startswith("Unnamed:")]
+    df = df.drop(drop + [c for c in spec.get("drop", []) if c in df.columns],
+                 axis=1)
+    for column, dtype in spec.get("types", {}).items():
+        df[column] = df[column].astype(dtype)
+    return df
+
+
+def _expression(filters):
+    import pyarrow.dataset as ds
+
+    if filters is None or not isinstance(filters, dict):
+        return filters
+    expression = None
+    for column, value in filters.items():
+        if isinstance(value, (list, tuple, set)):
+            term = ds.field(column).isin(list(value))
+        else:
+            term = ds.field(column) == value
+        expression = term if expression is None else expression & term
+    return expression
+
+
+class TableStore(object):
+    """
+    Partitioned Parquet datasets, one directory per table.
+
+    Args:
+        root: directory of the store
+        tables: table specs, defaults to TABLES
+    """
+
+    def __init__(self, root, tables=TABLES, data_dir=DATA_DIR):
+        self.root = root
+        self.tables = tables
+        self.data_dir = data_dir
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _meta_path(self, name):
+        return os.path.join(self.root, name + ".json")
+
+    def ingest(self, name, df=None):
+        """
+        Write a table (read from its source CSVs if 'df' is not given),
+        replacing what is stored. Returns the number of rows.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        spec = self.tables[name]
+        if df is None:
+            df = read_source(spec, self.data_dir)
+        partition = spec.get("partition") or []
+        sort = partition + (spec.get("sort") or [])
+        if sort:
+            df = df.sort_values(sort, kind="mergesort")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        if os.path.exists(self._path(name)):
+            shutil.rmtree(self._path(name))
+        partitioning = None
+        if partition:
+            partitioning = ds.partitioning(
+                pa.schema([table.schema.field(c) for c in partition]),
+                flavor="hive")
+        ds.write_dataset(table, self._path(name), format="parquet",
+                         partitioning=partitioning,
+                         min_rows_per_group=ROW_GROUP_ROWS,
+                         max_rows_per_group=ROW_GROUP_ROWS)
+        meta = {"source": spec["source"], "rows": table.num_rows,
+                "partition": partition, "sort": sort,
+                "columns": OrderedDict((f.name, str(f.type))
+                                       for f in table.schema)}
+        with open(self._meta_path(name), "w") as f:
+            json.dump(meta, f, indent=1)
+        return table.num_rows
+
+    def ingest_all(self):
+        for name in self.tables:
+            rows = self.ingest(name)
+            print("{0}: {1} rows".format(name, rows))
+
+    def meta(self, name):
+        with open(self._meta_path(name)) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+
+    def dataset(self, name):
+        """The pyarrow dataset of a table, with typed partition columns"""
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        meta = self.meta(name)
+        partitioning = None
+        if meta["partition"]:
+            partitioning = ds.partitioning(
+                pa.schema([(c, pa.type_for_alias(meta["columns"][c]))
+                           for c in meta["partition"]]), flavor="hive")
+        return ds.dataset(self._path(name), format="parquet",
+                          partitioning=partitioning)
+
+    def query(self, name, columns=None, filters=None):
+        """
+        Read part of a table as a DataFrame.
+
+        Args:
+            columns: columns to read, all if None
+            filters: dict of column -> value (or list of values), or a
+                     pyarrow.dataset expression. Filters on partition
+                     columns skip the other partitions' files entirely,
+                     filters on sort columns skip row groups.
+        """
+        table = self.dataset(name).to_table(columns=columns,
+                                            filter=_expression(filters))
+        return table.to_pandas()
@@ -0,0 +1,214 @@
+# Sweep of the static DFO thresholds against the validation points
+#
+# The 'standard' thresholds (b1b2 ratio < 0.70, band 1 < 2027, band 7 < 675,
+# see modis_local.water_flag) were never swept, because every try was a full
+# dfo run. Here only the validation points are evaluated: their time series
+# are read once from the event stack, and every (b1b2, b1, b7) triple of a
+# grid is scored from those series in one pass.
+#
+# A water flag is the orthant b1b2 < t1, b1 < t2, b7 < t3, so with each grid
+# sorted, the position of a value in it (searchsorted) says for which grid
+# values the test passes, and the flags of an image for the whole grid are a
+# cumulative indicator of those three positions. The 2/3-day composites are
+# sums of the flags over the days before each image, the same for every
+# threshold, and a point is flooded when at least two composites pass, like
+# duration >= 1 in dfo(). The confusion counts of every triple then come
+# from summing over the points:
+#
+#     grid = ThresholdGrid(np.arange(0.5, 0.9, 0.02), [2027],
+#                          np.arange(400, 1000, 25))
+#     surface = sweep(load_event, points, grid)
+#
+# The points are scored as in validation.py: the model class of a point is
+# flood/dry from the sweep, and the points the model marked as permanent
+# water (scores 2 and 3) are left out.
+
+from collections import OrderedDict
+
+import numpy as np
+
+from flood_detection import modis_local
+from flood_detection.utils import tiled_raster
+from flood_stats import validation
+
+
+class ThresholdGrid(object):
+    """
+    Grid of water flag thresholds.
+
+    Args:
+        b1b2, b1, b7: threshold values to try for the b1b2 ratio, band 1
+                      (red_250m) and band 7 (swir), sorted here
+    """
+
+    def __init__(self, b1b2, b1, b7):
+        # Thresholds are compared in the float32 of the bands, like in
+        # modis_local.water_flag()
+        self.axes = OrderedDict(
+            (name, np.unique(np.asarray(values, np.float32)))
+            for name, values in [("b1b2", b1b2), ("b1", b1), ("b7", b7)])
+
+    @property
+    def shape(self):
+        return tuple(len(v) for v in self.axes.values())
+
+    def positions(self, b1b2, red, swir):
+        """
+        Index of the first grid value above each band value, per axis. The
+        flag of a value passes for all grid values from that index on (NaN
+        never passes).
+        """
+        return [np.searchsorted(axis, np.asarray(values, np.float32),
+                                side="right")
+                for axis, values in zip(self.axes.values(), [b1b2, red, swir])]
+
+    def table(self):
+        """Columns of every grid triple, in the order of a flattened surface"""
+        mesh = np.meshgrid(*self.axes.values(), indexing="ij")
+        return OrderedDict((name, m.ravel()) for name, m in
+                           zip(self.axes, mesh))
+
+
+def point_pixels(lat, lon, window):
+    """Rows and columns of points in a window of the GFD grid"""
+    rows = np.floor((tiled_raster.GRID_ORIGIN[1] - np.asarray(lat)) /
+                    tiled_raster.PIXEL_DEG).astype(np.int64) - window[0].start
+    cols = np.floor((np.asarray(lon) - tiled_raster.GRID_ORIGIN[0]) /
+                    tiled_raster.PIXEL_DEG).astype(np.int64) - window[1].start
+    n_rows = window[0].stop - window[0].start
+    n_cols = window[1].stop - window[1].start
+    if (rows < 0).any() or (rows >= n_rows).any() or (cols < 0).any() or \
+            (cols >= n_cols).any():
+        raise ValueError("Points outside of the window")
+    return rows, cols
+
+
+def point_series(stack, dates, began, ended, rows, cols, preprocessed=False):
+    """
+    b1b2 ratio, band 1 and band 7 time series (time, points) of pixels of
+    the event stack, with the same date range and preprocessing as dfo()
+    """
+    stack, days = modis_local.select_stack(stack, dates, began, ended)
+    band_names = modis_local.PREPROCESSED_BANDS if preprocessed \
+        else modis_local.RAW_BANDS
+    # The points as a (time, band, points, 1) stack, preprocessing is per pixel
+    img = modis_local.from_stack(stack[:, :, rows, cols][..., None],
+                                 band_names)
+    if not preprocessed:
+        img = modis_local.b1b2_ratio(modis_local.pan_sharpen(img))
+    series = OrderedDict((name, img[name][..., 0]) for name in
+                         ["b1b2_ratio", "red_250m", "swir"])
+    return series, days
+
+
+def flood_views(series, days, grid, lag_days, comp_days, chunk_size=256):
+    """
+    Number of composites flagged as flood water, for every point and grid
+    triple, array (points,) + grid.shape
+    """
+    n_points = series["b1b2_ratio"].shape[1]
+    pos = grid.positions(series["b1b2_ratio"], series["red_250m"],
+                         series["swir"])
+    # Images joined to each image, see modis_local.join_previous_days
+    day_num = modis_local.as_days(days).astype(np.int64)
+    delta = day_num[:, None] - day_num[None, :]
+    matches = ((delta >= 0) & (delta <= lag_days)).astype(np.uint8)
+
+    i0, i1, i2 = np.ix_(*[np.arange(n) for n in grid.shape])
+    views = np.empty((n_points,) + grid.shape, np.uint16)
+    for start in range(0, n_points, chunk_size):
+        p = slice(start, start + chunk_size)
+        # Flags (time, points) + grid.shape: a test passes for all grid values
+        # from the position of the band value on
+        flags = (i0 >= pos[0][:, p, None, None, None]) & \
+                (i1 >= pos[1][:, p, None, None, None]) & \
+                (i2 >= pos[2][:, p, None, None, None])
+        counts = np.tensordot(matches, flags.astype(np.uint8), axes=(1, 0))
+        views[p] = (counts >= comp_days).sum(axis=0)
+    return views
+
+
+def sweep_event(series, days, student, grid, began, my_comp="3Day",
+                exclude=None, inside=None):
+    """
+    Confusion counts of every grid triple for the points of one event.
+
+    Args:
+        series, days: see point_series()
+        student: validation class of each point (1 = flooded, 0 = dry)
+        exclude: boolean mask of points to leave out (permanent water)
+        inside: boolean mask of points inside the roi, the others are never
+                flooded (like the roi_mask of dfo())
+
+    Returns:
+        array grid.shape + (4,) of tp, tn, fp, fn
+    """
+    student = np.asarray(student)
+    keep = (student == 0) | (student == 1)
+    if exclude is not None:
+        keep &= ~np.asarray(exclude, bool)
+    series = OrderedDict((name, band[:, keep]) for name, band in
+                         series.items())
+    views = flood_views(series, days, grid, modis_local.LAG_DAYS[my_comp],
+                        modis_local.composite_days(began, my_comp))
+    # duration = views // 2 >= 1
+    flooded = views >= 2
+    if inside is not None:
+        flooded &= np.asarray(inside, bool)[keep].reshape(
+            (-1,) + (1,) * len(grid.shape))
+    wet = student[keep] == 1
+    counts = np.empty(grid.shape + (len(validation.CONFUSION),))
+    counts[..., 0] = flooded[wet].sum(axis=0)
+    counts[..., 1] = (~flooded[~wet]).sum(axis=0)
+    counts[..., 2] = flooded[~wet].sum(axis=0)
+    counts[..., 3] = (~flooded[wet]).sum(axis=0)
+    return counts
+
+
+def sweep(load_event, points, grid, my_comp="3Day", flood_field="dfoID",
+          student_field="validation", score_field="score",
+          preprocessed=False):
+    """
+    Precision/recall surface of every event with validation points.
+
+    Args:
+        load_event: function from a DFO ID to a dict with the event 'stack',
+                    'dates', 'began', 'ended', the 'window' of the GFD grid
+                    the stack covers and optionally its 'roi_mask'
+        points: DataFrame of validation points with lat/lon, e.g.
+                data/gfd_validation_sensitivity.csv
+        grid: ThresholdGrid
+
+    Returns:
+        DataFrame with one row per event and grid triple: Flood, b1b2, b1,
+        b7, tp, tn, fp, fn and validation.METRICS
+    """
+    import pandas as pd
+
+    frames = []
+    floods, members, bounds = validation.flood_members(points, flood_field)
+    for f, dfo_id in enumerate(floods):
+        event_points = points.iloc[members[bounds[f]:bounds[f + 1]]]
+        event = load_event(dfo_id)
+        rows, cols = point_pixels(event_points["lat"].values,
+                                  event_points["lon"].values, event["window"])
+        series, days = point_series(event["stack"], event["dates"],
+                                    event["began"], event["ended"], rows, cols,
+                                    preprocessed)
+        # Scores 2 and 3 are the points the model marked as permanent water
+        exclude = None
+        if score_field in event_points:
+            exclude = np.isin(event_points[score_field].values, [2, 3])
+        inside = None
+        if event.get("roi_mask") is not None:
+            inside = np.asarray(event["roi_mask"], bool)[rows, cols]
+        counts = sweep_event(series, days, event_points[student_field].values,
+                             grid, event["began"], my_comp, exclude, inside)
+        table = OrderedDict([("Flood", dfo_id)])
+        table.update(grid.table())
+        counts = counts.reshape(-1, len(validation.CONFUSION))
+        for i, name in enumerate(validation.CONFUSION):
+            table[name] = counts[:, i]
+        table.update(validation.metrics(counts))
+        frames.append(pd.DataFrame(table))
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,251 @@
+# Confusion-matrix metrics of the flood maps against the validation points
+#
+# main_validation.ipynb scores every validation point as
+# model_score * 2 + student_score, where the model (DFO) classes are 0 = dry,
+# 1 = permanent water and 2 = flood and the student classes are 0 = dry and
+# 1 = flooded:
+#
+#     5 = true positive      0 = true negative
+#     4 = false positive     1 = false negative
+#
+# and 2/3 are permanent water, which is left out of the metrics. The sampling
+# sensitivity analysis was a loop over floods and sample sizes that resampled
+# the points and appended one row at a time to a DataFrame. Here the points
+# are coded once to confusion classes and the counts of every (flood, method,
+# sample size, replicate) come out of array operations into preallocated
+# columns:
+#
+#     points = pd.read_csv("data/gfd_validation_sensitivity.csv")
+#     table = sensitivity(points, np.arange(0, 400), replicates=10)
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Scores of the confusion classes, in the order of the count columns
+CONFUSION = OrderedDict([("tp", 5), ("tn", 0), ("fp", 4), ("fn", 1)])
+METRICS = ["precision", "recall", "overall_accuracy", "commission", "omission"]
+
+# Code of the points that are in no confusion class (permanent water, bad
+# scores)
+OTHER = len(CONFUSION)
+
+
+def valid_points(points, field="validation"):
+    """Drop the points the students labeled NaN (coded as -99 or 99)"""
+    return points[(points[field] > -1) & (points[field] < 99)]
+
+
+def score(model, student):
+    """Score of each point, model class * 2 + student class"""
+    return np.asarray(model) * 2 + np.asarray(student)
+
+
+def confusion_codes(scores):
+    """
+    Index of the confusion class of each score in CONFUSION, OTHER for
+    permanent water and anything else.
+    """
+    scores = np.asarray(scores)
+    codes = np.full(scores.shape, OTHER, dtype=np.int8)
+    for i, value in enumerate(CONFUSION.values()):
+        codes[scores == value] = i
+    return codes
+
+
+def metrics(counts):
+    """
+    Metrics from confusion counts.
+
+    Args:
+        counts: array (..., 4) of tp, tn, fp, fn
+
+    Returns:
+        OrderedDict of METRICS to arrays of shape counts.shape[:-1], NaN where
+        a metric is undefined (e.g. precision without positives)
+    """
+    counts = np.asarray(counts, dtype=float)
+    tp, tn, fp, fn = [counts[..., i] for i in range(len(CONFUSION))]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return OrderedDict([
+            ("precision", tp / (tp + fp)),
+            ("recall", tp / (tp + fn)),
+            ("overall_accuracy", (tp + tn) / (tp + tn + fp + fn)),
+            ("commission", fp / (tp + fp)),
+            ("omission", fn / (tp + fn)),
+        ])
+
+
+def method_scores(points, methods, student_field="validation"):
+    """
+    Scores of every method, for validation points with one model class
+    column per method (std_2day, otsu_3day, ...).
+
+    Returns:
+        OrderedDict of method name to scores
+    """
+    return OrderedDict((m, score(points[m], points[student_field]))
+                       for m in methods)
+
+
+def method_codes(points, methods=None, score_field="score"):
+    """
+    Confusion codes of every method, from a dict of method name to scores or
+    from the 'score_field' column if 'methods' is None
+    """
+    if methods is None:
+        methods = OrderedDict([(score_field, points[score_field].values)])
+    return OrderedDict((m, confusion_codes(s)) for m, s in methods.items())
+
+
+def flood_members(points, flood_field="dfoID"):
+    """
+    Floods and the positions of their points: the points of floods[i] are
+    points.iloc[members[bounds[i]:bounds[i + 1]]]
+    """
+    floods, flood_index = np.unique(points[flood_field].values,
+                                    return_inverse=True)
+    members = np.argsort(flood_index, kind="mergesort")
+    bounds = np.searchsorted(flood_index[members], np.arange(len(floods) + 1))
+    return floods, members, bounds
+
+
+def _table(columns, counts):
+    import pandas as pd
+
+    table = OrderedDict(columns)
+    for i, name in enumerate(CONFUSION):
+        table[name] = counts[:, i]
+    table.update(metrics(counts))
+    return pd.DataFrame(table)
+
+
+def method_metrics(points, methods=None, flood_field="dfoID",
+                   score_field="score"):
+    """
+    Confusion counts and metrics of every flood and method on all points,
+    like data/gfd_validation_metrics.csv.
+
+    Args:
+        points: DataFrame of validation points
+        methods: dict of method name to scores, see method_scores(). The
+                 'score_field' column is used as the only method if None.
+
+    Returns:
+        DataFrame with one row per flood and method
+    """
+    codes = method_codes(points, methods, score_field)
+    floods, flood_index = np.unique(points[flood_field].values,
+                                    return_inverse=True)
+    n_floods, n_codes = len(floods), OTHER + 1
+    counts = np.empty((len(codes) * n_floods, OTHER))
+    for m, point_codes in enumerate(codes.values()):
+        binned = np.bincount(flood_index * n_codes + point_codes,
+                             minlength=n_floods * n_codes)
+        counts[m * n_floods:(m + 1) * n_floods] = \
+            binned.reshape(n_floods, n_codes)[:, :OTHER]
+
+    return _table([("Flood", np.tile(floods, len(codes))),
+                   ("Method", np.repeat(list(codes), n_floods)),
+                   ("counts", counts.sum(1).astype(int))], counts)
+
+
+def sample_counts(codes, sizes, replicates, rng, max_cells=2 ** 22):
+    """
+    Confusion counts of random samples of points without replacement.
+
+    Every (size, replicate) is an independent sample: each point gets a
+    random key and the sample of size j is the j points with the smallest
+    keys, so one sort of the keys gives the samples of every size.
+
+    Args:
+        codes: confusion codes of the points of one flood
+        sizes: sample sizes, at most len(codes)
+        replicates: number of samples of each size
+        rng: numpy RandomState or Generator
+        max_cells: bound on the number of random keys drawn at once
+
+    Returns:
+        array (replicates, len(sizes), 4) of tp, tn, fp, fn
+    """
+    codes = np.asarray(codes)
+    sizes = np.asarray(sizes, dtype=int)
+    n = len(codes)
+    onehot = np.zeros((n, OTHER))
+    in_class = codes < OTHER
+    onehot[np.nonzero(in_class)[0], codes[in_class]] = 1
+
+    out = np.zeros((replicates, len(sizes), OTHER))
+    chunk = max(1, max_cells // max(1, len(sizes) * n))
+    has_points = sizes > 0
+    for start in range(0, replicates, chunk):
+        stop = min(start + chunk, replicates)
+        keys = rng.random((stop - start, len(sizes), n))
+        # Largest key in each sample
+        cutoff = np.sort(keys, axis=2)[:, has_points, sizes[has_points] - 1]
+        chosen = keys[:, has_points] <= cutoff[..., None]
+        out[start:stop, has_points] = np.dot(chosen, onehot)
+    return out
+
+
+def sensitivity(points, sampling_levels, replicates=1, seed=None,
+                methods=None, flood_field="dfoID", score_field="score",
+                drop_no_tp=True):
+    """
+    Metrics of random samples of the validation points of every flood, for
+    every method, sample size and replicate.
+
+    Args:
+        points: DataFrame of validation points
+        sampling_levels: sample sizes. Sizes larger than the number of
+                         points of a flood are skipped for that flood.
+        replicates: number of samples of each size
+        seed: seed of the random samples
+        methods: dict of method name to scores, see method_scores(). The
+                 'score_field' column is used as the only method if None.
+        drop_no_tp: drop the samples without true positives, like the
+                    notebook did
+
+    Returns:
+        DataFrame with columns Flood, Method, NumofPoints, replicate, the
+        confusion counts and METRICS
+    """
+    rng = np.random.RandomState(seed)
+    codes = method_codes(points, methods, score_field)
+    sampling_levels = np.asarray(sampling_levels, dtype=int)
+    floods, members, bounds = flood_members(points, flood_field)
+
+    # Preallocate every row: method x flood x size x replicate
+    blocks = []
+    n_rows = 0
+    for f in range(len(floods)):
+        sizes = sampling_levels[sampling_levels <= bounds[f + 1] - bounds[f]]
+        blocks.append((f, sizes, n_rows))
+        n_rows += len(sizes) * replicates
+    total = n_rows * len(codes)
+    flood_col = np.empty(total, dtype=floods.dtype)
+    method_col = np.empty(total, dtype=object)
+    size_col = np.empty(total, dtype=int)
+    replicate_col = np.empty(total, dtype=int)
+    counts = np.empty((total, OTHER))
+
+    for m, (method, point_codes) in enumerate(codes.items()):
+        for f, sizes, offset in blocks:
+            start = m * n_rows + offset
+            stop = start + len(sizes) * replicates
+            flood_codes = point_codes[members[bounds[f]:bounds[f + 1]]]
+            sampled = sample_counts(flood_codes, sizes, replicates, rng)
+            # Rows ordered by size, then replicate
+            counts[start:stop] = sampled.transpose(1, 0, 2).reshape(-1, OTHER)
+            flood_col[start:stop] = floods[f]
+            method_col[start:stop] = method
+            size_col[start:stop] = np.repeat(sizes, replicates)
+            replicate_col[start:stop] = np.tile(np.arange(replicates),
+                                                len(sizes))
+
+    table = _table([("Flood", flood_col), ("Method", method_col),
+                    ("NumofPoints", size_col), ("replicate", replicate_col)],
+                   counts)
+    if drop_no_tp:
+        table = table[counts[:, 0] > 0].reset_index(drop=True)
+    return table
@@ -0,0 +1,421 @@
+# Local zonal statistics for population exposure
+#
+# The getFloodPopbyCountry_* functions in pop_utils.py map over every
+# country/FPU feature and run two reduceRegion calls for each (population and
+# flooded area). Here the zone polygons are rasterized once to the population
+# grid and the flood grid, the 250-m flood map is converted to the fraction of
+# each population pixel that is flooded with exact area-overlap weights, and
+# the flooded population of every zone and every population product comes out
+# of a single bincount.
+#
+# Grids are regular lon/lat grids (EPSG:4326) described by a Grid. Population
+# products on another projection have to be resampled to one first.
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Radius of the authalic sphere, for pixel areas in square meters
+EARTH_RADIUS = 6371007.181
+
+
+class Grid(object):
+    """
+    A regular lon/lat grid.
+
+    Args:
+        west, north: coordinates of the top left corner
+        pixel_width, pixel_height: pixel size in degrees
+        shape: (rows, cols)
+    """
+
+    def __init__(self, west, north, pixel_width, pixel_height, shape):
+        self.west = float(west)
+        self.north = float(north)
+        self.pixel_width = float(pixel_width)
+        self.pixel_height = float(pixel_height)
+        self.shape = tuple(int(n) for n in shape)
+
+    @classmethod
+    def from_window(cls, window):
+        """Grid of a (row slice, col slice) window of the global GFD grid"""
+        from flood_detection.utils import tiled_raster
+
+        west, south, east, north = tiled_raster.window_to_bounds(window)
+        return cls(west, north, tiled_raster.PIXEL_DEG, tiled_raster.PIXEL_DEG,
+                   (window[0].stop - window[0].start,
+                    window[1].stop - window[1].start))
+
+    def x_edges(self):
+        return self.west + np.arange(self.shape[1] + 1) * self.pixel_width
+
+    def y_edges(self):
+        return self.north - np.arange(self.shape[0] + 1) * self.pixel_height
+
+    def pixel_area(self):
+        """Area of the pixels of each row in square meters"""
+        lat = np.radians(self.y_edges())
+        return EARTH_RADIUS ** 2 * np.radians(self.pixel_width) * \
+            (np.sin(lat[:-1]) - np.sin(lat[1:]))
+
+
+def _polygons(geometry):
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    if geometry["type"] == "GeometryCollection":
+        return [p for g in geometry["geometries"] for p in _polygons(g)]
+    return []
+
+
+def polygon_mask(geometry, grid):
+    """
+    Boolean mask of the grid pixels with their center inside a GeoJSON
+    (Multi)Polygon, the pixels reduceRegion counts for a geometry. Holes and
+    multiple parts are handled with the even-odd rule.
+    """
+    rings = [np.asarray(ring, np.float64)[:, :2]
+             for polygon in _polygons(geometry) for ring in polygon]
+    mask = np.zeros(grid.shape, bool)
+    if not rings:
+        return mask
+    start = np.concatenate([r[:-1] for r in rings])
+    end = np.concatenate([r[1:] for r in rings])
+    start, end = start[start[:, 1] != end[:, 1]], end[start[:, 1] != end[:, 1]]
+
+    # Rows whose center line crosses each edge, half open so vertices shared
+    # by two edges are counted once
+    y_lo = np.minimum(start[:, 1], end[:, 1])
+    y_hi = np.maximum(start[:, 1], end[:, 1])
+    r_first = np.floor((grid.north - y_hi) / grid.pixel_height - 0.5).astype(np.int64) + 1
+    r_last = np.floor((grid.north - y_lo) / grid.pixel_height - 0.5).astype(np.int64)
+    r_first = np.maximum(r_first, 0)
+    r_last = np.minimum(r_last, grid.shape[0] - 1)
+    n_rows = np.maximum(r_last - r_first + 1, 0)
+    if n_rows.sum() == 0:
+        return mask
+
+    edge = np.repeat(np.arange(len(start)), n_rows)
+    offset = np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    rows = r_first[edge] + offset
+    y = grid.north - (rows + 0.5) * grid.pixel_height
+    x0, y0 = start[edge, 0], start[edge, 1]
+    x = x0 + (y - y0) * (end[edge, 0] - x0) / (end[edge, 1] - y0)
+    cols = np.ceil((x - grid.west) / grid.pixel_width - 0.5).astype(np.int64)
+
+    # Pixels between each pair of crossings on a row are inside
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], np.clip(cols[order], 0, grid.shape[1])
+    span_rows, span_start, span_stop = rows[0::2], cols[0::2], cols[1::2]
+    diff = np.zeros((grid.shape[0], grid.shape[1] + 1), np.int32)
+    np.add.at(diff, (span_rows, span_start), 1)
+    np.add.at(diff, (span_rows, span_stop), -1)
+    return np.cumsum(diff[:, :-1], axis=1) > 0
+
+
+def rasterize(geometries, grid):
+    """
+    Rasterize zone polygons to an int32 array of zone numbers: 1 for the first
+    geometry, 2 for the second, ... and 0 outside all of them.
+    """
+    zones = np.zeros(grid.shape, np.int32)
+    for i, geometry in enumerate(geometries):
+        zones[polygon_mask(geometry, grid)] = i + 1
+    return zones
+
+
+def overlap_weights(src_edges, dst_edges):
+    """
+    Area-overlap weights along one axis. For every source pixel returns the
+    destination pixels it overlaps (slots x source pixels) and the fraction of
+    each destination pixel it covers. Edges must increase.
+    """
+    src_edges = np.asarray(src_edges, np.float64)
+    dst_edges = np.asarray(dst_edges, np.float64)
+    ratio = np.diff(src_edges).max() / np.diff(dst_edges).min()
+    n_slots = int(np.ceil(ratio)) + 1
+    first = np.searchsorted(dst_edges, src_edges[:-1], side="right") - 1
+
+    index = first[None, :] + np.arange(n_slots)[:, None]
+    valid = (index >= 0) & (index < len(dst_edges) - 1)
+    safe = np.clip(index, 0, len(dst_edges) - 2)
+    lo = np.maximum(src_edges[:-1][None, :], dst_edges[safe])
+    hi = np.minimum(src_edges[1:][None, :], dst_edges[safe + 1])
+    weights = np.where(valid, np.maximum(hi - lo, 0), 0) / \
+        (dst_edges[safe + 1] - dst_edges[safe])
+    return safe, weights
+
+
+def _sum_slots(values, index, weights, n_out, axis):
+    out_shape = list(values.shape)
+    out_shape[axis] = n_out
+    out = np.zeros(out_shape, np.float64)
+    for slot_index, slot_weights in zip(index, weights):
+        shape = [1, 1]
+        shape[axis] = -1
+        weighted = values * slot_weights.reshape(shape)
+        # index is sorted, sum each run of source pixels in one call
+        targets, starts = np.unique(slot_index, return_index=True)
+        sums = np.add.reduceat(weighted, starts, axis=axis)
+        if axis == 0:
+            out[targets] += sums
+        else:
+            out[:, targets] += sums
+    return out
+
+
+class AreaWeights(object):
+    """
+    Exact area weights from a source grid (the 250-m flood map) to a target
+    grid (a population grid). Both are lon/lat grids, so the overlap of two
+    pixels is the product of their overlap along x and along y and the
+    weights are stored per axis.
+    """
+
+    def __init__(self, src_grid, dst_grid):
+        self.src_grid = src_grid
+        self.dst_grid = dst_grid
+        self.x_index, self.x_weights = overlap_weights(src_grid.x_edges(),
+                                                       dst_grid.x_edges())
+        # Rows counted from the top so the edges increase
+        self.y_index, self.y_weights = overlap_weights(
+            src_grid.north - src_grid.y_edges(),
+            src_grid.north - dst_grid.y_edges())
+
+    def resample(self, values):
+        """Area weighted mean of a source grid array on the target grid"""
+        values = np.asarray(values, np.float64)
+        cols = _sum_slots(values, self.x_index, self.x_weights,
+                          self.dst_grid.shape[1], axis=1)
+        return _sum_slots(cols, self.y_index, self.y_weights,
+                          self.dst_grid.shape[0], axis=0)
+
+
+class ZonalEngine(object):
+    """
+    Flooded area and flooded population of every zone.
+
+    Args:
+        zones: list of (zone ID, GeoJSON geometry), e.g. countries or FPUs
+        flood_grid: Grid of the flood maps
+        pop_grid: Grid of the population products
+        flood_zones: zones already rasterized to the flood grid
+    """
+
+    def __init__(self, zones, flood_grid, pop_grid, flood_zones=None):
+        self.zone_ids = [z[0] for z in zones]
+        geometries = [z[1] for z in zones]
+        self.flood_grid = flood_grid
+        self.pop_grid = pop_grid
+        if flood_zones is None:
+            flood_zones = rasterize(geometries, flood_grid)
+        self.flood_zones = flood_zones
+        self.pop_zones = rasterize(geometries, pop_grid)
+        self.weights = AreaWeights(flood_grid, pop_grid)
+        self.pixel_area = flood_grid.pixel_area()
+
+    @property
+    def n_zones(self):
+        return len(self.zone_ids)
+
+    def flood_mask(self, flooded, perm_water=None):
+        """Flooded pixels that are not permanent water (maskImages)"""
+        flood = np.nan_to_num(np.asarray(flooded, np.float64)) > 0
+        if perm_water is not None:
+            flood &= ~np.asarray(perm_water, bool)
+        return flood
+
+    def flooded_area(self, flood):
+        """Flooded area of each zone in square meters"""
+        area = flood * self.pixel_area[:, None]
+        return np.bincount(self.flood_zones.ravel(), area.ravel(),
+                           minlength=self.n_zones + 1)[1:]
+
+    def exposure(self, flooded, populations, perm_water=None):
+        """
+        Args:
+            flooded: flood map on the flood grid (the 'flooded' band)
+            populations: ordered dict of population arrays on the population
+                         grid, e.g. {"Exposed": ghsl}. NaN counts as 0.
+            perm_water: optional boolean permanent water on the flood grid
+
+        Returns:
+            - 'Area': flooded area of each zone (m2)
+            - one array per population product with the flooded population
+              of each zone
+        """
+        flood = self.flood_mask(flooded, perm_water)
+        names = list(populations.keys())
+        sums = self.zone_sums(self.weights.resample(flood),
+                              [populations[n] for n in names])
+
+        result = OrderedDict([("Area", self.flooded_area(flood))])
+        for i, name in enumerate(names):
+            result[name] = sums[i, 0]
+        return result
+
+    def zone_sums(self, fraction, populations, classes=None, n_classes=1):
+        """
+        Flooded population of every (product, class, zone) in one bincount.
+
+        Args:
+            fraction: flooded fraction of each population pixel
+            populations: list of population arrays on the population grid
+            classes: optional int array of class numbers (0 to n_classes - 1)
+                     on the population grid, -1 for no class
+
+        Returns:
+            - array of shape (products, classes, zones)
+        """
+        n_bins = n_classes * (self.n_zones + 1)
+        index = self.pop_zones.astype(np.int64)
+        weight = np.ones(self.pop_grid.shape)
+        if classes is not None:
+            classes = np.asarray(classes)
+            index = index + np.maximum(classes, 0).astype(np.int64) * \
+                (self.n_zones + 1)
+            weight = (classes >= 0).astype(np.float64)
+
+        # Bin numbers offset per product: product, class, zone
+        pop = np.stack([np.nan_to_num(np.asarray(p, np.float64))
+                        for p in populations])
+        index = index[None] + (np.arange(len(populations)) * n_bins)[:, None, None]
+        sums = np.bincount(index.ravel(), (pop * (fraction * weight)[None]).ravel(),
+                           minlength=len(populations) * n_bins)
+        return sums.reshape(len(populations), n_classes, self.n_zones + 1)[:, :, 1:]
+
+    def exposure_table(self, events, populations, zone_field="FPU"):
+        """
+        Exposure of many events on the same grids in one call.
+
+        Args:
+            events: iterable of (event properties, flood map) or
+                    (event properties, flood map, permanent water). The
+                    properties (e.g. id, Year, Month, Day) go in every row.
+            populations: ordered dict of population arrays, or a function
+                         taking the event properties and returning one (the
+                         GHSL year closest to the event)
+
+        Returns:
+            - a list of rows (dicts), one per event and zone, with the same
+              columns as getFloodPopbyCountry_GHSLTimeSeries
+        """
+        rows = []
+        for event in events:
+            props, flooded = event[0], event[1]
+            perm_water = event[2] if len(event) > 2 else None
+            pops = populations(props) if callable(populations) else populations
+            result = self.exposure(flooded, pops, perm_water)
+            for i, zone_id in enumerate(self.zone_ids):
+                row = OrderedDict(props)
+                row[zone_field] = zone_id
+                for name, values in result.items():
+                    row[name] = float(values[i])
+                rows.append(row)
+        return rows
+
+
+# GHSL settlement model (SMOD) classes used in the population sensitivity
+# analysis (main_popsensitivity.txt)
+SETTLEMENT_CLASSES = OrderedDict([("rural", [0, 1]),
+                                  ("semiurban", [2]),
+                                  ("urban", [3])])
+
+
+def class_index(values, class_values=SETTLEMENT_CLASSES):
+    """Class number of each pixel from its raw value, -1 if in no class"""
+    values = np.asarray(values)
+    index = np.full(values.shape, -1, np.int16)
+    for i, codes in enumerate(class_values.values()):
+        index[np.isin(values, codes)] = i
+    return index
+
+
+def sample_nearest(values, src_grid, dst_grid, fill=-1):
+    """Nearest neighbour sample of a source grid array at the target pixels"""
+    x = dst_grid.west + (np.arange(dst_grid.shape[1]) + 0.5) * dst_grid.pixel_width
+    y = dst_grid.north - (np.arange(dst_grid.shape[0]) + 0.5) * dst_grid.pixel_height
+    cols = np.floor((x - src_grid.west) / src_grid.pixel_width).astype(np.int64)
+    rows = np.floor((src_grid.north - y) / src_grid.pixel_height).astype(np.int64)
+    inside = (rows[:, None] >= 0) & (rows[:, None] < src_grid.shape[0]) & \
+             (cols[None, :] >= 0) & (cols[None, :] < src_grid.shape[1])
+    out = np.asarray(values)[np.clip(rows, 0, src_grid.shape[0] - 1)[:, None],
+                             np.clip(cols, 0, src_grid.shape[1] - 1)[None, :]]
+    return np.where(inside, out, fill)
+
+
+class MultiExposure(object):
+    """
+    Flooded population of several population products, split by settlement
+    class, for every zone from one read of the flood map.
+
+    The flood mask is built once, resampled once to each distinct population
+    grid, and all products and classes on that grid are reduced together, so
+    the full (product x class x zone) table costs one pass instead of one
+    reduceRegion per product, class and zone.
+
+    Args:
+        zones: list of (zone ID, GeoJSON geometry)
+        flood_grid: Grid of the flood maps
+        datasets: ordered dict of product name -> (Grid, population array)
+        settlement: optional (Grid, array) of settlement codes, e.g. GHSL SMOD
+        class_values: ordered dict of class name -> settlement codes
+    """
+
+    def __init__(self, zones, flood_grid, datasets, settlement=None,
+                 class_values=SETTLEMENT_CLASSES):
+        self.zone_ids = [z[0] for z in zones]
+        self.flood_grid = flood_grid
+        self.datasets = OrderedDict(datasets)
+        self.class_names = list(class_values.keys()) if settlement else []
+        flood_zones = rasterize([z[1] for z in zones], flood_grid)
+
+        # One engine (zones, area weights, classes) per population grid
+        self.groups = OrderedDict()
+        for name, (grid, _) in self.datasets.items():
+            key = (grid.west, grid.north, grid.pixel_width, grid.pixel_height,
+                   grid.shape)
+            if key not in self.groups:
+                classes = None
+                if settlement is not None:
+                    classes = class_index(sample_nearest(settlement[1],
+                                                         settlement[0], grid),
+                                          class_values)
+                self.groups[key] = {"engine": ZonalEngine(zones, flood_grid,
+                                                          grid, flood_zones),
+                                    "classes": classes, "names": []}
+            self.groups[key]["names"].append(name)
+
+    def exposure(self, flooded, perm_water=None):
+        """
+        Returns:
+            - 'Area': flooded area of each zone (m2)
+            - 'floodpop_<product>_<class>' and 'floodpop_<product>_tot' for
+              every product and class, same columns as gfd_popsensitivity.csv
+        """
+        engine = list(self.groups.values())[0]["engine"]
+        flood = engine.flood_mask(flooded, perm_water)
+        result = OrderedDict([("Area", engine.flooded_area(flood))])
+        n_classes = max(len(self.class_names), 1)
+        for group in self.groups.values():
+            fraction = group["engine"].weights.resample(flood)
+            sums = group["engine"].zone_sums(
+                fraction, [self.datasets[n][1] for n in group["names"]],
+                group["classes"], n_classes)
+            for i, name in enumerate(group["names"]):
+                for j, class_name in enumerate(self.class_names):
+                    result["floodpop_{0}_{1}".format(name, class_name)] = sums[i, j]
+                result["floodpop_{0}_tot".format(name)] = sums[i].sum(axis=0)
+        return result
+
+    def table(self, flooded, perm_water=None, zone_field="zone"):
+        """The exposure as a list of rows (dicts), one per zone"""
+        result = self.exposure(flooded, perm_water)
+        rows = []
+        for i, zone_id in enumerate(self.zone_ids):
+            row = OrderedDict([(zone_field, zone_id)])
+            for name, values in result.items():
+                row[name] = float(values[i])
+            rows.append(row)
+        return rows
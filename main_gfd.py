@@ -3,10 +3,10 @@
 import ee
 ee.Initialize()
 
-from flood_detection import modis
-from flood_detection.utils import export, misc
+from flood_detection import batch, modis
+from flood_detection.utils import basins, catalog, export, misc, roi, timing
 
-import time, os, csv
+import time
 
 # INPUTS
 # Enter the ID of the GEE Asset that contains the list of events to be mapped
@@ -26,25 +26,67 @@ event_db = ee.FeatureCollection("projects/global-flood-db/dfo-polygons/qc-aug-01
 gcs_folder = "gfd_v3"
 asset_path = "projects/global-flood-db/gfd_v3"
 
+# Asset with the precomputed slope classes from misc.get_slope_classes(). Set
+# to None to compute the slope from GMTED2010 for every event.
+slope_classes = None
+
+# Assets of the precomputed permanent water masks from
+# misc.get_perm_water_exports(). Left as None the masks are built from the JRC
+# dataset for every event.
+misc.PERM_WATER_ASSET = None
+misc.YEARLY_PERM_ASSET = None
+
+# Directory of a local basin index (flood_detection.utils.basins.BasinIndex)
+# with the HydroSheds level 4 basins built in it. The watersheds of every event
+# are then selected and dissolved locally in one go. Left as None each event
+# runs a filterBounds on the global basin table.
+basin_index = None
+
+# Simplify the watershed of each event to this error (in meters) and mask the
+# images with its rasterized roi instead of clipping them (utils/roi.py). This
+# is faster for complex basins but changes the flood maps along the edges of
+# the roi. None (the default) keeps the full-resolution basins, set it to
+# roi.EE_MAX_ERROR (half of a 250-m pixel) to use the simplified roi.
+roi_max_error = None
+# roi_max_error = roi.EE_MAX_ERROR
+
+# Checkpoint of completed/failed events. Re-running the script with the same
+# checkpoint file skips events that are already done.
+checkpoint_file = "error_logs/gfd_v3/checkpoint.csv"
+
+# Set to the path of an error log to only re-run the events that failed
+rerun_errors = None
+# rerun_errors = "error_logs/gfd_v3/3Day_otsu_error_log_23_07_2019_1.csv"
+
+# Number of events mapped at the same time, and how many events can be
+# started per second (burst of up to 50 events, refilling at 50 per 15 mins)
+workers = 4
+events_per_sec = 50 / 900.0
+
+# Trace of the time and server round trips of every stage of each event
+# (utils/timing.py), as JSON lines and a Chrome trace. None to not record it.
+trace_file = None
+chrome_trace_file = None
+# trace_file = "error_logs/gfd_v3/trace_{0}.jsonl".format(time.strftime("%d_%m_%Y"))
+
 #-------------------------------------------------------------------------------
 # PROCESSING STARTS HERE
 
 # Create Error Log file
 log_file = "error_logs/gfd_v3/error_log_{0}.csv".format(time.strftime("%d_%m_%Y"))
 
-with open(log_file,"ab") as out_file:
-    wr = csv.writer(out_file)
-    wr.writerow(["error_type", "dfo_id", "error_message"])
+# Load the properties and polygons of all events in one request. The local
+# copy of the QC database can be used instead to skip the request entirely.
+event_catalog = catalog.EventCatalog.from_feature_collection(event_db)
+# event_catalog = catalog.EventCatalog.from_csv(catalog.QC_DATABASE)
 
-# Create list of events from input gee asset
-event_ids = ee.List(event_db.filterMetadata("ID", "greater_than", 4603).aggregate_array('ID')).sort()
-id_list = event_ids.getInfo()
-id_list = [int(i) for i in id_list]
+# The properties and file names of the exported assets come from the DFO
+# database, as they did when export.to_asset looked up each event in it
+dfo_catalog = catalog.EventCatalog.from_feature_collection(
+    ee.FeatureCollection(export.DFO_TABLE))
 
-# NOTE: Code snippet for when you are re-running floods in error log
-# errors = "error_logs\\gfd_v3\\3Day_otsu_error_log_23_07_2019_1.csv"
-# with open(errors) as f:
-#     id_list = sorted([int(float(row["dfo_id"])) for row in csv.DictReader(f)])
+# Create list of events from input gee asset
+id_list = event_catalog.ids(min_id=4603)
 
 # NOTE: ID List for Validation Floods
 # id_list = [1641,1810,1818,1910,1925,1931,1971,2024,2035,2045,2075,2076,2099,
@@ -59,39 +101,47 @@ id_list = [int(i) for i in id_list]
 #            4272,4314,4315,4325,4339,4340,4346,4357,4364,4427,4428,4435,4444,
 #            4464,4507,4516]
 
-snooze_button = 1
-for event in id_list:
+# Watersheds of all events from the local basin index
+if basin_index is not None:
+    watersheds = basins.BasinIndex(basin_index).bulk_union(
+        "level4", dict((i, event_catalog.geometry(i)) for i in id_list
+                       if i in event_catalog.geometries))
 
-    # Check if we have worn out GEE
-    if snooze_button%50==0: #if true - hit the snooze button
-        print "---------------------Giving GEE a breather for 15 mins--------------------"
-        time.sleep(900)
+def map_event(event):
 
     # Get event date range
-    flood_event = ee.Feature(event_db.filterMetadata('ID', 'equals', event).first())
-    began = str(ee.Date(flood_event.get('Began')).format('yyyy-MM-dd').getInfo())
-    ended = str(ee.Date(flood_event.get('Ended')).format('yyyy-MM-dd').getInfo())
-    thresh_type = str(flood_event.get('ThreshType').getInfo())
-
-    if thresh_type == 'std':
-        thresh_type = 'standard'
-    else:
-        pass
+    began = event_catalog.began(event)
+    ended = event_catalog.ended(event)
+    thresh_type = event_catalog.thresh_type(event)
 
     # Use polygon from event GEE Asset to select watersheds from global
     # HydroSheds data choose level3, level4, or level5
-    watershed = misc.get_watersheds_level4(flood_event.geometry()).union().geometry()
-    # watershed = misc.get_islands(flood_event.geometry()).union().geometry()
+    if basin_index is not None:
+        geometry = watersheds.get(event, ((), None))[1]
+        if geometry is None:
+            raise batch.EventError("DFO Algorithm Error",
+                                   "No watershed intersects the event")
+        watershed = basins.ee_geometry(geometry)
+    else:
+        event_geometry = event_catalog.ee_geometry(event)
+        watershed = misc.get_watersheds_level4(event_geometry).union().geometry()
+    # watershed = misc.get_islands(event_geometry).union().geometry()
+    roi_mask = None
+    if roi_max_error is not None:
+        watershed = roi.ee_simplify(watershed, roi_max_error)
+        roi_mask = roi.ee_mask(watershed)
 
     try:
         # Map the event. Returns 4 band image: 'flooded', 'duration',
         # 'clearViews', 'clearPerc'
-        print "Mapping Event {0} - {1} threshold".format(event, thresh_type)
-        flood_map = modis.dfo(watershed, began, ended, thresh_type, "3Day")
+        print("Mapping Event {0} - {1} threshold".format(event, thresh_type))
+        flood_map = modis.dfo(watershed, began, ended, thresh_type, "3Day",
+                              roi_mask=roi_mask)
 
         # Apply slope mask to remove false detections from terrain
         # shadow. Input your image and choose a slope (in degrees) as a threshold
-        flood_map_slope_mask = misc.apply_slope_mask(flood_map, thresh=5)
+        flood_map_slope_mask = misc.apply_slope_mask(flood_map, thresh=5,
+                                                      slope_classes=slope_classes)
 
         # Get permanent water from JRC dataset at MODIS resolution
         perm_water = misc.get_jrc_perm(watershed)
@@ -107,14 +157,9 @@ for event in id_list:
                                   'gfd_country_name': str(country_info[1])})
 
     except Exception as e:
-        s = str(e)
-        with open(log_file,"ab") as out_file:
-            wr = csv.writer(out_file)
-            wr.writerow(["DFO Algorithm Error", event, s])
-        print "DFO Algorithm Error {0} - Cataloguing and moving onto next event".format(event)
-        print "-------------------------------------------------"
-        snooze_button+=1
-        continue
+        if batch.is_quota_error(e):
+            raise
+        raise batch.EventError("DFO Algorithm Error", str(e))
 
     try:
     #     Export to an asset. This function needs the ee.Image of the flood map
@@ -122,19 +167,34 @@ for event in id_list:
     #     map_floodEvent_MODIS, the path to where the asset will be saved, and
     #     the resolution (in meters) to save it (default = 250m)
 
-        export.to_asset(dfo_final, watershed.bounds(), asset_path, 250)
-        export.to_gcs(dfo_final, watershed.bounds(), gcs_folder, 'DFO', 250)
+        export.to_asset(dfo_final, watershed.bounds(), asset_path, 250,
+                        dfo_id=event, catalog=dfo_catalog)
+        export.to_gcs(dfo_final, watershed.bounds(), gcs_folder, 'DFO', 250,
+                      dfo_id=event, catalog=event_catalog)
 
-        print "Uploading DFO {0} to GEE Assets & GCS".format(event)
-        print "-------------------------------------------------"
+        print("Uploading DFO {0} to GEE Assets & GCS".format(event))
 
+    # Not retried, a retry would start the export that already went through
+    # a second time
     except Exception as e:
-        s = str(e)
-        with open(log_file,"ab") as out_file:
-            wr = csv.writer(out_file)
-            wr.writerow(["Export Error", event, s])
-        print "Export Error DFO {0} - Cataloguing and moving onto next event".format(event)
-        print "-------------------------------------------------"
-
-    # Add to the snooze_button so we don't make Noel angry.
-    snooze_button+=1
+        if batch.is_quota_error(e):
+            raise batch.EventError(batch.QUOTA_ERROR, str(e))
+        raise batch.EventError("Export Error", str(e))
+
+if trace_file is not None:
+    timing.start(trace_file, chrome_trace_file)
+
+# Run all events through a pool of workers. The token bucket replaces the old
+# snooze_button so we still don't make Noel angry.
+runner = batch.BatchRunner(timing.per_event(map_event),
+                           batch.CheckpointStore(checkpoint_file),
+                           log_file=log_file, workers=workers,
+                           rate_limiter=batch.TokenBucket(events_per_sec, 50))
+
+try:
+    if rerun_errors is None:
+        runner.run(id_list)
+    else:
+        runner.run_failures(rerun_errors)
+finally:
+    timing.stop()
@@ -7,59 +7,56 @@
 import ee
 ee.Initialize()
 
-from flood_stats import pop_utils
-import time, csv
+from flood_detection.batch import CheckpointStore, TokenBucket
+from flood_detection.utils import timing
+from flood_stats import batch, pop_utils
+import time
 
 # Image Collection of flood maps, each needs layer called "flooded" that
 # is 1 = flooded, 0 = not flooded
 gfd = ee.ImageCollection('projects/global-flood-db/gfd_v3').filterMetadata('id','greater_than',4335)
 
-# Create Error Log file
-log_file = "error_logs/event_stats/pop_error_log_{0}.csv".format(time.strftime("%d_%m_%Y"))
-with open(log_file,"w", newline='') as out_file:
-    wr = csv.writer(out_file)
-    wr.writerow(["error_type", "dfo_id", "error_message"])
+# Checkpoint of the events already exported. Re-running the script with the
+# same checkpoint only exports the new events.
+checkpoint_file = "error_logs/event_stats/pop_checkpoint.csv"
 
-# Create list of events from input fusion table
-event_ids = ee.List(gfd.aggregate_array('id')).sort()
-id_list = event_ids.getInfo()
-id_list = [int(i) for i in id_list]
-
-for event_id in id_list:
-    # Get event date range, they can be passed as Strings
-    flood_event = ee.Image(gfd.filterMetadata('id', 'equals', event_id).first())
+# Number of events reduced and exported together, and the number of export
+# tasks running at the same time
+group_size = 25
+max_tasks = 10
 
-    try:
-        # Calculate flood stats
-        flood_stats = pop_utils.getFloodPopbyCountry_GHSLTimeSeries(flood_event)
-        index = flood_stats.get("id").getInfo()
-        print("calculated results, exporting results for DFO {0}...".format(int(index)))
+# Trace of the time and server round trips of each stage (JSON lines, see
+# flood_detection/utils/timing.py). None to not record it.
+trace_file = None
 
-    except Exception as e:
-        s = str(e)
-        with open(log_file,"w", newline='') as out_file:
-            wr = csv.writer(out_file)
-            wr.writerow(["Calculation Error", event_id, s])
-        print("Calculation Error {0} - Cataloguing and moving onto next event".format(event_id))
-        print("-------------------------------------------------")
+#-------------------------------------------------------------------------------
+# PROCESSING STARTS HERE
 
-    # Export results
-    try:
-        task = ee.batch.Export.table.toCloudStorage(
-            collection = flood_stats,
-            description = 'GFD_bycountryEstimates_GHSL_TS_{0}'.format(str(int(index))),
-            bucket = 'event_stats',
-            fileNamePrefix = 'ghsl_fpu/GFD_{0}_Pop_Area_GHSL_TS_2019_07_29'.format(str(int(index))),
-            fileFormat = 'CSV')
+if trace_file is not None:
+    timing.start(trace_file)
 
-        task.start()
+# Create list of events from input fusion table
+event_ids = ee.List(gfd.aggregate_array('id')).sort()
+id_list = event_ids.getInfo()
+id_list = [int(i) for i in id_list]
 
-    except Exception as e:
-        s = str(e)
-        with open(log_file,"ab") as out_file:
-            wr = csv.writer(out_file)
-            wr.writerow(["Export Error", event_id, s])
-        print("Export Error DFO {0} - Cataloguing and moving onto next event".format(event_id))
-        print("-------------------------------------------------")
+# Export one table for every group of events
+def export_group(flood_stats, name):
+    return ee.batch.Export.table.toCloudStorage(
+        collection = flood_stats,
+        description = 'GFD_bycountryEstimates_GHSL_TS_{0}'.format(name),
+        bucket = 'event_stats',
+        fileNamePrefix = 'ghsl_fpu/GFD_{0}_Pop_Area_GHSL_TS_{1}'.format(
+            name, time.strftime("%Y_%m_%d")),
+        fileFormat = 'CSV')
+
+runner = batch.PopStatsRunner(CheckpointStore(checkpoint_file),
+                              group_size=group_size, max_tasks=max_tasks,
+                              rate_limiter=TokenBucket(1, 5))
+try:
+    runner.run_ee(gfd, id_list, pop_utils.getFloodPopbyCountry_GHSLTimeSeries,
+                  export_group)
+finally:
+    timing.stop()
 
 print('Done!')